@@ -0,0 +1,575 @@
+import asyncio
+import hashlib
+import inspect
+import itertools
+import json
+import os
+from datetime import datetime
+from Encryption import EncryptionManager
+from Codec import (MessageCodec, FrameTooLargeError, extract_frame, build_chunk_frame, available_encodings,
+                   available_compressions, DEFAULT_COMPRESSION_THRESHOLD)
+
+
+def hash_file(path):
+    """(SHA-256 hex digest, size) of a file, read in 1 MB blocks."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+
+class AsyncClientComm:
+    """
+    asyncio client for the chat server.
+
+    One instance is one connection. All methods must be called from the
+    event loop the connection was opened on; many instances can share one
+    loop, which is what bots and load generators want.
+    """
+
+    def __init__(self, config_path=None, encryption=None):
+        self.server_ip = None
+        self.server_port = None
+        # Pass an EncryptionManager that already has keys to skip RSA key
+        # generation, which dominates connect time for simulated users
+        self.encryption = encryption or EncryptionManager()
+        self.reader = None
+        self.writer = None
+        self.is_connected = False
+        self.receive_task = None
+        self.receive_buffer = bytearray()
+        self.codec = MessageCodec()  # JSON until the handshake negotiates otherwise
+        self.encodings = available_encodings()  # Encodings offered to the server
+        self.compressions = available_compressions()  # Compression methods offered to the server
+        self.pending_requests = {}  # {request_id: asyncio.Future} awaiting their response
+        self.request_ids = itertools.count(1)
+        self.message_callback = None  # Called with each new_message, sync or async
+        self.unread_callback = None  # Called with each unread_counts frame, sync or async
+        self.untagged_callback = None  # Called with responses that carry no request_id
+        self.exports = {}  # {export_id: asyncio.Queue} of the chat exports being received
+        self.downloads = {}  # {download_id: asyncio.Queue} of the attachment downloads being received
+        self.session_token = None
+        self.username = None
+
+        if config_path is None:
+            config_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "config.json"))
+        self.load_config(config_path)
+
+    def load_config(self, config_path):
+        """Load server IP and port from config.json."""
+        try:
+            with open(config_path, "r") as file:
+                config = json.load(file)
+                self.server_ip = config.get("server_ip_address")
+                self.server_port = config.get("server_port")
+                if not self.server_ip or not self.server_port:
+                    raise ValueError("Missing server configuration")
+                protocol = config.get("protocol", {})
+                if "encodings" in protocol:
+                    self.encodings = [name for name in protocol["encodings"]
+                                      if name in available_encodings()]
+                if "compression" in protocol:
+                    self.compressions = [name for name in protocol["compression"]
+                                         if name in available_compressions()]
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            raise RuntimeError(f"Failed to load configuration: {str(e)}")
+
+    async def connect(self):
+        """
+        Open the connection and perform the secure handshake.
+
+        Raises:
+            ConnectionError: If the server can't be reached or the handshake fails
+        """
+        self.receive_buffer = bytearray()
+        self.codec = MessageCodec()  # The handshake itself is always JSON
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.server_ip, self.server_port)
+            await self._establish_secure_connection()
+        except Exception as e:
+            await self._close_writer()
+            raise ConnectionError(f"Failed to establish secure connection: {str(e)}")
+
+        self.is_connected = True
+        self.receive_task = asyncio.get_running_loop().create_task(self._receive_loop())
+        return True
+
+    async def _establish_secure_connection(self):
+        """Perform the secure handshake protocol with the server."""
+        # 1. Generate client keys off the event loop, unless we were given some
+        if self.encryption.private_key is None:
+            await asyncio.get_running_loop().run_in_executor(None, self.encryption.generate_keys)
+
+        # 2. Send public key to server, offering our encodings
+        await self._send_frame({
+            "type": "key_exchange",
+            "data": {
+                "client_public_key": self.encryption.get_public_key().decode(),
+                "encodings": self.encodings,
+                "compression": self.compressions
+            }
+        })
+
+        # 3. Receive server's public key
+        response = await self._receive_one_message()
+        if response.get("type") != "key_exchange":
+            raise ValueError("Invalid key exchange response")
+        self.encryption.set_server_public_key(response["data"]["server_public_key"].encode())
+
+        # 4. Generate and send session key
+        self.encryption.generate_session_key()
+        encrypted_session_key = self.encryption.encrypt_session_key()
+        await self._send_frame({
+            "type": "session_key",
+            "data": {
+                "encrypted_session_key": encrypted_session_key.hex()
+            }
+        })
+
+        # 5. Wait for confirmation
+        response = await self._receive_one_message()
+        if response.get("type") != "session_confirmed":
+            raise ValueError("Session establishment failed")
+
+        # 6. Switch to the wire format the server picked (older servers don't say)
+        confirmed = response["data"]
+        self.codec = MessageCodec(
+            confirmed.get("encoding", "json"),
+            compression=confirmed.get("compression"),
+            compression_threshold=confirmed.get("compression_threshold") or DEFAULT_COMPRESSION_THRESHOLD
+        )
+
+    async def _send_frame(self, message):
+        self.writer.write(self.codec.build_frame(message))
+        await self.writer.drain()
+
+    async def _send_bytes(self, frame):
+        # A whole frame per write, so frames sent from other tasks go in between, never inside
+        self.writer.write(frame)
+        await self.writer.drain()
+
+    async def _receive_one_message(self):
+        """Receive exactly one complete framed message."""
+        while True:
+            try:
+                frame = extract_frame(self.receive_buffer)
+            except FrameTooLargeError:
+                raise ConnectionError("Server sent an oversized frame")
+            except ValueError:
+                # Invalid length prefix, drop what we have and resync
+                self.receive_buffer.clear()
+                frame = None
+
+            if frame is not None:
+                return self.codec.decode_frame(frame)
+
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("Server disconnected")
+            self.receive_buffer += data
+
+    async def _receive_loop(self):
+        """Dispatch incoming frames until the connection closes."""
+        try:
+            while True:
+                message = await self._receive_one_message()
+                if message.get("type") == "ping":
+                    # Server heartbeat; any frame back tells it we're alive
+                    await self._send_frame({"type": "pong", "data": {}})
+                elif message.get("type") == "new_message":
+                    if self.message_callback:
+                        try:
+                            # Awaited inline so callbacks see messages in order
+                            result = self.message_callback(message)
+                            if inspect.isawaitable(result):
+                                await result
+                        except Exception as e:
+                            print(f"Error in message callback: {e}")
+                elif message.get("type") == "unread_counts":
+                    if self.unread_callback:
+                        try:
+                            result = self.unread_callback(message["data"]["chats"])
+                            if inspect.isawaitable(result):
+                                await result
+                        except Exception as e:
+                            print(f"Error in unread callback: {e}")
+                elif message.get("type") == "export_chat_chunk":
+                    queue = self.exports.get(message.get("data", {}).get("export_id"))
+                    if queue is not None:
+                        queue.put_nowait(message["data"])
+                elif message.get("type") == "attachment_chunk":
+                    queue = self.downloads.get(message["data"]["transfer_id"])
+                    if queue is not None:
+                        queue.put_nowait(message["data"])
+                elif "request_id" in message:
+                    future = self.pending_requests.pop(message["request_id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(message.get("data", {}))
+                elif self.untagged_callback:
+                    self.untagged_callback(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        finally:
+            self.is_connected = False
+            self._fail_pending_requests(ConnectionError("Connection to server lost"))
+            for queue in [*self.exports.values(), *self.downloads.values()]:
+                queue.put_nowait(None)
+
+    def _fail_pending_requests(self, error):
+        """Fail every in-flight request, e.g. after losing the connection."""
+        futures = list(self.pending_requests.values())
+        self.pending_requests.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    async def request(self, request_type, data, timeout=None):
+        """
+        Send a request and wait for its response.
+
+        Requests carry their own request_id, so any number of them can be
+        in flight on one connection at the same time.
+
+        Returns:
+            The response's data dict
+
+        Raises:
+            ConnectionError: If not connected or the connection drops
+            asyncio.TimeoutError: If timeout seconds pass without a response
+        """
+        if not self.is_connected:
+            raise ConnectionError("Not connected to server")
+
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending_requests[request_id] = future
+        try:
+            await self._send_frame({
+                "type": request_type,
+                "data": data,
+                "request_id": request_id
+            })
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            # Covers timeouts and cancellation; a late response is then dropped
+            self.pending_requests.pop(request_id, None)
+
+    def set_message_callback(self, callback):
+        """Set callback (plain function or coroutine function) for new_message frames."""
+        self.message_callback = callback
+
+    async def register(self, username, password):
+        """Register a new account."""
+        return await self.request("register", {
+            "username": username,
+            "password": password
+        })
+
+    async def login(self, username, password):
+        """Log in and remember the session token for later requests."""
+        response = await self.request("login", {
+            "username": username,
+            "password": password
+        })
+        if response.get("success"):
+            self.session_token = response.get("token")
+            self.username = username
+        return response
+
+    async def start_private_chat(self, target_username):
+        """Open (or create) the private chat with another user, with its history."""
+        return await self.request("start_private_chat", {
+            "token": self.session_token,
+            "target_username": target_username
+        })
+
+    async def search_users(self, query, limit=10):
+        """Find usernames starting with query, for autocomplete."""
+        return await self.request("search_users", {
+            "token": self.session_token,
+            "query": query,
+            "limit": limit
+        })
+
+    async def search_archive(self, chat_id, query, limit=20):
+        """Search a chat's archived (expired) messages, newest first."""
+        return await self.request("search_archive", {
+            "token": self.session_token,
+            "chat_id": chat_id,
+            "query": query,
+            "limit": limit
+        })
+
+    async def send_message(self, chat_id, content, attachment=None):
+        """Send a chat message, optionally with an attachment from upload_attachment(), and wait for the server to store it."""
+        data = {
+            "token": self.session_token,
+            "chat_id": chat_id,
+            "content": content,
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        if attachment is not None:
+            data["attachment"] = {"attachment_id": attachment["attachment_id"], "filename": attachment["filename"]}
+        return await self.request("send_message", data)
+
+    async def upload_attachment(self, path, filename=None):
+        """
+        Upload a file for sending with send_message(), resuming an earlier
+        upload of it that was cut off.
+
+        Chunks go out one at a time as the socket drains, so other requests
+        on the connection are sent in between rather than after the file.
+
+        Returns:
+            {attachment_id, filename, size}
+        Raises:
+            ConnectionError: If not connected or the connection drops
+            RuntimeError: If the server refuses or rejects the upload
+        """
+        attachment_id, size = await asyncio.get_running_loop().run_in_executor(None, hash_file, path)
+        response = await self.request("upload_start", {
+            "token": self.session_token,
+            "attachment_id": attachment_id,
+            "size": size
+        })
+        if not response.get("success"):
+            raise RuntimeError(response.get("message", "Upload refused"))
+        if not response.get("complete"):
+            upload_id, offset, chunk_size = response["upload_id"], response["offset"], response["chunk_size"]
+            with open(path, "rb") as file:
+                file.seek(offset)
+                while offset < size:
+                    chunk = file.read(chunk_size)
+                    if not chunk:
+                        raise RuntimeError(f"{path} changed during the upload")
+                    await self._send_bytes(build_chunk_frame(upload_id, offset, chunk))
+                    offset += len(chunk)
+            response = await self.request("upload_finish", {
+                "token": self.session_token,
+                "upload_id": upload_id
+            })
+            if not response.get("success"):
+                raise RuntimeError(response.get("message", "Upload failed"))
+        return {"attachment_id": attachment_id, "filename": filename or os.path.basename(path), "size": size}
+
+    async def download_attachment(self, attachment_id, path, window=8):
+        """
+        Download an attachment to path, resuming from path + ".part" if an
+        earlier download was cut off.
+
+        Like export_chat(), chunks are granted window at a time and granted
+        again as they are written, and the finished file is checked against
+        the attachment_id (its SHA-256) before it is moved to path.
+
+        Returns:
+            path
+        Raises:
+            ConnectionError: If not connected or the connection drops
+            RuntimeError: If the server refuses or the content doesn't match
+        """
+        partial = path + ".part"
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        download_id = next(self.request_ids)
+        queue = asyncio.Queue()
+        self.downloads[download_id] = queue
+        finished = False
+        try:
+            response = await self.request("download_start", {
+                "token": self.session_token,
+                "attachment_id": attachment_id,
+                "download_id": download_id,
+                "offset": offset,
+                "window": window
+            })
+            if not response.get("success"):
+                finished = True
+                raise RuntimeError(response.get("message", "Download refused"))
+            size, window = response["size"], response.get("window", window)
+            offset = min(offset, size)
+            with open(partial, "r+b" if os.path.exists(partial) else "wb") as file:
+                file.seek(offset)
+                file.truncate()
+                consumed = 0
+                while offset < size:
+                    chunk = await queue.get()
+                    if chunk is None:
+                        raise ConnectionError("Connection to server lost")
+                    if chunk["offset"] != offset:
+                        raise RuntimeError(f"Expected the chunk at offset {offset}")
+                    file.write(chunk["chunk"])
+                    offset += len(chunk["chunk"])
+                    consumed += 1
+                    if consumed >= max(1, window // 2):
+                        await self._send_transfer_ack("download_ack", "download_id", download_id, credit=consumed)
+                        consumed = 0
+            finished = True
+        finally:
+            self.downloads.pop(download_id, None)
+            if not finished and self.is_connected:
+                try:
+                    await self._send_transfer_ack("download_ack", "download_id", download_id, cancel=True)
+                except Exception:
+                    pass
+
+        digest, _ = await asyncio.get_running_loop().run_in_executor(None, hash_file, partial)
+        if digest != attachment_id:
+            os.remove(partial)
+            raise RuntimeError("Downloaded content doesn't match the attachment_id")
+        os.replace(partial, path)
+        return path
+
+    async def get_chats(self):
+        """List the user's chats with participants and last message."""
+        return await self.request("get_chats", {
+            "token": self.session_token
+        })
+
+    async def get_messages(self, chat_id, limit=50, before_id=None):
+        """Fetch the most recent messages of a chat, or with before_id the ones older than that message."""
+        return await self.request("get_messages", {
+            "token": self.session_token,
+            "chat_id": chat_id,
+            "limit": limit,
+            "before_id": before_id
+        })
+
+    async def subscribe(self, chat_ids):
+        """
+        Receive these chats' new messages in full. Once a connection has
+        subscribed, its other chats only send unread counts (unread_callback).
+
+        Returns:
+            The response, whose chats list the messages counted for each chat so far
+        """
+        return await self.request("subscribe", {
+            "token": self.session_token,
+            "chat_ids": list(chat_ids)
+        })
+
+    async def unsubscribe(self, chat_ids):
+        """Receive only unread counts for these chats from now on."""
+        return await self.request("unsubscribe", {
+            "token": self.session_token,
+            "chat_ids": list(chat_ids)
+        })
+
+    async def export_chat(self, chat_id, window=4, chunk_size=None):
+        """
+        Download a chat's whole history, newest first, as an async generator of message lists.
+
+        The server streams one chunk per credit; window chunks are granted up
+        front and each one is granted again once the loop body is done with
+        it, so a slow consumer slows the server down instead of piling up
+        chunks in memory. Leaving the loop early cancels the export.
+
+        Raises:
+            ConnectionError: If not connected or the connection drops
+            RuntimeError: If the server refuses or aborts the export
+        """
+        export_id = next(self.request_ids)
+        queue = asyncio.Queue()
+        self.exports[export_id] = queue
+        finished = False
+        try:
+            response = await self.request("export_chat", {
+                "token": self.session_token,
+                "chat_id": chat_id,
+                "export_id": export_id,
+                "window": window,
+                "chunk_size": chunk_size
+            })
+            if not response.get("success"):
+                finished = True
+                raise RuntimeError(response.get("message", "Export refused"))
+            # The server may have granted a smaller window than asked for
+            window = response.get("window", window)
+            consumed = 0
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    finished = True
+                    raise ConnectionError("Connection to server lost")
+                if chunk.get("done"):
+                    finished = True
+                    if chunk.get("error"):
+                        raise RuntimeError(chunk["error"])
+                    return
+                yield chunk["messages"]
+                consumed += 1
+                # Hand back credit in batches of half a window, one ack per few chunks
+                if consumed >= max(1, window // 2):
+                    await self._send_transfer_ack("export_chat_ack", "export_id", export_id, credit=consumed)
+                    consumed = 0
+        finally:
+            self.exports.pop(export_id, None)
+            if not finished and self.is_connected:
+                try:
+                    await self._send_transfer_ack("export_chat_ack", "export_id", export_id, cancel=True)
+                except Exception:
+                    pass
+
+    async def _send_transfer_ack(self, request_type, id_field, transfer_id, credit=0, cancel=False):
+        # Not waited on: nothing is pending under its request_id, so the answer is dropped
+        await self._send_frame({
+            "type": request_type,
+            "data": {id_field: transfer_id, "credit": credit, "cancel": cancel},
+            "request_id": next(self.request_ids)
+        })
+
+    async def get_metrics(self):
+        """Fetch the server's metrics (the user must be a configured admin)."""
+        return await self.request("get_metrics", {
+            "token": self.session_token
+        })
+
+    async def backup(self):
+        """Start an online backup of the server's database (the user must be a configured admin)."""
+        return await self.request("backup", {
+            "token": self.session_token
+        })
+
+    async def ping(self):
+        """Check the connection end to end; returns the round trip in seconds."""
+        start = asyncio.get_running_loop().time()
+        await self.request("ping", {})
+        return asyncio.get_running_loop().time() - start
+
+    async def disconnect(self):
+        """Tell the server we're leaving and close the connection."""
+        if self.is_connected:
+            try:
+                # Don't wait for the answer, the connection is going away
+                await self._send_frame({
+                    "type": "disconnect",
+                    "data": {"token": self.session_token} if self.session_token else {}
+                })
+            except Exception:
+                pass
+        self.is_connected = False
+
+        if self.receive_task:
+            self.receive_task.cancel()
+            try:
+                await self.receive_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.receive_task = None
+
+        await self._close_writer()
+        self._fail_pending_requests(ConnectionError("Disconnected from server"))
+        self.session_token = None
+
+    async def _close_writer(self):
+        if self.writer:
+            try:
+                self.writer.close()
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+            self.writer = None
+            self.reader = None
@@ -1,168 +1,144 @@
-import socket
-import json
+import asyncio
 import threading
 import time
+from collections import deque
 from datetime import datetime
-from Encryption import EncryptionManager
+from AsyncClientComm import AsyncClientComm
 
 class ClientComm:
-    def __init__(self, config_path="../config.json"):
-        self.socket = None
-        self.server_ip = None
-        self.server_port = None
-        self.encryption = EncryptionManager()
-        self.is_connected = False
+    """
+    Blocking client API used by the terminal UI.
+
+    This is a thin wrapper around AsyncClientComm: the connection lives on
+    an event loop running in a background thread, and every call here hands
+    work to that loop and waits for (or returns a Future of) the result.
+    """
+
+    def __init__(self, config_path=None):
+        self.comm = AsyncClientComm(config_path)
+        self.comm.message_callback = self._dispatch_message
+        self.comm.untagged_callback = self._queue_untagged_response
+        self.comm.unread_callback = self._dispatch_unread_counts
+        self.server_ip = self.comm.server_ip
+        self.server_port = self.comm.server_port
+        self.loop = None
+        self.loop_thread = None
         self.message_callback = None
-        self.receive_thread = None
-        self.response_queue = []
-        self.receive_buffer = ""
+        self.unread_callback = None  # Called with [{chat_id, unread}] for chats not subscribed to
+        self.response_queue = deque()  # Responses the server didn't tag with a request_id
+        self.response_ready = threading.Condition()  # Notified whenever a response arrives
+        self.last_request = None  # Future of the latest send_request, for get_next_response
         self.shutting_down = False  # Add flag for clean shutdown
-        import os
 
-        config_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "config.json"))
-        self.load_config(config_path)
-    
+    @property
+    def is_connected(self):
+        return self.comm.is_connected
+
     def load_config(self, config_path):
         """Load server IP and port from config.json."""
-        try:
-            with open(config_path, "r") as file:
-                config = json.load(file)
-                self.server_ip = config.get("server_ip_address")
-                self.server_port = config.get("server_port")
-                if not self.server_ip or not self.server_port:
-                    raise ValueError("Missing server configuration")
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            raise RuntimeError(f"Failed to load configuration: {str(e)}")
-    
+        self.comm.load_config(config_path)
+        self.server_ip = self.comm.server_ip
+        self.server_port = self.comm.server_port
+
+    def _start_loop(self):
+        """Start the background event loop that owns the connection."""
+        if self.loop_thread and self.loop_thread.is_alive():
+            return
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever)
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+
+    def _stop_loop(self):
+        if self.loop and self.loop_thread and self.loop_thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join(timeout=1.0)
+        if self.loop and not self.loop.is_running():
+            self.loop.close()
+        self.loop = None
+        self.loop_thread = None
+
+    def _run(self, coroutine):
+        """Schedule a coroutine on the connection's loop; returns a concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
     def connect(self):
         """Establish a connection with the server and perform secure handshake."""
         if self.shutting_down:
             return False
-            
+
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.server_ip, self.server_port))
-            self.is_connected = True
+            self._start_loop()
+            print("Starting security handshake...")
+            self._run(self.comm.connect()).result(timeout=30.0)
             print(f"Connected to server at {self.server_ip}:{self.server_port}")
-            
-            # Perform secure handshake
-            self._establish_secure_connection()
-            
-            # Start message receiving thread
-            self.receive_thread = threading.Thread(target=self._receive_loop)
-            self.receive_thread.daemon = True
-            self.receive_thread.start()
-            
+            print("Secure connection established")
+
+            # Wake any waiter as soon as the connection drops
+            self.comm.receive_task.add_done_callback(lambda task: self._notify_response())
             return True
         except Exception as e:
             print(f"Connection failed: {str(e)}")
-            self.is_connected = False
             return False
 
-    def _establish_secure_connection(self):
-        """Perform the secure handshake protocol with the server."""
-        try:
-            print("Starting security handshake...")
-            
-            # 1. Generate client keys
-            self.encryption.generate_keys()
-            
-            # 2. Send public key to server with framing
-            request = {
-                "type": "key_exchange",
-                "data": {
-                    "client_public_key": self.encryption.get_public_key().decode()
-                }
-            }
-            json_data = json.dumps(request)
-            frame = f"{len(json_data)}::{json_data}"
-            self.socket.sendall(frame.encode())
-            
-            # 3. Receive server's public key (using framed message handling)
-            response = self._receive_one_message()
-            if response.get("type") != "key_exchange":
-                raise ValueError("Invalid key exchange response")
-            
-            self.encryption.set_server_public_key(response["data"]["server_public_key"].encode())
-            
-            # 4. Generate and send session key with framing
-            session_key = self.encryption.generate_session_key()
-            encrypted_session_key = self.encryption.encrypt_session_key()
-            
-            request = {
-                "type": "session_key",
-                "data": {
-                    "encrypted_session_key": encrypted_session_key.hex()
-                }
-            }
-            json_data = json.dumps(request)
-            frame = f"{len(json_data)}::{json_data}"
-            self.socket.sendall(frame.encode())
-            
-            # 5. Wait for confirmation (using framed message handling)
-            response = self._receive_one_message()
-            if response.get("type") != "session_confirmed":
-                raise ValueError("Session establishment failed")
-            
-            print("Secure connection established")
-            return True
-            
-        except Exception as e:
-            print(f"Handshake error: {str(e)}")
-            raise RuntimeError(f"Failed to establish secure connection: {str(e)}")
-        
-    def _receive_one_message(self):
-        """Receive exactly one complete framed message."""
-        buffer = ""
-        while True:
-            data = self.socket.recv(4096).decode()
-            if not data:
-                raise ConnectionError("Server disconnected")
-                
-            buffer += data
-            
-            if '::' in buffer:
-                length_str, rest = buffer.split('::', 1)
-                try:
-                    length = int(length_str)
-                except ValueError:
-                    buffer = ""
-                    continue
-                    
-                if len(rest) >= length:
-                    message = rest[:length]
-                    return json.loads(message)
+    def request(self, request_type, data):
+        """
+        Send a request and return a Future for its response.
 
+        Every request carries its own request_id, which the server echoes
+        back, so several requests can be in flight at once and each Future
+        only ever receives the response to its own request. The Future
+        resolves to the response's data dict.
 
-    def send_request(self, request_type, data):
-        """Send a formatted request to the server."""
+        Returns:
+            concurrent.futures.Future, or None while shutting down
+        """
         if self.shutting_down:
-            return False
-            
+            return None
+
         if not self.is_connected:
             # Only try to reconnect if we're not shutting down
             if not self.shutting_down and not self.reconnect():
                 raise ConnectionError("Not connected to server")
-        
-        try:
-            request = {
-                "type": request_type,
-                "data": data
-            }
-            json_data = json.dumps(request)
-            frame = f"{len(json_data)}::{json_data}"
-            self.socket.sendall(frame.encode())
-            return True
-        except Exception as e:
-            if not self.shutting_down:
-                self.is_connected = False
-            raise RuntimeError(f"Failed to send request: {str(e)}")
-    
+
+        return self._run(self.comm.request(request_type, data))
+
+    def send_request(self, request_type, data):
+        """Send a formatted request to the server."""
+        future = self.request(request_type, data)
+        if future is None:
+            return False
+        # get_next_response() answers for the latest request only, so a late
+        # response to an earlier one can never be handed to the wrong caller
+        self.last_request = future
+        future.add_done_callback(lambda f: self._notify_response())
+        return True
+
+    def _dispatch_message(self, message):
+        """Forward new_message frames to the UI callback (runs on the loop thread)."""
+        if self.message_callback:
+            self.message_callback(message)
+
+    def _dispatch_unread_counts(self, chats):
+        """Forward unread_counts frames to the UI callback (runs on the loop thread)."""
+        if self.unread_callback:
+            self.unread_callback(chats)
+
+    def _queue_untagged_response(self, response):
+        """Keep responses from servers that don't echo request IDs."""
+        self.response_queue.append(response)
+        self._notify_response()
+
+    def _notify_response(self):
+        """Wake threads blocked in get_next_response."""
+        with self.response_ready:
+            self.response_ready.notify_all()
+
     def reconnect(self):
         """Attempt to reconnect to the server."""
         if self.shutting_down:
             return False
-            
+
         try:
             print("Attempting to reconnect to server...")
             self.disconnect()  # Clean up old connection
@@ -175,13 +151,13 @@ class ClientComm:
     def receive_response(self):
         """Wait for and handle the server's response."""
         try:
-            response = self.socket.recv(4096).decode()
-            parsed_response = json.loads(response)
-            return parsed_response['data']
+            response = self.get_next_response()
+            if response is None:
+                raise TimeoutError("No response from server")
+            return response
         except Exception as e:
-            self.is_connected = False
             raise RuntimeError(f"Failed to receive response: {str(e)}")
-            
+
     def send_message(self, message_data):
         """Send a message object to the server."""
         try:
@@ -189,99 +165,33 @@ class ClientComm:
             if isinstance(message_data, dict):
                 if 'timestamp' not in message_data:
                     message_data['timestamp'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
+
             self.send_request("send_message", message_data)
             return True
         except Exception as e:
             print(f"Failed to send message: {str(e)}")
             return False
-    
-    def _receive_message(self):
-        """Receive a complete message with framing."""
-        while self.is_connected:
-            try:
-                # Read data into buffer
-                data = self.socket.recv(4096).decode()
-                if not data:
-                    continue
-                
-                self.receive_buffer += data
-                
-                # Process all complete messages in buffer
-                while '::' in self.receive_buffer:
-                    # Find the message length and content
-                    length_str, rest = self.receive_buffer.split('::', 1)
-                    try:
-                        length = int(length_str)
-                    except ValueError:
-                        # Invalid length prefix, clear buffer and continue
-                        self.receive_buffer = ""
-                        break
-                    
-                    # Check if we have a complete message
-                    if len(rest) >= length:
-                        message = rest[:length]
-                        self.receive_buffer = rest[length:]  # Keep remaining data
-                        
-                        try:
-                            # Parse and handle the message
-                            response = json.loads(message)
-                            if response.get("type") == "new_message":
-                                if self.message_callback:
-                                    self.message_callback(response)
-                            else:
-                                self.response_queue.append(response)
-                        except json.JSONDecodeError as e:
-                            print(f"Error decoding message: {e}")
-                    else:
-                        # Incomplete message, wait for more data
-                        break
-                        
-            except Exception as e:
-                # print(f"Error in receive loop: {e}")
-                self.is_connected = False
-                break
-
-    def _receive_loop(self):
-        """Background thread for receiving messages."""
-        while self.is_connected and not self.shutting_down:
-            try:
-                self._receive_message()
-            except Exception as e:
-                if not self.shutting_down:
-                    # print(f"Error in receive loop: {e}")
-                    self.is_connected = False
-                break
-            
+
     def set_message_callback(self, callback):
         """Set callback function for handling received messages."""
         self.message_callback = callback
-    
+
     def disconnect(self):
         """Gracefully close the connection."""
         self.shutting_down = True  # Set shutdown flag first
-        self.is_connected = False
-        
-        if self.socket:
+
+        if self.loop and self.loop.is_running():
             try:
-                # Send disconnect request only if we were connected
-                if not self.socket._closed:
-                    try:
-                        self.send_request("disconnect", {})
-                    except:
-                        pass
-                self.socket.close()
-            except:
+                self._run(self.comm.disconnect()).result(timeout=2.0)
+            except Exception:
                 pass
-        
-        # Wait for receive thread to finish with a short timeout
-        if self.receive_thread and self.receive_thread.is_alive():
-            self.receive_thread.join(timeout=1.0)
-        
+        self._stop_loop()
+
         # Clear any remaining state
-        self.receive_buffer = ""
         self.response_queue.clear()
+        self.last_request = None
         self.message_callback = None
+        self._notify_response()
         print("Disconnected from server.")
 
     def send_register_request(self, username, password):
@@ -290,7 +200,7 @@ class ClientComm:
             "username": username,
             "password": password
         })
-    
+
     def send_login_request(self, username, password):
         """Send a login request."""
         return self.send_request("login", {
@@ -298,24 +208,61 @@ class ClientComm:
             "password": password
         })
 
+    def send_subscribe_request(self, token, chat_ids):
+        """
+        Ask for these chats' messages in full and only unread counts of the
+        others. Answered on its own Future, so it never takes the place of
+        the response get_next_response() is waiting for.
+        """
+        return self.request("subscribe", {
+            "token": token,
+            "chat_ids": list(chat_ids)
+        })
+
+    def send_unsubscribe_request(self, token, chat_ids):
+        """Go back to unread counts only for these chats."""
+        return self.request("unsubscribe", {
+            "token": token,
+            "chat_ids": list(chat_ids)
+        })
+
     def get_next_response(self):
         """Get the next response from the queue with timeout."""
         if self.shutting_down:
             return None
-            
-        start_time = time.time()
+
+        # Claim the latest request; older unclaimed ones are simply dropped
+        future, self.last_request = self.last_request, None
+
         timeout = 5.0  # 5 second timeout
-        
-        while self.is_connected and not self.response_queue and (time.time() - start_time) < timeout:
-            time.sleep(0.1)  # Wait for response
-            
+
+        # The loop thread notifies on every response and on disconnect
+        with self.response_ready:
+            self.response_ready.wait_for(
+                lambda: (not self.is_connected or self.response_queue
+                         or (future is not None and future.done())),
+                timeout
+            )
+
+        if future and future.done():
+            try:
+                return future.result()
+            except ConnectionError:
+                if not self.shutting_down:
+                    raise
+                return None
+
         if not self.response_queue:
+            if future:
+                # Cancelling drops it from the pending requests, so a late
+                # response can't linger
+                future.cancel()
             if not self.is_connected and not self.shutting_down:
                 raise ConnectionError("Not connected to server")
             return None
-            
+
         try:
-            response = self.response_queue.pop(0)
+            response = self.response_queue.popleft()
             if isinstance(response, dict):
                 return response.get('data', {})
             return {}
@@ -326,29 +273,29 @@ class ClientComm:
 if __name__ == "__main__":
     print("\nStarting client test...")
     client = ClientComm()
-    
+
     def print_message(message):
         print(f"Received: {message}")
-    
+
     try:
         # Connect and set up message handling
         if client.connect():
             client.set_message_callback(print_message)
-            
+
             # Send a test message
             test_message = "Hello, this is a secure test message!"
             print("\nSending message:", test_message)
             client.send_message(test_message)
-            
+
             # Keep running until user interrupts
             print("\nClient running. Press Ctrl+C to stop...")
             while True:
                 time.sleep(1)
-                
+
     except KeyboardInterrupt:
         print("\nStopping client...")
     except Exception as e:
         print(f"\nError occurred: {str(e)}")
     finally:
         if client.is_connected:
-            client.disconnect()
\ No newline at end of file
+            client.disconnect()
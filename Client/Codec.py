@@ -0,0 +1,390 @@
+import json
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, JSON is always available
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # cbor2 is optional, JSON is always available
+    cbor2 = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, zlib is always available
+    zstandard = None
+
+FIELD_SEPARATOR = b":"
+MAX_HEADER_LENGTH = 32  # Length prefix plus flags never get close to this
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Bytes; longest payload accepted, before or after decompression
+
+DEFAULT_ENCODING = "json"
+DEFAULT_COMPRESSION_THRESHOLD = 1024  # Bytes; smaller frames are sent as-is
+
+# Attachment data travels raw in frames of its own, flagged so they skip
+# the encoding: a header naming the transfer and offset, then the bytes
+ATTACHMENT_FLAG = b"a"
+CHUNK_HEADER = struct.Struct("!QQ")  # transfer_id, offset
+
+# Preset dictionary shared by both ends. It primes the compressor with the
+# keys and values every frame repeats, which is most of a small frame. Both
+# sides must use the exact same bytes, so changing it is a protocol change.
+CHAT_DICTIONARY = (
+    b'"target_username":"token":"limit":"chat_type":"private","group",'
+    b'"created_at":"2025-01-01 00:00:00","participants":["'
+    b'{"type":"get_chats_response","data":{"success":true,"chats":[{"chat_id":'
+    b'"last_message":{"message_id":"content":"timestamp":"username":"'
+    b'{"type":"get_messages_response","data":{"success":true,"messages":['
+    b'{"type":"new_message","data":{"message_id":"chat_id":"content":"'
+    b'{"type":"start_private_chat_response","data":{"success":true,"chat_id":'
+    b'"messages":[{"message_id":"content":"timestamp":"2025-01-01 00:00:00",'
+    b'"username":"},{"message_id":"content":"timestamp":"2025-01-01 00:00:00",'
+    b'"username":"'
+)
+
+
+def _json_encode(message):
+    # ASCII-only output keeps the byte length equal to the character length,
+    # which is what older peers expect in the frame prefix
+    return json.dumps(message, separators=(",", ":")).encode()
+
+
+def _json_decode(payload):
+    return json.loads(payload)
+
+
+def _msgpack_encode(message):
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def _msgpack_decode(payload):
+    return msgpack.unpackb(payload, raw=False)
+
+
+def _cbor_encode(message):
+    return cbor2.dumps(message)
+
+
+def _cbor_decode(payload):
+    return cbor2.loads(payload)
+
+
+# Encodings in order of preference, only those whose library is installed
+ENCODINGS = {}
+if msgpack is not None:
+    ENCODINGS["msgpack"] = (_msgpack_encode, _msgpack_decode)
+if cbor2 is not None:
+    ENCODINGS["cbor"] = (_cbor_encode, _cbor_decode)
+ENCODINGS[DEFAULT_ENCODING] = (_json_encode, _json_decode)
+
+
+def available_encodings():
+    """Return the names of all encodings usable in this process."""
+    return list(ENCODINGS.keys())
+
+
+class CompressionStats:
+    """Thread-safe totals describing how well compression is paying off."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames_compressed = 0
+        self.frames_skipped = 0  # Below threshold or no size gain
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.frames_decompressed = 0
+        self.decompress_seconds = 0.0
+
+    def record_compress(self, size_in, size_out, seconds, used):
+        with self.lock:
+            if used:
+                self.frames_compressed += 1
+                self.bytes_in += size_in
+                self.bytes_out += size_out
+            else:
+                self.frames_skipped += 1
+            self.compress_seconds += seconds
+
+    def record_skip(self):
+        with self.lock:
+            self.frames_skipped += 1
+
+    def record_decompress(self, seconds):
+        with self.lock:
+            self.frames_decompressed += 1
+            self.decompress_seconds += seconds
+
+    def snapshot(self):
+        """Return the totals plus derived ratio and CPU cost."""
+        with self.lock:
+            ratio = self.bytes_in / self.bytes_out if self.bytes_out else 0.0
+            megabytes = self.bytes_in / (1024 * 1024)
+            return {
+                "frames_compressed": self.frames_compressed,
+                "frames_skipped": self.frames_skipped,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "compression_ratio": round(ratio, 3),
+                "compress_cpu_seconds": round(self.compress_seconds, 6),
+                "compress_cpu_ms_per_mb": round(self.compress_seconds * 1000 / megabytes, 3) if megabytes else 0.0,
+                "frames_decompressed": self.frames_decompressed,
+                "decompress_cpu_seconds": round(self.decompress_seconds, 6),
+            }
+
+
+class ZlibCompressor:
+    """Per-frame deflate primed with the shared chat dictionary."""
+    flag = b"z"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, payload):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=CHAT_DICTIONARY)
+        return compressor.compress(payload) + compressor.flush()
+
+    def decompress(self, payload, max_size=MAX_FRAME_SIZE):
+        decompressor = zlib.decompressobj(-15, zdict=CHAT_DICTIONARY)
+        # Stop at max_size instead of inflating whatever the peer claims
+        result = decompressor.decompress(payload, max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed frame too large")
+        result += decompressor.flush()
+        if len(result) > max_size:
+            raise ValueError("Decompressed frame too large")
+        return result
+
+
+class ZstdCompressor:
+    """Per-frame zstd primed with the shared chat dictionary."""
+    flag = b"s"
+
+    def __init__(self, level=3):
+        dictionary = zstandard.ZstdCompressionDict(
+            CHAT_DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+        )
+        self.compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+        self.lock = threading.Lock()  # zstandard contexts are not thread-safe
+
+    def compress(self, payload):
+        with self.lock:
+            return self.compressor.compress(payload)
+
+    def decompress(self, payload, max_size=MAX_FRAME_SIZE):
+        # max_output_size only bounds frames that don't declare their size
+        if zstandard.frame_content_size(payload) > max_size:
+            raise ValueError("Decompressed frame too large")
+        with self.lock:
+            try:
+                return self.decompressor.decompress(payload, max_output_size=max_size)
+            except zstandard.ZstdError as e:
+                raise ValueError(f"Invalid compressed frame: {e}")
+
+
+# Compression methods in order of preference, only those usable here
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = ZstdCompressor
+COMPRESSORS["zlib"] = ZlibCompressor
+
+_compressor_instances = {}
+
+
+def get_compressor(name):
+    """Return the shared compressor instance for a method name."""
+    if name not in _compressor_instances:
+        _compressor_instances[name] = COMPRESSORS[name]()
+    return _compressor_instances[name]
+
+
+def available_compressions():
+    """Return the names of all compression methods usable in this process."""
+    return list(COMPRESSORS.keys())
+
+
+def negotiate_compression(offered, preferred=None):
+    """
+    Pick the compression method for a connection.
+
+    Args:
+        offered: Methods the peer supports, in any order
+        preferred: Our own methods in order of preference
+
+    Returns:
+        Name of the first preferred method the peer also offered, or None
+    """
+    if not offered:
+        return None
+    if preferred is None:
+        preferred = available_compressions()
+    for name in preferred:
+        if name in COMPRESSORS and name in offered:
+            return name
+    return None
+
+
+def negotiate_encoding(offered, preferred=None):
+    """
+    Pick the encoding to use for a connection.
+
+    Args:
+        offered: Encodings the peer supports, in any order
+        preferred: Our own encodings in order of preference
+
+    Returns:
+        Name of the first preferred encoding the peer also offered, or JSON
+    """
+    if not offered:
+        return DEFAULT_ENCODING
+    preferred = preferred or available_encodings()
+    for name in preferred:
+        if name in ENCODINGS and name in offered:
+            return name
+    return DEFAULT_ENCODING
+
+
+class MessageCodec:
+    """Serialize protocol messages to and from one wire encoding."""
+
+    def __init__(self, encoding=DEFAULT_ENCODING, compression=None,
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, stats=None, max_frame_size=MAX_FRAME_SIZE):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.encoding = encoding
+        self._encode, self._decode = ENCODINGS[encoding]
+        self.compression = compression
+        self.compressor = get_compressor(compression) if compression else None
+        self.compression_threshold = compression_threshold
+        self.stats = stats
+        self.max_frame_size = max_frame_size  # Cap on a decompressed payload
+
+    def encode(self, message):
+        """Serialize a message dict to bytes."""
+        return self._encode(message)
+
+    def decode(self, payload):
+        """Deserialize bytes back into a message dict."""
+        return self._decode(payload)
+
+    def build_frame(self, message):
+        """Serialize a message and wrap it in a length-prefixed frame."""
+        payload = self.encode(message)
+        if self.compressor is None:
+            return build_frame(payload)
+        if len(payload) < self.compression_threshold:
+            if self.stats:
+                self.stats.record_skip()
+            return build_frame(payload)
+
+        start = time.thread_time()
+        compressed = self.compressor.compress(payload)
+        elapsed = time.thread_time() - start
+
+        # Incompressible payloads go out as-is rather than growing
+        used = len(compressed) < len(payload)
+        if self.stats:
+            self.stats.record_compress(len(payload), len(compressed), elapsed, used)
+        if not used:
+            return build_frame(payload)
+        return build_frame(compressed, self.compressor.flag)
+
+    def decode_frame(self, frame):
+        """Decompress if needed and deserialize a (flags, payload) frame."""
+        flags, payload = frame
+        if flags == ATTACHMENT_FLAG:
+            transfer_id, offset = CHUNK_HEADER.unpack_from(payload)
+            return {"type": "attachment_chunk", "data": {
+                "transfer_id": transfer_id,
+                "offset": offset,
+                # A view past the header: extract_frame made the one copy, out of the receive buffer
+                "chunk": memoryview(payload)[CHUNK_HEADER.size:]
+            }}
+        if flags:
+            # Only the method this connection negotiated; a compressed frame
+            # before the handshake, or with another flag, is refused unread
+            if self.compressor is None or flags != self.compressor.flag:
+                raise ValueError(f"Unexpected frame flags: {flags!r}")
+            start = time.thread_time()
+            payload = self.compressor.decompress(payload, self.max_frame_size)
+            if self.stats:
+                self.stats.record_decompress(time.thread_time() - start)
+        return self.decode(payload)
+
+
+def build_frame(payload, flags=b""):
+    """
+    Prefix a payload with its byte length and the frame delimiter.
+
+    Plain frames look like ``<length>::<payload>``; flagged frames put the
+    flags between the separators, e.g. ``<length>:z:<payload>``.
+    """
+    return str(len(payload)).encode() + FIELD_SEPARATOR + flags + FIELD_SEPARATOR + payload
+
+
+def build_chunk_header(transfer_id, offset, length):
+    """
+    Everything of an attachment chunk frame up to its length bytes of data,
+    for senders that write the data themselves (e.g. with sendfile).
+    """
+    return (str(CHUNK_HEADER.size + length).encode() + FIELD_SEPARATOR + ATTACHMENT_FLAG + FIELD_SEPARATOR
+            + CHUNK_HEADER.pack(transfer_id, offset))
+
+
+def build_chunk_frame(transfer_id, offset, data):
+    """A complete attachment chunk frame carrying data."""
+    return build_chunk_header(transfer_id, offset, len(data)) + data
+
+
+class FrameTooLargeError(ValueError):
+    """A frame header announced a payload longer than the receiver accepts."""
+
+
+def extract_frame(buffer, max_length=MAX_FRAME_SIZE):
+    """
+    Pop one complete frame off the front of a receive buffer.
+
+    Args:
+        buffer: bytearray holding received data, modified in place
+        max_length: Longest payload accepted; checked before any of it is buffered
+
+    Returns:
+        (flags, payload) bytes tuple, or None if no complete frame is buffered yet
+
+    Raises:
+        ValueError: If the buffer does not start with a valid frame header
+        FrameTooLargeError: If the header announces more than max_length bytes
+    """
+    length_end = buffer.find(FIELD_SEPARATOR, 0, MAX_HEADER_LENGTH)
+    flags_end = buffer.find(FIELD_SEPARATOR, length_end + 1, MAX_HEADER_LENGTH) if length_end != -1 else -1
+    if flags_end == -1:
+        if len(buffer) >= MAX_HEADER_LENGTH:
+            raise ValueError("Invalid frame header")
+        return None
+
+    try:
+        length = int(buffer[:length_end])
+    except ValueError:
+        raise ValueError("Invalid frame length prefix")
+    if length < 0:
+        raise ValueError("Invalid frame length prefix")
+    if length > max_length:
+        raise FrameTooLargeError(f"Frame of {length} bytes exceeds the {max_length} byte limit")
+
+    start = flags_end + 1
+    end = start + length
+    if len(buffer) < end:
+        return None
+
+    flags = bytes(buffer[length_end + 1:flags_end])
+    payload = bytes(buffer[start:end])
+    del buffer[:end]
+    return flags, payload
@@ -251,6 +251,9 @@ class ChatClient:
                self.session_token = response.get('token')
                self.username = username  # Store username after successful login
                self.add_to_history(f"Successfully logged in as: {username}")
+               # Full messages only for the open chat, unread counts for the rest
+               self.client.unread_callback = self.handle_unread_counts
+               self.client.send_subscribe_request(self.session_token, [])
             else:
                self.add_to_history(f"Login failed: {response.get('message', 'Unknown error')}")
          else:
@@ -359,6 +362,7 @@ class ChatClient:
          return
          
       self.current_chat = chat_id
+      self.client.send_subscribe_request(self.session_token, [chat_id])
       print(f"Joined chat {chat_id}. Type /exit to leave, /help for commands.")
       
       # Get chat history
@@ -427,6 +431,11 @@ class ChatClient:
    def cleanup_chat(self):
       """Clean up chat-related state."""
       # print("DEBUG: Cleaning up chat state")
+      if self.current_chat is not None and self.session_token:
+         try:
+            self.client.send_unsubscribe_request(self.session_token, [self.current_chat])
+         except ConnectionError:
+            pass
       self.current_chat = None
       self.chat_target = None
       self.current_messages = []
@@ -435,9 +444,7 @@ class ChatClient:
       # Clear any pending messages in the client's queue
       if hasattr(self.client, 'response_queue'):
          self.client.response_queue.clear()
-      if hasattr(self.client, 'receive_buffer'):
-         self.client.receive_buffer = ""
-      
+
       # print("DEBUG: Chat cleanup complete")
 
 
@@ -490,6 +497,12 @@ class ChatClient:
          traceback.print_exc()
 
 
+   def handle_unread_counts(self, chats):
+      """Note new messages in the chats that aren't open."""
+      for chat in chats:
+         if chat.get('chat_id') != self.current_chat:
+            self.add_to_history(f"{chat.get('unread')} unread message(s) in chat {chat.get('chat_id')}")
+
    def handle_logout(self):
       """Handle user logout and reset client state."""
       if self.session_token:
@@ -511,6 +524,21 @@ class ChatClient:
       if hasattr(self, 'client'):
          self.client.disconnect()
 
+   def search_usernames(self, query, limit=5):
+      """Ask the server for usernames starting with query; returns [] if that fails."""
+      try:
+         self.client.send_request("search_users", {
+            "token": self.session_token,
+            "query": query,
+            "limit": limit
+         })
+         response = self.client.get_next_response()
+      except ConnectionError:
+         return []
+      if not response or not response.get('success'):
+         return []
+      return response.get('usernames', [])
+
    def handle_private_chat(self):
       """Handle starting a private chat with another user."""
       try:
@@ -534,6 +562,10 @@ class ChatClient:
                
          if not response.get('success'):
             self.add_to_history(response.get('message', 'Failed to start chat'))
+            if response.get('message') == "User not found" and target_username:
+               suggestions = self.search_usernames(target_username[:3])
+               if suggestions:
+                  self.add_to_history(f"Did you mean: {', '.join(suggestions)}?")
             return
                
          # Store chat info
@@ -557,6 +589,7 @@ class ChatClient:
          
          # Set up message callback and display chat
          self.client.set_message_callback(self.handle_incoming_message)
+         self.client.send_subscribe_request(self.session_token, [self.current_chat])
          self.display_chat_messages()
          
          # Enter chat loop
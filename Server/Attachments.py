@@ -0,0 +1,395 @@
+"""
+Attachment files and their transfers over client connections.
+
+Files are stored once per content, under the SHA-256 of their bytes,
+which is also the attachment ID messages refer to. Both directions are
+chunked so attachment data shares the connection with chat traffic a
+chunk at a time rather than holding it up:
+
+- Uploads: upload_start names the file by its SHA-256 and size, and the
+  client sends attachment chunk frames, written straight to a partial
+  file. upload_finish checks the content and moves it into place. A
+  partial file outlives the connection, so starting the same upload again
+  resumes it from the bytes already received. Partial files count against
+  a per-user byte budget, and ones left untouched for too long are deleted.
+- Downloads: download_start streams chunk frames from an offset (so a
+  download resumes too) with the file's bytes sent by the kernel
+  (sendfile), under the same credit flow control as chat exports.
+"""
+import hashlib
+import itertools
+import mmap
+import os
+import re
+import threading
+import time
+from ChatExport import ExportStream
+from ServerLog import get_logger
+
+logger = get_logger("attachments")
+
+ATTACHMENT_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_attachment_id(value):
+    return isinstance(value, str) and ATTACHMENT_ID.match(value) is not None
+
+
+class AttachmentStore:
+    """Content-addressed attachment files: objects/<first two hex digits>/<sha256>, uploads in progress in uploads/."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        self.uploads_dir = os.path.join(directory, "uploads")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.uploads_dir, exist_ok=True)
+
+    def object_path(self, attachment_id):
+        return os.path.join(self.objects_dir, attachment_id[:2], attachment_id)
+
+    def partial_path(self, user_id, attachment_id):
+        # Per user, so two users uploading the same file don't write into one another's
+        return os.path.join(self.uploads_dir, f"{user_id}-{attachment_id}.part")
+
+    def has(self, attachment_id):
+        return os.path.exists(self.object_path(attachment_id))
+
+    def partials(self, user_id=None):
+        """(user_id, attachment_id, os.stat_result) of the partial uploads on disk, or of one user's."""
+        prefix = f"{user_id}-" if user_id is not None else ""
+        with os.scandir(self.uploads_dir) as entries:
+            for entry in entries:
+                if not (entry.name.startswith(prefix) and entry.name.endswith(".part")):
+                    continue
+                owner, _, attachment_id = entry.name[:-len(".part")].partition("-")
+                try:
+                    yield int(owner), attachment_id, entry.stat()
+                except (ValueError, OSError):
+                    continue  # Not one of ours, or removed since the listing
+
+    def open_partial(self, user_id, attachment_id):
+        """Open (or create) a user's partial upload; returns (file descriptor, bytes already received)."""
+        fd = os.open(self.partial_path(user_id, attachment_id), os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0),
+                     0o600)
+        return fd, os.fstat(fd).st_size
+
+    def complete(self, user_id, attachment_id, fd):
+        """
+        Check a finished upload against its ID and move it into the store.
+
+        Returns:
+            Whether the content matched; a mismatched partial file is deleted
+        """
+        os.fsync(fd)
+        digest = hashlib.sha256()
+        if os.fstat(fd).st_size:
+            # Hashed through a memory map: no read() calls or buffers however big the file
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        partial = self.partial_path(user_id, attachment_id)
+        if digest.hexdigest() != attachment_id:
+            os.remove(partial)
+            return False
+        target = self.object_path(attachment_id)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(partial, target)
+        return True
+
+
+class Upload:
+    """An upload in progress on one connection."""
+
+    def __init__(self, user_id, attachment_id, size, fd, received):
+        self.user_id = user_id
+        self.attachment_id = attachment_id
+        self.size = size
+        self.fd = fd
+        self.received = received
+        self.error = None  # Set by a bad chunk; the rest are dropped until the client restarts
+
+
+class AttachmentTransfers:
+    """Uploads and downloads of attachments, for every connection."""
+
+    def __init__(self, server, store, max_size=100 * 1024 * 1024, chunk_size=65536, window=8, max_window=64,
+                 max_per_connection=4, stall_timeout=60.0, max_partial_bytes=200 * 1024 * 1024,
+                 partial_ttl=24 * 3600):
+        """
+        Args:
+            server: ServerConnection the chunks go through
+            store: AttachmentStore holding the files
+            max_size: Largest attachment accepted, in bytes
+            chunk_size: Bytes per chunk, both ways
+            window: Initial download credit when the client doesn't give one
+            max_window: Most credit a download may hold
+            max_per_connection: Uploads plus downloads one connection may run at once
+            stall_timeout: Seconds a download waits for credit before giving up
+            max_partial_bytes: Most bytes of unfinished uploads one user may
+                have on disk, counting each running upload at its full size
+            partial_ttl: Seconds an unfinished upload is kept after its last chunk
+        """
+        self.server = server
+        self.store = store
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.window = window
+        self.max_window = max_window
+        self.max_per_connection = max_per_connection
+        self.stall_timeout = stall_timeout
+        self.max_partial_bytes = max_partial_bytes
+        self.partial_ttl = partial_ttl
+        self.lock = threading.Lock()
+        self.uploads = {}  # {(client_id, upload_id): Upload}
+        self.downloads = {}  # {(client_id, download_id): ExportStream}
+        self.partials = set()  # (user_id, attachment_id) of the uploads in progress anywhere
+        self.upload_ids = itertools.count(1)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.uploads_completed = 0
+        self.downloads_completed = 0
+        self.partials_expired = 0
+
+    @classmethod
+    def from_config(cls, server, config, db_path):
+        """Build from the "attachments" section of config.json; files default to an attachments/ directory by db_path."""
+        settings = config.get("attachments") or {}
+        directory = settings.get("directory") or os.path.join(os.path.dirname(os.path.abspath(db_path)), "attachments")
+        return cls(
+            server,
+            AttachmentStore(directory),
+            max_size=settings.get("max_size", 100 * 1024 * 1024),
+            chunk_size=settings.get("chunk_size", 65536),
+            window=settings.get("window", 8),
+            max_window=settings.get("max_window", 64),
+            max_per_connection=settings.get("max_per_connection", 4),
+            stall_timeout=settings.get("stall_timeout", 60.0),
+            max_partial_bytes=settings.get("max_partial_bytes", 200 * 1024 * 1024),
+            partial_ttl=settings.get("partial_ttl", 24 * 3600)
+        )
+
+    def _running(self, client_socket):
+        # Callers hold self.lock
+        client_id = id(client_socket)
+        return (sum(1 for key in self.uploads if key[0] == client_id)
+                + sum(1 for key in self.downloads if key[0] == client_id))
+
+    def _partial_bytes(self, user_id, attachment_id):
+        """Bytes the user's other unfinished uploads hold or, while running here, will hold."""
+        # Callers hold self.lock
+        running = {upload.attachment_id: upload.size for upload in self.uploads.values() if upload.user_id == user_id}
+        return sum(max(stat.st_size, running.get(other, 0))
+                   for _, other, stat in self.store.partials(user_id) if other != attachment_id)
+
+    # Uploads
+
+    def start_upload(self, client_socket, user_id, attachment_id, size, readable=False):
+        """
+        Start or resume uploading an attachment.
+
+        Args:
+            readable: Whether the user may read the attachment already; only
+                then is a file the store has skipped, since knowing a hash
+                doesn't prove having the content
+
+        Returns:
+            (success, result): {upload_id, offset, chunk_size} to send from,
+            {complete: True} if the upload can be skipped, or why not
+        """
+        if not is_attachment_id(attachment_id):
+            return False, "attachment_id must be the file's SHA-256 in lowercase hex"
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            return False, "Invalid size"
+        if size > self.max_size:
+            return False, f"Attachments are limited to {self.max_size} bytes"
+        if readable and self.store.has(attachment_id):
+            return True, {"complete": True}
+        with self.lock:
+            if (user_id, attachment_id) in self.partials:
+                return False, "This upload is already running"
+            if self._running(client_socket) >= self.max_per_connection:
+                return False, "Too many transfers running on this connection"
+            try:
+                if self._partial_bytes(user_id, attachment_id) + size > self.max_partial_bytes:
+                    return False, "Too many unfinished uploads; finish or restart them first"
+                fd, received = self.store.open_partial(user_id, attachment_id)
+            except OSError as e:
+                logger.error(f"Can't open upload of {attachment_id}: {e}")
+                return False, "Failed to start the upload"
+            if received > size:
+                # Left over from an upload of a different size; start over
+                os.ftruncate(fd, 0)
+                received = 0
+            upload_id = next(self.upload_ids)
+            self.uploads[(id(client_socket), upload_id)] = Upload(user_id, attachment_id, size, fd, received)
+            self.partials.add((user_id, attachment_id))
+        return True, {"upload_id": upload_id, "offset": received, "chunk_size": self.chunk_size}
+
+    def receive_chunk(self, client_socket, data):
+        """Write an uploaded chunk (decoded attachment chunk frame data) to its partial file."""
+        with self.lock:
+            upload = self.uploads.get((id(client_socket), data["transfer_id"]))
+        if upload is None or upload.error:
+            return
+        chunk = data["chunk"]
+        if data["offset"] != upload.received:
+            upload.error = f"Expected the chunk at offset {upload.received}"
+        elif len(chunk) > self.chunk_size or upload.received + len(chunk) > upload.size:
+            upload.error = "Chunk too large"
+        else:
+            try:
+                self._write(upload, chunk)
+            except OSError as e:
+                logger.error(f"Failed to write upload of {upload.attachment_id}: {e}")
+                upload.error = "Failed to store the chunk"
+                return
+            upload.received += len(chunk)
+            self.bytes_received += len(chunk)
+
+    def _write(self, upload, chunk):
+        if hasattr(os, "pwrite"):
+            os.pwrite(upload.fd, chunk, upload.received)
+        else:  # Windows
+            os.lseek(upload.fd, upload.received, os.SEEK_SET)
+            os.write(upload.fd, chunk)
+
+    def finish_upload(self, client_socket, upload_id):
+        """
+        End an upload, storing the file if all of it arrived intact.
+
+        Returns:
+            (success, result): {attachment_id, size}, or {message, offset}
+            with the offset a restarted upload would continue from
+        """
+        with self.lock:
+            upload = self.uploads.pop((id(client_socket), upload_id), None)
+            if upload is not None:
+                self.partials.discard((upload.user_id, upload.attachment_id))
+        if upload is None:
+            return False, {"message": "No such upload", "offset": 0}
+        try:
+            if upload.error or upload.received < upload.size:
+                message = upload.error or f"Only {upload.received} of {upload.size} bytes arrived"
+                return False, {"message": message, "offset": upload.received}
+            if not self.store.complete(upload.user_id, upload.attachment_id, upload.fd):
+                return False, {"message": "Content doesn't match the attachment_id", "offset": 0}
+        except OSError as e:
+            logger.error(f"Failed to store upload of {upload.attachment_id}: {e}")
+            return False, {"message": "Failed to store the attachment", "offset": upload.received}
+        finally:
+            os.close(upload.fd)
+        self.uploads_completed += 1
+        return True, {"attachment_id": upload.attachment_id, "size": upload.size}
+
+    def expire_partials(self):
+        """Delete unfinished uploads that got no chunk for partial_ttl seconds; returns how many."""
+        cutoff = time.time() - self.partial_ttl
+        expired = 0
+        for user_id, attachment_id, stat in self.store.partials():
+            if stat.st_mtime >= cutoff:
+                continue
+            with self.lock:
+                # Under the lock, so the upload can't be resumed while its file goes
+                if (user_id, attachment_id) in self.partials:
+                    continue
+                try:
+                    os.remove(self.store.partial_path(user_id, attachment_id))
+                except OSError as e:
+                    logger.warning(f"Can't remove stale upload of {attachment_id}: {e}")
+                    continue
+                self.partials_expired += 1
+            expired += 1
+        if expired:
+            logger.info(f"Removed {expired} stale partial uploads")
+        return expired
+
+    # Downloads
+
+    def start_download(self, client_socket, attachment_id, download_id, offset=0, window=None):
+        """
+        Start streaming an attachment from offset on a new thread.
+
+        Returns:
+            (success, result): {size, chunk_size, window}, or why not
+        """
+        if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+            return False, "Invalid offset"
+        if not isinstance(window, int) or isinstance(window, bool):
+            window = self.window
+        window = max(1, min(window, self.max_window))
+        try:
+            file = open(self.store.object_path(attachment_id), "rb")
+        except OSError:
+            return False, "Attachment not found"
+        size = os.fstat(file.fileno()).st_size
+        key = (id(client_socket), download_id)
+        with self.lock:
+            if key in self.downloads:
+                file.close()
+                return False, f"Download {download_id} is already running"
+            if self._running(client_socket) >= self.max_per_connection:
+                file.close()
+                return False, "Too many transfers running on this connection"
+            stream = self.downloads[key] = ExportStream(client_socket, download_id, None, window)
+        threading.Thread(target=self._send_file, args=(key, stream, file, min(offset, size), size),
+                         name=f"download-{download_id}", daemon=True).start()
+        return True, {"size": size, "chunk_size": self.chunk_size, "window": window}
+
+    def acknowledge(self, client_socket, download_id, credit=0, cancel=False):
+        """Grant a download more credit, or cancel it; returns whether it was running."""
+        with self.lock:
+            stream = self.downloads.get((id(client_socket), download_id))
+        if stream is None:
+            return False
+        if cancel:
+            stream.cancel()
+        elif isinstance(credit, int) and not isinstance(credit, bool) and credit > 0:
+            stream.grant(credit, self.max_window)
+        return True
+
+    def _send_file(self, key, stream, file, offset, size):
+        completed = False
+        try:
+            while offset < size:
+                if not stream.take_credit(self.stall_timeout):
+                    break
+                length = min(self.chunk_size, size - offset)
+                self.server.send_file_frame(stream.client_socket, stream.export_id, file, offset, length)
+                offset += length
+                self.bytes_sent += length
+            else:
+                completed = True
+        except Exception as e:
+            # The connection went away mid-stream, there's no one left to tell
+            logger.debug(f"Download {stream.export_id} ended: {e}")
+        finally:
+            file.close()
+            with self.lock:
+                del self.downloads[key]
+                if completed:
+                    self.downloads_completed += 1
+
+    def close_connection(self, client_socket):
+        """Drop a closed connection's transfers; its partial uploads stay on disk to be resumed."""
+        client_id = id(client_socket)
+        with self.lock:
+            uploads = [self.uploads.pop(key) for key in list(self.uploads) if key[0] == client_id]
+            for upload in uploads:
+                self.partials.discard((upload.user_id, upload.attachment_id))
+            downloads = [stream for key, stream in self.downloads.items() if key[0] == client_id]
+        for upload in uploads:
+            os.close(upload.fd)
+        for stream in downloads:
+            stream.cancel()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uploads": len(self.uploads),
+                "downloads": len(self.downloads),
+                "uploads_completed": self.uploads_completed,
+                "downloads_completed": self.downloads_completed,
+                "partials_expired": self.partials_expired,
+                "bytes_received": self.bytes_received,
+                "bytes_sent": self.bytes_sent
+            }
@@ -0,0 +1,226 @@
+"""
+Streaming exports of a chat's whole history.
+
+An export_chat request starts a stream that reads the chat a page at a
+time and sends each page as an export_chat_chunk frame, newest first.
+Streams run on threads of their own so the connection keeps answering
+requests meanwhile, the client's acknowledgements among them.
+
+Flow control is by credit: the client names each stream with an
+export_id, grants an initial window of chunks with the request and more
+with export_chat_ack as it works through them. A stream out of credit
+waits holding a single page, so memory on both ends stays at window
+chunks however many messages the chat has.
+"""
+import threading
+import time
+from Storage import StorageError
+from ServerLog import get_logger
+
+logger = get_logger("export")
+
+CHUNK_FRAME = "export_chat_chunk"
+
+
+class ExportStream:
+    """One export in progress on one connection."""
+
+    def __init__(self, client_socket, export_id, pages, credit):
+        """
+        Args:
+            client_socket: Connection the chunks go to
+            export_id: The client's name for the stream, echoed on every chunk
+            pages: Generator of message lists, one per chunk
+            credit: Chunks that may be sent before the client acknowledges any
+        """
+        self.client_socket = client_socket
+        self.export_id = export_id
+        self.pages = pages
+        self.credit = credit
+        self.cancelled = False
+        self.condition = threading.Condition()
+        self.chunks = 0
+        self.messages = 0
+
+    def grant(self, credit, max_credit):
+        """Allow credit more chunks, holding at most max_credit unspent."""
+        with self.condition:
+            self.credit = min(self.credit + credit, max_credit)
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify()
+
+    def take_credit(self, timeout):
+        """
+        Spend one credit, waiting up to timeout seconds for the client to grant one.
+
+        Returns:
+            True to send the next chunk, False if cancelled or no credit came
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.credit <= 0 and not self.cancelled:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            if self.cancelled:
+                return False
+            self.credit -= 1
+            return True
+
+
+class ChatExporter:
+    """Runs the export streams of every connection."""
+
+    def __init__(self, server, chunk_size=500, max_chunk_size=1000, window=4, max_window=32,
+                 max_per_connection=2, stall_timeout=60.0):
+        """
+        Args:
+            server: ServerConnection the chunks are sent through
+            chunk_size: Messages per chunk when the client doesn't ask for a size
+            max_chunk_size: Largest chunk a client may ask for
+            window: Initial credit when the client doesn't give one
+            max_window: Most credit a stream may hold
+            max_per_connection: Streams one connection may run at once
+            stall_timeout: Seconds a stream waits for credit before giving up
+        """
+        self.server = server
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.window = window
+        self.max_window = max_window
+        self.max_per_connection = max_per_connection
+        self.stall_timeout = stall_timeout
+        self.lock = threading.Lock()
+        self.streams = {}  # {(client_id, export_id): ExportStream}
+        self.started = 0
+        self.completed = 0
+        self.stopped = 0  # Cancelled, stalled, failed or disconnected
+        self.messages_sent = 0
+
+    @classmethod
+    def from_config(cls, server, settings):
+        """Build from the "export" section of config.json."""
+        settings = settings or {}
+        return cls(
+            server,
+            chunk_size=settings.get("chunk_size", 500),
+            max_chunk_size=settings.get("max_chunk_size", 1000),
+            window=settings.get("window", 4),
+            max_window=settings.get("max_window", 32),
+            max_per_connection=settings.get("max_per_connection", 2),
+            stall_timeout=settings.get("stall_timeout", 60.0)
+        )
+
+    def clamp_chunk_size(self, chunk_size):
+        """The chunk size to use for a client's requested one (None for the default)."""
+        if not isinstance(chunk_size, int) or isinstance(chunk_size, bool):
+            return self.chunk_size
+        return max(1, min(chunk_size, self.max_chunk_size))
+
+    def start(self, client_socket, export_id, pages, window=None):
+        """
+        Start streaming pages to a connection on a new thread.
+
+        Args:
+            client_socket: Connection to stream to
+            export_id: The client's name for the stream
+            pages: Generator of message lists, one per chunk
+            window: Initial credit (defaults to the configured window)
+
+        Returns:
+            (success, result): the initial credit, or why no stream was started
+        """
+        if not isinstance(window, int) or isinstance(window, bool):
+            window = self.window
+        window = max(1, min(window, self.max_window))
+        key = (id(client_socket), export_id)
+        with self.lock:
+            if key in self.streams:
+                return False, f"Export {export_id} is already running"
+            running = sum(1 for stream in self.streams.values() if stream.client_socket is client_socket)
+            if running >= self.max_per_connection:
+                return False, "Too many exports running on this connection"
+            stream = self.streams[key] = ExportStream(client_socket, export_id, pages, window)
+            self.started += 1
+        threading.Thread(target=self._run, args=(key, stream), name=f"export-{export_id}", daemon=True).start()
+        return True, window
+
+    def acknowledge(self, client_socket, export_id, credit=0, cancel=False):
+        """Grant a stream more credit, or cancel it; returns whether the stream was running."""
+        with self.lock:
+            stream = self.streams.get((id(client_socket), export_id))
+        if stream is None:
+            return False
+        if cancel:
+            stream.cancel()
+        elif isinstance(credit, int) and not isinstance(credit, bool) and credit > 0:
+            stream.grant(credit, self.max_window)
+        return True
+
+    def close_connection(self, client_socket):
+        """Cancel a closed connection's streams, so they don't wait out stall_timeout."""
+        with self.lock:
+            streams = [stream for stream in self.streams.values() if stream.client_socket is client_socket]
+        for stream in streams:
+            stream.cancel()
+
+    def _run(self, key, stream):
+        finished = False
+        disconnected = False
+        error = None
+        try:
+            for messages in stream.pages:
+                if not stream.take_credit(self.stall_timeout):
+                    if not stream.cancelled:
+                        error = "Export stopped: no acknowledgement from the client"
+                    break
+                self.server.send_to_client(stream.client_socket, {
+                    "type": CHUNK_FRAME,
+                    "data": {"export_id": stream.export_id, "seq": stream.chunks, "messages": messages}
+                })
+                stream.chunks += 1
+                stream.messages += len(messages)
+            else:
+                finished = True
+        except StorageError as e:
+            logger.error(f"Export {stream.export_id} failed: {e}")
+            error = "Failed to read the chat history"
+        except Exception as e:
+            # The connection went away mid-stream, there's no one left to tell
+            logger.debug(f"Export {stream.export_id} ended: {e}")
+            disconnected = True
+        finally:
+            stream.pages.close()
+            with self.lock:
+                del self.streams[key]
+                self.messages_sent += stream.messages
+                if finished:
+                    self.completed += 1
+                else:
+                    self.stopped += 1
+
+        # The last chunk carries no messages, only how the stream ended
+        if not disconnected and not stream.cancelled:
+            final = {"export_id": stream.export_id, "seq": stream.chunks, "messages": [], "done": True,
+                     "count": stream.messages}
+            if error:
+                final["error"] = error
+            try:
+                self.server.send_to_client(stream.client_socket, {"type": CHUNK_FRAME, "data": final})
+            except Exception:
+                pass
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "running": len(self.streams),
+                "started": self.started,
+                "completed": self.completed,
+                "stopped": self.stopped,
+                "messages_sent": self.messages_sent
+            }
@@ -0,0 +1,206 @@
+import json
+import sqlite3
+import threading
+import weakref
+import zlib
+from ServerLog import get_logger
+
+logger = get_logger("archive")
+
+
+class MessageArchive:
+    """
+    Messages past their retention, compressed in a separate SQLite file.
+
+    Each batch of a chat's archived messages is stored as one zlib
+    compressed block, which is where the space goes back to. A
+    contentless FTS5 index (when SQLite has FTS5) keeps the archive
+    searchable by words without storing the text a second time; without
+    FTS5, search decompresses the chat's blocks and looks through them.
+    """
+
+    def __init__(self, path, connect):
+        """
+        Args:
+            path: Archive database file; created with its tables if missing
+            connect: Called as connect(path) to open a connection to it
+        """
+        self.path = path
+        self.connect = connect
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()  # Closed together in close()
+        self.full_text = self._create_tables(self.conn)
+
+    @property
+    def conn(self):
+        """The calling thread's connection to the archive, created on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.connect(self.path)
+            self._connections.add(conn)
+        return conn
+
+    def _create_tables(self, conn):
+        """Create the archive tables; returns whether the full-text index is available."""
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive_blocks (
+                block_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_archive_blocks_chat ON archive_blocks (chat_id, last_id)')
+        # Which block holds each message, so archiving twice is harmless and search hits can be resolved
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archived_messages (
+                message_id INTEGER PRIMARY KEY,
+                block_id INTEGER NOT NULL
+            )
+        ''')
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS archive_search USING fts5(message_content, content='')")
+            full_text = True
+        except sqlite3.OperationalError:
+            logger.warning("SQLite has no FTS5, archive search will scan the archived blocks")
+            full_text = False
+        conn.commit()
+        return full_text
+
+    def add(self, rows):
+        """
+        Archive messages, one compressed block per chat.
+
+        Args:
+            rows: (message_id, chat_id, sender_id, message_content, timestamp) tuples;
+                messages already in the archive are skipped
+        Returns:
+            Number of messages archived
+        Raises:
+            sqlite3.IntegrityError: If a different message is archived under one of the ids
+        """
+        conn = self.conn
+        ids = [row[0] for row in rows]
+        present = set()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            present.update(message_id for message_id, in conn.execute(
+                f'SELECT message_id FROM archived_messages WHERE message_id IN ({",".join("?" * len(chunk))})',
+                chunk
+            ))
+        if present:
+            self._check_archived(rows, present)
+        by_chat = {}
+        for message_id, chat_id, sender_id, message_content, timestamp in rows:
+            if message_id not in present:
+                by_chat.setdefault(chat_id, []).append((message_id, sender_id, message_content, str(timestamp)))
+        try:
+            for chat_id, messages in by_chat.items():
+                messages.sort()
+                data = zlib.compress(json.dumps(messages, ensure_ascii=False).encode("utf-8"), 6)
+                cursor = conn.execute('''
+                    INSERT INTO archive_blocks (chat_id, first_id, last_id, message_count, data)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (chat_id, messages[0][0], messages[-1][0], len(messages), data))
+                block_id = cursor.lastrowid
+                conn.executemany('INSERT INTO archived_messages (message_id, block_id) VALUES (?, ?)',
+                                 [(message[0], block_id) for message in messages])
+                if self.full_text:
+                    conn.executemany('INSERT INTO archive_search (rowid, message_content) VALUES (?, ?)',
+                                     [(message[0], message[2]) for message in messages])
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        return sum(len(messages) for messages in by_chat.values())
+
+    def _check_archived(self, rows, present):
+        """
+        Make sure the messages of rows found in the archive are the ones archived.
+
+        Archiving a message again (its delete failed last time) is harmless,
+        but another message under an archived id would be lost if skipped.
+        """
+        conn = self.conn
+        ids = list(present)
+        block_ids = set()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            block_ids.update(block_id for block_id, in conn.execute(
+                f'SELECT DISTINCT block_id FROM archived_messages WHERE message_id IN ({",".join("?" * len(chunk))})',
+                chunk
+            ))
+        archived = {}
+        for block_id, chat_id, data in conn.execute(
+            f'SELECT block_id, chat_id, data FROM archive_blocks WHERE block_id IN ({",".join("?" * len(block_ids))})',
+            list(block_ids)
+        ):
+            for message_id, sender_id, message_content, timestamp in json.loads(zlib.decompress(data)):
+                archived[message_id] = (chat_id, sender_id, message_content, timestamp)
+        for message_id, chat_id, sender_id, message_content, timestamp in rows:
+            if message_id in present and archived.get(message_id) != (chat_id, sender_id, message_content,
+                                                                       str(timestamp)):
+                raise sqlite3.IntegrityError(f"Message {message_id} is already archived as a different message")
+
+    def last_id(self):
+        """The highest message id ever archived, 0 if none."""
+        return self.conn.execute('SELECT COALESCE(MAX(message_id), 0) FROM archived_messages').fetchone()[0]
+
+    def _blocks(self, block_ids):
+        """{block_id: [(message_id, sender_id, message_content, timestamp)]} of the given blocks."""
+        blocks = {}
+        for block_id, data in self.conn.execute(
+            f'SELECT block_id, data FROM archive_blocks WHERE block_id IN ({",".join("?" * len(block_ids))})',
+            list(block_ids)
+        ):
+            blocks[block_id] = [tuple(message) for message in json.loads(zlib.decompress(data))]
+        return blocks
+
+    def search(self, chat_id, query, limit=20):
+        """
+        A chat's archived messages matching query, newest first.
+
+        Returns:
+            (message_id, sender_id, message_content, timestamp) tuples
+        """
+        if self.full_text:
+            # Every word of the query, each quoted so FTS5 syntax in it is taken literally
+            match = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+            if not match:
+                return []
+            hits = self.conn.execute('''
+                SELECT archive_search.rowid, archived_messages.block_id
+                FROM archive_search
+                JOIN archived_messages ON archived_messages.message_id = archive_search.rowid
+                JOIN archive_blocks ON archive_blocks.block_id = archived_messages.block_id
+                WHERE archive_search MATCH ? AND archive_blocks.chat_id = ?
+                ORDER BY archive_search.rowid DESC
+                LIMIT ?
+            ''', (match, chat_id, limit)).fetchall()
+            if not hits:
+                return []
+            blocks = self._blocks({block_id for _, block_id in hits})
+            wanted = {message_id for message_id, _ in hits}
+            found = [message for block_id in blocks for message in blocks[block_id] if message[0] in wanted]
+            return sorted(found, reverse=True)
+
+        needle = query.lower()
+        found = []
+        for block_id, data in self.conn.execute(
+            'SELECT block_id, data FROM archive_blocks WHERE chat_id = ? ORDER BY last_id DESC', (chat_id,)
+        ):
+            messages = [tuple(message) for message in json.loads(zlib.decompress(data))]
+            found.extend(message for message in reversed(messages) if needle in message[2].lower())
+            if len(found) >= limit:
+                break
+        return sorted(found, reverse=True)[:limit]
+
+    def close(self):
+        """Close every thread's archive connection."""
+        for conn in list(self._connections):
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
@@ -0,0 +1,239 @@
+import os
+import queue
+import socket
+import threading
+from Codec import MessageCodec
+from MessageBus import PresenceTable, receive_frames
+from ServerLog import get_logger
+
+logger = get_logger("broker")
+
+
+class NodeConnection:
+    """One node's connection to the broker, with its own writer thread."""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.node_id = None  # Known once the node says hello
+        self.outbox = queue.SimpleQueue()  # Frames to send, None to stop the writer
+        self.writer = None
+
+    def send(self, frame):
+        self.outbox.put(frame)
+
+    def close(self):
+        self.outbox.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class MessageBroker:
+    """
+    Routes messages between the ChatServer nodes of a cluster.
+
+    Nodes connect over TCP, or over a Unix socket when they share a
+    machine (the supervisor's workers do). The broker keeps the list of
+    connected nodes and which users are connected to each, and routes a
+    chat delivery only to the nodes its recipients are on. Routing happens
+    under one lock and each node's frames are written in order by its own
+    writer thread, so every node sees a chat's messages in the same order
+    without a slow node holding up the others.
+    """
+
+    def __init__(self, address):
+        """
+        Args:
+            address: (host, port) to listen on, or the path of a Unix socket
+        """
+        self.address = address
+        self.codec = MessageCodec()
+        self.lock = threading.Lock()
+        self.nodes = {}  # {node_id: NodeConnection}
+        self.presence = PresenceTable()
+        self.server_socket = None
+        self.accept_thread = None
+        self.running = False
+        self.routed = 0  # Frames queued for nodes
+
+    def start(self):
+        if isinstance(self.address, tuple):
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(self.address)
+        self.server_socket.listen(socket.SOMAXCONN)
+        self.running = True
+        self.accept_thread = threading.Thread(target=self._accept_connections, name="broker", daemon=True)
+        self.accept_thread.start()
+        logger.info(f"Message broker listening on {self.address}")
+
+    def stop(self):
+        self.running = False
+        if self.server_socket:
+            try:
+                # Wakes the accept thread; close() alone leaves it blocked on Linux
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
+        if self.accept_thread:
+            self.accept_thread.join(timeout=2.0)
+        with self.lock:
+            connections = list(self.nodes.values())
+        for connection in connections:
+            connection.close()
+        if not isinstance(self.address, tuple):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+        logger.info("Message broker stopped")
+
+    def _accept_connections(self):
+        while self.running:
+            try:
+                sock, address = self.server_socket.accept()
+            except OSError:
+                if self.running:
+                    logger.exception("Error accepting node connection")
+                continue
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = NodeConnection(sock, address or "unix socket")
+            connection.writer = threading.Thread(target=self._write, args=(connection,), daemon=True)
+            connection.writer.start()
+            threading.Thread(target=self._read, args=(connection,), daemon=True).start()
+
+    def _write(self, connection):
+        while True:
+            frame = connection.outbox.get()
+            if frame is None:
+                return
+            try:
+                connection.sock.sendall(frame)
+            except OSError:
+                connection.close()  # The reader notices and removes the node
+                return
+
+    def _read(self, connection):
+        try:
+            for message in receive_frames(connection.sock, self.codec):
+                self._handle(connection, message)
+        except (OSError, ValueError) as e:
+            if self.running:
+                logger.warning(f"Node {connection.node_id} connection failed: {e}")
+        finally:
+            self._remove(connection)
+            connection.close()
+            connection.sock.close()
+
+    def _handle(self, connection, message):
+        op = message.get("op")
+        with self.lock:
+            if op == "hello":
+                self._join(connection, message["node_id"], message.get("users", []))
+            elif connection.node_id is None:
+                return  # Everything else needs a hello first
+            elif op == "deliver":
+                frame = self.codec.build_frame({"op": "deliver", "user_ids": message["user_ids"],
+                                                "message": message["message"]})
+                for node_id in self.presence.nodes_for(message["user_ids"]):
+                    target = self.nodes.get(node_id)
+                    if target is None:
+                        continue
+                    if target is connection and message.get("exclude") is not None:
+                        # Only the sender's node knows the connection to skip
+                        target.send(self.codec.build_frame({
+                            "op": "deliver", "user_ids": message["user_ids"],
+                            "message": message["message"], "exclude": message["exclude"]
+                        }))
+                    else:
+                        target.send(frame)
+                    self.routed += 1
+            elif op == "presence":
+                self.presence.set(connection.node_id, message["user_id"], message["online"])
+                self._broadcast({"op": "presence", "node_id": connection.node_id,
+                                 "user_id": message["user_id"], "online": message["online"]},
+                                skip=connection)
+            elif op == "publish":
+                self._broadcast({"op": "event", "topic": message["topic"], "data": message["data"]},
+                                skip=connection)
+
+    def _join(self, connection, node_id, users):
+        # Callers hold the lock
+        previous = self.nodes.get(node_id)
+        if previous is not None and previous is not connection:
+            previous.close()  # A restarted node reconnecting before its old connection timed out
+            self.presence.drop_node(node_id)
+        connection.node_id = node_id
+        self.nodes[node_id] = connection
+        for user_id in users:
+            self.presence.set(node_id, user_id, True)
+        connection.send(self.codec.build_frame({
+            "op": "welcome", "nodes": sorted(self.nodes), "presence": self.presence.entries()
+        }))
+        self._broadcast({"op": "members", "nodes": sorted(self.nodes)}, skip=connection)
+        for user_id in users:
+            self._broadcast({"op": "presence", "node_id": node_id, "user_id": user_id, "online": True},
+                            skip=connection)
+        logger.info(f"Node {node_id} joined from {connection.address}; {len(self.nodes)} nodes")
+
+    def _remove(self, connection):
+        with self.lock:
+            if connection.node_id is None or self.nodes.get(connection.node_id) is not connection:
+                return
+            del self.nodes[connection.node_id]
+            self.presence.drop_node(connection.node_id)
+            self._broadcast({"op": "members", "nodes": sorted(self.nodes)})
+        logger.info(f"Node {connection.node_id} left; {len(self.nodes)} nodes")
+
+    def _broadcast(self, message, skip=None):
+        # Callers hold the lock
+        frame = self.codec.build_frame(message)
+        for connection in self.nodes.values():
+            if connection is not skip:
+                connection.send(frame)
+                self.routed += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "nodes": sorted(self.nodes),
+                "online_users": len(self.presence),
+                "routed": self.routed
+            }
+
+
+# Run a standalone broker for a cluster of servers
+if __name__ == "__main__":
+    import argparse
+    import json
+    import time
+    from MessageBus import parse_address
+    from ServerLog import setup_logging, shutdown_logging
+
+    parser = argparse.ArgumentParser(description="Run the InteChat message broker")
+    parser.add_argument("--config", help="path to config.json (defaults to the repository's)")
+    parser.add_argument("--address", help="host:port or Unix socket path (defaults to cluster.broker_address)")
+    args = parser.parse_args()
+
+    config_path = args.config or os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.json")
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    setup_logging({**config.get("logging", {}), "filename": "broker.log"})
+    broker = MessageBroker(parse_address(args.address or config.get("cluster", {}).get("broker_address")))
+    broker.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+        shutdown_logging()
@@ -0,0 +1,437 @@
+import os
+import socket
+import threading
+from Codec import MessageCodec, extract_frame
+from ServerLog import get_logger
+
+logger = get_logger("bus")
+
+CHAT_LOCK_STRIPES = 64  # Chats share this many locks to keep their deliveries in order
+
+
+def default_node_id():
+    """A node id unique across the cluster: host name and process id."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def parse_address(address):
+    """Turn "host:port" into a (host, port) tuple; anything else is a Unix socket path."""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def connect_socket(address, timeout=None):
+    """Open a stream connection to a (host, port) tuple or a Unix socket path."""
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address, timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    sock.settimeout(None)
+    return sock
+
+
+def receive_frames(sock, codec):
+    """Yield decoded messages from a stream socket until the peer closes it."""
+    buffer = bytearray()
+    while True:
+        frame = extract_frame(buffer)
+        if frame is not None:
+            yield codec.decode_frame(frame)
+            continue
+        data = sock.recv(65536)
+        if not data:
+            return
+        buffer += data
+
+
+def create_bus(settings=None, node_id=None):
+    """
+    Build the bus configured in the "cluster" section of config.json.
+
+    {"bus": "local"} (the default) keeps everything in this process;
+    {"bus": "broker", "broker_address": "host:port"} joins the nodes
+    connected to a MessageBroker.
+    """
+    settings = settings or {}
+    node_id = node_id or settings.get("node_id")
+    if settings.get("bus", "local") == "broker":
+        return BrokerBus(parse_address(settings["broker_address"]), node_id,
+                         reconnect_delay=settings.get("reconnect_delay", 1.0))
+    return InProcessBus(node_id=node_id)
+
+
+class PresenceTable:
+    """Which nodes each user is connected to: {user_id: {node_id}}."""
+
+    def __init__(self):
+        self.nodes_by_user = {}
+
+    def set(self, node_id, user_id, online):
+        nodes = self.nodes_by_user.get(user_id)
+        if online:
+            if nodes is None:
+                nodes = self.nodes_by_user[user_id] = set()
+            nodes.add(node_id)
+        elif nodes is not None:
+            nodes.discard(node_id)
+            if not nodes:
+                del self.nodes_by_user[user_id]
+
+    def drop_node(self, node_id):
+        """Forget every user of a node that left."""
+        for user_id in [user_id for user_id, nodes in self.nodes_by_user.items() if node_id in nodes]:
+            self.set(node_id, user_id, False)
+
+    def nodes_for(self, user_ids):
+        """Every node at least one of the users is connected to."""
+        found = set()
+        for user_id in user_ids:
+            found.update(self.nodes_by_user.get(user_id, ()))
+        return found
+
+    def entries(self):
+        """[(user_id, [node_id])] pairs, for sending the table to a node that joins."""
+        return [(user_id, sorted(nodes)) for user_id, nodes in self.nodes_by_user.items()]
+
+    def __len__(self):
+        return len(self.nodes_by_user)
+
+
+class MessageBus:
+    """
+    How a ChatServer reaches users connected to other server nodes.
+
+    A node is one ChatServer process. Every implementation provides:
+
+    - membership: nodes() lists the nodes currently connected to the bus
+    - presence: each node reports with set_presence() which users are
+      connected to it, and deliver() only goes to nodes where at least one
+      recipient is connected
+    - ordering: deliveries for one chat reach every node, and so every
+      recipient, in the same order
+
+    Nodes hand their own connections a delivery through the callback set
+    with on_deliver(); that includes the node a message was sent from. The
+    callback runs while one chat's deliveries are held in order, so it
+    must only queue the message (ServerConnection.send_to_clients), never
+    wait for a recipient to take it.
+    """
+
+    def __init__(self, node_id=None):
+        self.node_id = node_id or default_node_id()
+        self.subscribers = {}  # {topic: [callback(data)]}
+        self.deliver_callback = None
+        self.published = 0  # Events sent to other nodes
+        self.deliveries = 0  # deliver() calls made on this node
+        self.delivered_here = 0  # Deliveries handed to this node's connections
+
+    def subscribe(self, topic, callback):
+        """Call callback(data) for every event other nodes publish on topic."""
+        self.subscribers.setdefault(topic, []).append(callback)
+
+    def on_deliver(self, callback):
+        """Set callback(user_ids, message, exclude) that sends a delivery to this node's connections."""
+        self.deliver_callback = callback
+
+    def _dispatch(self, topic, data):
+        for callback in self.subscribers.get(topic, []):
+            try:
+                callback(data)
+            except Exception as e:
+                logger.exception(f"Bus subscriber for {topic} failed: {e}")
+
+    def _deliver_here(self, user_ids, message, exclude=None):
+        self.delivered_here += 1
+        if self.deliver_callback:
+            try:
+                self.deliver_callback(user_ids, message, exclude)
+            except Exception as e:
+                logger.exception(f"Delivery failed: {e}")
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def publish(self, topic, data):
+        """Send an event to every other node."""
+        raise NotImplementedError
+
+    def deliver(self, chat_id, user_ids, message, exclude=None):
+        """
+        Send a chat message to the given users on whichever nodes they are connected to.
+
+        Args:
+            chat_id: Chat the message belongs to; deliveries are ordered per chat
+            user_ids: Recipients
+            message: Message to send them
+            exclude: Client id of a connection on this node to leave out (the sender's)
+        """
+        raise NotImplementedError
+
+    def set_presence(self, user_id, online):
+        """Report that a user's first connection to this node opened, or its last one closed."""
+        raise NotImplementedError
+
+    def nodes(self):
+        """Ids of the nodes connected to the bus, this one included."""
+        raise NotImplementedError
+
+    def nodes_for_user(self, user_id):
+        """Ids of the nodes the user is connected to."""
+        raise NotImplementedError
+
+    def snapshot(self):
+        return {
+            "node_id": self.node_id,
+            "nodes": len(self.nodes()),
+            "published": self.published,
+            "deliveries": self.deliveries,
+            "delivered_here": self.delivered_here
+        }
+
+
+class InProcessHub:
+    """Shared state of the InProcessBus nodes living in one process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buses = {}  # {node_id: InProcessBus}
+        self.presence = PresenceTable()
+        self.chat_locks = [threading.Lock() for _ in range(CHAT_LOCK_STRIPES)]
+
+
+class InProcessBus(MessageBus):
+    """
+    Bus between nodes in the same process: a single server, or tests.
+
+    Deliveries call the target nodes' callbacks directly, under the chat's
+    lock, so one chat's messages are queued for their recipients one after
+    another while other chats proceed in parallel. The lock only covers the
+    queueing; the sends happen on the server's outbound writer.
+    """
+
+    def __init__(self, hub=None, node_id=None):
+        super().__init__(node_id)
+        self.hub = hub or InProcessHub()
+
+    def start(self):
+        with self.hub.lock:
+            self.hub.buses[self.node_id] = self
+
+    def stop(self):
+        with self.hub.lock:
+            if self.hub.buses.get(self.node_id) is self:
+                del self.hub.buses[self.node_id]
+                self.hub.presence.drop_node(self.node_id)
+
+    def publish(self, topic, data):
+        with self.hub.lock:
+            others = [bus for node_id, bus in self.hub.buses.items() if node_id != self.node_id]
+        for bus in others:
+            bus._dispatch(topic, data)
+        self.published += len(others)
+
+    def deliver(self, chat_id, user_ids, message, exclude=None):
+        self.deliveries += 1
+        with self.hub.chat_locks[hash(chat_id) % CHAT_LOCK_STRIPES]:
+            with self.hub.lock:
+                targets = [self.hub.buses[node_id] for node_id in self.hub.presence.nodes_for(user_ids)
+                           if node_id in self.hub.buses]
+            for bus in targets:
+                bus._deliver_here(user_ids, message, exclude if bus is self else None)
+
+    def set_presence(self, user_id, online):
+        with self.hub.lock:
+            self.hub.presence.set(self.node_id, user_id, online)
+
+    def nodes(self):
+        with self.hub.lock:
+            return sorted(self.hub.buses)
+
+    def nodes_for_user(self, user_id):
+        with self.hub.lock:
+            return self.hub.presence.nodes_for([user_id])
+
+
+class BrokerBus(MessageBus):
+    """
+    Bus between nodes connected to a MessageBroker over TCP or a Unix socket.
+
+    Deliveries go through the broker, which routes them to the nodes where
+    recipients are connected. The broker handles them one at a time and
+    every node reads its connection in order, so all nodes see one chat's
+    messages in the same order. The reader thread only queues each delivery
+    for its recipients, so a slow client can't hold it up. Membership and presence are mirrored from
+    the broker, so nodes() and nodes_for_user() don't need a round trip.
+
+    While the broker is unreachable, or no other node is connected, the
+    node delivers to its own connections directly and keeps trying to
+    reconnect; on reconnecting it reports its users again.
+    """
+
+    def __init__(self, address, node_id=None, reconnect_delay=1.0):
+        """
+        Args:
+            address: Broker's (host, port), or the path of its Unix socket
+            node_id: This node's id (see default_node_id())
+            reconnect_delay: Seconds between attempts to reach the broker
+        """
+        super().__init__(node_id)
+        self.address = address
+        self.reconnect_delay = reconnect_delay
+        self.codec = MessageCodec()
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.members = [self.node_id]  # Mirrored from the broker
+        self.presence = PresenceTable()  # Mirrored from the broker
+        self.local_users = set()  # Users connected here, reported again after a reconnect
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.connects = 0
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def start(self):
+        # Try once right away so a node started next to its broker is part
+        # of the cluster before it accepts clients
+        self._connect()
+        self.thread = threading.Thread(target=self._run, name="bus", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self._disconnect()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2.0)
+        self.thread = None
+
+    def _connect(self):
+        try:
+            sock = connect_socket(self.address, timeout=5.0)
+        except OSError as e:
+            if self.connects == 0:
+                logger.warning(f"Message broker at {self.address} unreachable, retrying: {e}")
+            return False
+        with self.send_lock:
+            self.sock = sock
+            with self.state_lock:
+                users = list(self.local_users)
+            sock.sendall(self.codec.build_frame({"op": "hello", "node_id": self.node_id, "users": users}))
+        self.connects += 1
+        logger.info(f"Connected to message broker at {self.address}")
+        return True
+
+    def _disconnect(self):
+        with self.send_lock:
+            sock, self.sock = self.sock, None
+        if sock:
+            try:
+                # Wakes the reader thread; close() alone leaves it blocked on Linux
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        with self.state_lock:
+            self.members = [self.node_id]
+            self.presence = PresenceTable()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            sock = self.sock
+            if sock is None:
+                if not self._connect():
+                    self.stop_event.wait(self.reconnect_delay)
+                continue
+            try:
+                for message in receive_frames(sock, self.codec):
+                    self._handle(message)
+            except (OSError, ValueError) as e:
+                if not self.stop_event.is_set():
+                    logger.warning(f"Message broker connection failed: {e}")
+            if not self.stop_event.is_set():
+                logger.warning("Lost connection to message broker, reconnecting")
+                self._disconnect()
+
+    def _handle(self, message):
+        op = message.get("op")
+        if op == "deliver":
+            self._deliver_here(message["user_ids"], message["message"], message.get("exclude"))
+        elif op == "event":
+            self._dispatch(message["topic"], message["data"])
+        elif op == "presence":
+            with self.state_lock:
+                self.presence.set(message["node_id"], message["user_id"], message["online"])
+        elif op == "members":
+            with self.state_lock:
+                self.members = message["nodes"]
+                for node_id in {node for nodes in self.presence.nodes_by_user.values() for node in nodes}:
+                    if node_id not in self.members:
+                        self.presence.drop_node(node_id)
+        elif op == "welcome":
+            with self.state_lock:
+                self.members = message["nodes"]
+                self.presence = PresenceTable()
+                for user_id, nodes in message["presence"]:
+                    for node_id in nodes:
+                        self.presence.set(node_id, user_id, True)
+
+    def _send(self, message):
+        """Send to the broker; returns False if there is no connection to send on."""
+        with self.send_lock:
+            if self.sock is None:
+                return False
+            try:
+                self.sock.sendall(self.codec.build_frame(message))
+                return True
+            except OSError as e:
+                logger.warning(f"Send to message broker failed: {e}")
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)  # The reader thread reconnects
+                except OSError:
+                    pass
+                return False
+
+    def publish(self, topic, data):
+        if self._send({"op": "publish", "topic": topic, "data": data}):
+            self.published += 1
+
+    def deliver(self, chat_id, user_ids, message, exclude=None):
+        self.deliveries += 1
+        with self.state_lock:
+            alone = len(self.members) <= 1
+        if alone or not self._send({"op": "deliver", "chat_id": chat_id, "user_ids": user_ids,
+                                    "message": message, "exclude": exclude}):
+            self._deliver_here(user_ids, message, exclude)
+
+    def set_presence(self, user_id, online):
+        with self.state_lock:
+            if online:
+                self.local_users.add(user_id)
+            else:
+                self.local_users.discard(user_id)
+            self.presence.set(self.node_id, user_id, online)
+        self._send({"op": "presence", "user_id": user_id, "online": online})
+
+    def nodes(self):
+        with self.state_lock:
+            return list(self.members)
+
+    def nodes_for_user(self, user_id):
+        with self.state_lock:
+            return self.presence.nodes_for([user_id])
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["connected"] = self.connected
+        snapshot["connects"] = self.connects
+        return snapshot
@@ -1,8 +1,10 @@
 from Encryption import EncryptionManager
 from UserManager import UserManager
-import sqlite3
 from datetime import datetime
 import json
+from ServerLog import get_logger
+
+logger = get_logger("messages")
 
 class MessageHandler:
     def __init__(self, user_manager):
@@ -86,7 +88,7 @@ class MessageHandler:
         except Exception as e:
             return False, f"Error saving message: {str(e)}"
 
-    def fetch_chat_history(self, chat_id, user_id, limit=50):
+    def fetch_chat_history(self, chat_id, user_id, limit=50, before_id=None):
         """
         Retrieve chat history for a specific chat.
         
@@ -94,6 +96,7 @@ class MessageHandler:
             chat_id: ID of the chat
             user_id: ID of user requesting history
             limit: Maximum number of messages to retrieve
+            before_id: Only retrieve messages older than this one, to page back through the history
             
         Returns:
             (success, result): Tuple with bool success and list of messages or error message
@@ -105,7 +108,7 @@ class MessageHandler:
 
             # Get messages using UserManager with a reasonable limit
             limit = min(50, limit)  # Cap at 50 messages
-            success, messages = self.user_manager.get_chat_messages(chat_id, user_id, limit)
+            success, messages = self.user_manager.get_chat_messages(chat_id, user_id, limit, before_id)
             
             if not success:
                 return False, "Failed to fetch messages"
@@ -113,18 +116,38 @@ class MessageHandler:
             # Format messages for client
             formatted_messages = []
             for msg in messages:
-                formatted_messages.append({
+                formatted = {
                     'message_id': msg['message_id'],
-                    'username': msg.get('username', 'Unknown'),  # Add default value
+                    'username': msg.get('username') or 'Unknown',  # Senders that no longer exist
                     'content': msg['message_content'],
                     'timestamp': msg['timestamp']
-                })
+                }
+                if 'attachment' in msg:
+                    formatted['attachment'] = msg['attachment']
+                formatted_messages.append(formatted)
 
             return True, formatted_messages[-50:]  # Return only the last 50 messages
 
         except Exception as e:
             return False, f"Error fetching chat history: {str(e)}"
 
+    def stream_chat_history(self, chat_id, user_id, page_size=500):
+        """
+        Open a cursor over a chat's whole history, for exporting it.
+
+        Args:
+            chat_id: ID of the chat
+            user_id: ID of user requesting the export
+            page_size: Messages per page the cursor yields
+
+        Returns:
+            (success, result): Tuple with bool success and a generator of
+            message pages (newest first) or error message
+        """
+        if not self._verify_chat_membership(chat_id, user_id):
+            return False, "User is not a member of this chat"
+        return True, self.user_manager.iter_chat_history(chat_id, page_size)
+
     def get_user_chats(self, user_id):
         """
         Get all chats for a user including last message information.
@@ -159,78 +182,32 @@ class MessageHandler:
             return formatted_chats
 
         except Exception as e:
-            print(f"Error getting user chats: {e}")
+            logger.error(f"Error getting user chats: {e}")
             return []
 
     def _verify_chat_membership(self, chat_id, user_id):
         """Verify a user is a member of a chat."""
-        try:
-            cursor = self.user_manager.conn.cursor()
-            cursor.execute('''
-                SELECT 1 FROM chat_members 
-                WHERE chat_id = ? AND user_id = ?
-            ''', (chat_id, user_id))
-            return cursor.fetchone() is not None
-        except sqlite3.Error:
-            return False
+        return self.user_manager.is_chat_member(chat_id, user_id)
 
     def _get_chat_participants(self, chat_id):
         """Get list of participant IDs for a chat."""
-        try:
-            cursor = self.user_manager.conn.cursor()
-            cursor.execute('''
-                SELECT user_id FROM chat_members 
-                WHERE chat_id = ?
-            ''', (chat_id,))
-            return [row['user_id'] for row in cursor.fetchall()]
-        except sqlite3.Error:
-            return []
+        return self.user_manager.get_chat_members(chat_id)
         
     def _get_chat_participants_with_names(self, chat_id):
         """Get list of participant usernames for a chat."""
-        try:
-            cursor = self.user_manager.conn.cursor()
-            cursor.execute('''
-                SELECT users.username
-                FROM chat_members 
-                JOIN users ON chat_members.user_id = users.user_id
-                WHERE chat_members.chat_id = ?
-            ''', (chat_id,))
-            return [row['username'] for row in cursor.fetchall()]
-        except sqlite3.Error as e:
-            print(f"Error getting participant names: {e}")
-            return []
+        return self.user_manager.get_chat_member_names(chat_id)
 
     def _get_last_message(self, chat_id):
         """Get the last message from a chat."""
-        try:
-            cursor = self.user_manager.conn.cursor()
-            cursor.execute('''
-                SELECT 
-                    messages.message_id,
-                    messages.message_content as content,
-                    messages.timestamp,
-                    users.username
-                FROM messages
-                JOIN users ON messages.sender_id = users.user_id
-                WHERE messages.chat_id = ?
-                ORDER BY messages.message_id DESC
-                LIMIT 1
-            ''', (chat_id,))
-            
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'message_id': row['message_id'],
-                    'content': row['content'],
-                    'timestamp': row['timestamp'],
-                    'username': row['username']
-                }
-            return None
-            
-        except sqlite3.Error as e:
-            print(f"Error getting last message: {e}")
-            return None
+        row = self.user_manager.get_last_message(chat_id)
+        if row:
+            return {
+                'message_id': row['message_id'],
+                'content': row['message_content'],
+                'timestamp': row['timestamp'],
+                'username': row['sender_username']
+            }
+        return None
 
     def _handle_pending_message(self, chat_id, message_id, sender_id, content):
         """Store message for offline participants."""
@@ -0,0 +1,556 @@
+import bisect
+import heapq
+import mmap
+import os
+import struct
+import threading
+import zlib
+from ServerLog import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = get_logger("messagelog")
+
+# Every record is: length and CRC-32 of everything after them, the fixed
+# fields, then the UTF-8 content. prev_* point at the chat's previous
+# message: its id, and where it was written (segment serial and offset)
+PREFIX = struct.Struct("<II")  # length, crc
+FIELDS = struct.Struct("<qqqqqI19s")  # message_id, chat_id, sender_id, prev_id, prev_serial, prev_offset, timestamp
+RECORD = struct.Struct("<IIqqqqqI19s")  # Both of the above, unpacked in one go
+HEADER_SIZE = RECORD.size
+
+DEFAULT_SEGMENT_BYTES = 64 * 2**20
+DEFAULT_INDEX_INTERVAL = 4096  # Bytes of log between sparse index entries
+
+
+class Segment:
+    """
+    One file of a partition's log, named <first message id>.<serial>.log.
+
+    The file is allocated at its full size up front and mapped once, so
+    reads go through the mapping while appends are plain pwrite()s; the
+    unwritten tail reads as zeros, which is where the log ends. A
+    compacted copy of a segment gets a new serial, which is how stale
+    pointers into the old copy are recognized.
+    """
+
+    def __init__(self, path, base_id, serial, size):
+        self.path = path
+        self.base_id = base_id
+        self.serial = serial
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.end = 0  # Bytes of records written
+        self.index_ids = []  # Sparse index: message ids ...
+        self.index_offsets = []  # ... and where their records start
+        self.mm = None
+        self._map()
+
+    def _map(self):
+        self._unmap()
+        size = os.fstat(self.fd).st_size
+        if size:
+            self.mm = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+
+    def _unmap(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = None
+
+    @property
+    def capacity(self):
+        return len(self.mm) if self.mm is not None else 0
+
+    def grow(self, size):
+        os.ftruncate(self.fd, size)
+        self._map()
+
+    def seal(self):
+        """Give back the unused preallocated space once the segment is full."""
+        os.ftruncate(self.fd, self.end)
+        self._map()
+
+    def scan(self, index_interval, verify):
+        """
+        Walk the records from the start, rebuilding the sparse index.
+
+        Yields (offset, message_id, chat_id) for each record. Stops at the
+        first zeroed or, when verify is set, damaged record, which becomes
+        the segment's end.
+        """
+        self.end = 0
+        self.index_ids, self.index_offsets = [], []
+        offset, capacity, last_indexed = 0, self.capacity, -index_interval
+        while offset + HEADER_SIZE <= capacity:
+            length, crc = PREFIX.unpack_from(self.mm, offset)
+            stop = offset + PREFIX.size + length
+            if length < FIELDS.size or stop > capacity:
+                break
+            if verify and zlib.crc32(self.mm[offset + PREFIX.size:stop]) != crc:
+                logger.warning(f"Damaged record at {self.path}:{offset}, truncating the log there")
+                break
+            message_id, chat_id = struct.unpack_from("<qq", self.mm, offset + PREFIX.size)
+            if offset - last_indexed >= index_interval:
+                self.index_ids.append(message_id)
+                self.index_offsets.append(offset)
+                last_indexed = offset
+            yield offset, message_id, chat_id
+            offset = stop
+        self.end = offset
+
+    def read(self, offset):
+        """The record at offset as (message_id, chat_id, sender_id, prev, content, timestamp, next_offset)."""
+        length, _, message_id, chat_id, sender_id, prev_id, prev_serial, prev_offset, timestamp = \
+            RECORD.unpack_from(self.mm, offset)
+        stop = offset + PREFIX.size + length
+        content = self.mm[offset + HEADER_SIZE:stop].decode("utf-8")
+        prev = (prev_id, prev_serial, prev_offset) if prev_id else None
+        return message_id, chat_id, sender_id, prev, content, timestamp.rstrip(b"\0").decode("ascii"), stop
+
+    def seek(self, message_id):
+        """Offset of the first record with message_id or a later one (end when there is none)."""
+        position = bisect.bisect_right(self.index_ids, message_id) - 1
+        offset = self.index_offsets[position] if position >= 0 else 0
+        while offset < self.end:
+            length, _ = PREFIX.unpack_from(self.mm, offset)
+            found, = struct.unpack_from("<q", self.mm, offset + PREFIX.size)
+            if found >= message_id:
+                return offset
+            offset += PREFIX.size + length
+        return offset
+
+    def locate(self, message_id):
+        """Offset of the record with message_id, or None."""
+        offset = self.seek(message_id)
+        if offset < self.end and struct.unpack_from("<q", self.mm, offset + PREFIX.size)[0] == message_id:
+            return offset
+        return None
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        self._unmap()
+        os.close(self.fd)
+
+
+def encode_record(message_id, chat_id, sender_id, prev, timestamp, content):
+    prev_id, prev_serial, prev_offset = prev or (0, 0, 0)
+    body = FIELDS.pack(message_id, chat_id, sender_id, prev_id, prev_serial, prev_offset,
+                       timestamp.encode("ascii")) + content.encode("utf-8")
+    return PREFIX.pack(len(body), zlib.crc32(body)) + body
+
+
+class Partition:
+    """
+    The log of the chats whose id modulo the partition count is index.
+
+    Message ids grow along the log, so a message is found by bisecting the
+    segments and their sparse index, then scanning a few records forward.
+    Each record points back at its chat's previous record, and the newest
+    record of each chat is kept in heads, so a chat's history is read
+    newest first by following those pointers, without a per-message index.
+    """
+
+    def __init__(self, directory, index, count, id_floor, segment_bytes, index_interval):
+        self.directory = directory
+        self.index = index
+        self.count = count
+        self.id_floor = id_floor
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.lock = threading.Lock()
+        self.segments = []  # Oldest first
+        self.by_serial = {}  # {serial: Segment}
+        self.heads = {}  # {chat_id: (message_id, serial, offset)} of each chat's newest record
+        self.last_id = 0
+        self.next_serial = 1
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def _recover(self):
+        found = {}  # {base_id: (serial, name)}, keeping the newest copy of each segment
+        for name in os.listdir(self.directory):
+            parts = name.split(".")
+            if len(parts) != 3 or parts[2] != "log" or not (parts[0].isdigit() and parts[1].isdigit()):
+                continue
+            base_id, serial = int(parts[0]), int(parts[1])
+            previous = found.get(base_id)
+            if previous and previous[0] > serial:
+                os.unlink(os.path.join(self.directory, name))  # Left behind by an interrupted compaction
+                continue
+            if previous:
+                os.unlink(os.path.join(self.directory, previous[1]))
+            found[base_id] = (serial, name)
+        for position, base_id in enumerate(sorted(found)):
+            serial, name = found[base_id]
+            segment = Segment(os.path.join(self.directory, name), base_id, serial, 0)
+            active = position == len(found) - 1
+            for offset, message_id, chat_id in segment.scan(self.index_interval, verify=active):
+                self.heads[chat_id] = (message_id, serial, offset)
+                self.last_id = message_id
+            self._add_segment(segment)
+            self.next_serial = max(self.next_serial, serial + 1)
+        if self.segments:
+            active = self.segments[-1]
+            # An empty active segment still names the id it starts at, which
+            # is all that's left of the last id once compaction has dropped
+            # every sealed segment
+            self.last_id = max(self.last_id, active.base_id - 1)
+            # Zero anything after the last good record, a torn write must not
+            # look like a record once newer ones are appended before it
+            os.ftruncate(active.fd, active.end)
+            active.grow(max(self.segment_bytes, active.end))
+        else:
+            self._roll(self.last_id + 1)
+
+    def _add_segment(self, segment):
+        self.segments.append(segment)
+        self.by_serial[segment.serial] = segment
+
+    def _roll(self, base_id):
+        if self.segments:
+            self.segments[-1].seal()
+        name = f"{base_id:020d}.{self.next_serial}.log"
+        segment = Segment(os.path.join(self.directory, name), base_id, self.next_serial, self.segment_bytes)
+        self.next_serial += 1
+        self._add_segment(segment)
+        return segment
+
+    def _next_id(self):
+        # This partition only hands out ids congruent to its index
+        return (max(self.last_id, self.id_floor) // self.count + 1) * self.count + self.index
+
+    def append(self, chat_id, sender_id, content, timestamp, message_id=None):
+        with self.lock:
+            if message_id is None:
+                message_id = self._next_id()
+            elif message_id <= self.last_id:
+                raise ValueError(f"Message {message_id} is not newer than {self.last_id}")
+            record = encode_record(message_id, chat_id, sender_id, self.heads.get(chat_id), timestamp, content)
+            segment = self.segments[-1]
+            if segment.end and segment.end + len(record) > self.segment_bytes:
+                segment = self._roll(message_id)
+            if segment.end + len(record) > segment.capacity:
+                segment.grow(segment.end + len(record))  # A record bigger than a whole segment
+            offset = segment.end
+            os.pwrite(segment.fd, record, offset)
+            if not segment.index_offsets or offset - segment.index_offsets[-1] >= self.index_interval:
+                segment.index_ids.append(message_id)
+                segment.index_offsets.append(offset)
+            segment.end += len(record)
+            self.heads[chat_id] = (message_id, segment.serial, offset)
+            self.last_id = message_id
+            return message_id
+
+    def _segment_for(self, message_id):
+        position = bisect.bisect_right([segment.base_id for segment in self.segments], message_id) - 1
+        return self.segments[position] if position >= 0 else None
+
+    def _find(self, message_id):
+        """(segment, offset) of a message, or None."""
+        segment = self._segment_for(message_id)
+        offset = segment.locate(message_id) if segment else None
+        return (segment, offset) if offset is not None else None
+
+    def recent(self, chat_id, limit, before_id=None):
+        """A chat's newest messages (older than before_id) first, as (message_id, sender_id, content, timestamp)."""
+        rows = []
+        with self.lock:
+            pointer = self.heads.get(chat_id)
+            if before_id is not None and pointer is not None and pointer[0] >= before_id:
+                found = self._find(before_id)
+                if found is not None:
+                    _, found_chat_id, _, prev, _, _, _ = found[0].read(found[1])
+                    if found_chat_id == chat_id:
+                        pointer = prev  # Start right behind the given message
+            if pointer is None:
+                return rows
+            message_id, serial, offset = pointer
+            by_serial, unpack_from = self.by_serial, RECORD.unpack_from
+            # Segment.read() inlined: this loop is every history read
+            while len(rows) < limit:
+                segment = by_serial.get(serial)
+                if segment is None or offset >= segment.end:
+                    # The segment was compacted since the pointer was written
+                    location = self._find(message_id)
+                    if location is None:
+                        break  # Compacted away, and everything older with it
+                    segment, offset = location
+                length, _, message_id, _, sender_id, prev_id, serial, prev_offset, timestamp = \
+                    unpack_from(segment.mm, offset)
+                if before_id is None or message_id < before_id:
+                    # Sliced straight out of the page cache: no read() calls or
+                    # file buffers (decoding a memoryview of the map is slower)
+                    content = segment.mm[offset + HEADER_SIZE:offset + PREFIX.size + length].decode("utf-8")
+                    rows.append((message_id, sender_id, content, timestamp.rstrip(b"\0").decode("ascii")))
+                if not prev_id:
+                    break
+                message_id, offset = prev_id, prev_offset
+        return rows
+
+    def compact_steps(self, drop, archive=None, older_than=None):
+        """
+        Rewrite the sealed segments without the records drop() rejects, one
+        segment per step, yielding (records dropped, bytes freed) after each.
+
+        The partition is locked for one segment at a time, so appends and
+        reads wait for at most one segment's rewrite.
+
+        Args:
+            drop: drop(message_id, chat_id, timestamp) -> True to drop a
+                record. It must only ever reject the oldest messages of a
+                chat (a prefix of its history), since a reader stops at the
+                first message it can't find.
+            archive: Called with the dropped records as (message_id, chat_id,
+                sender_id, message_content, timestamp) tuples before they
+                are removed
+            older_than: Stop at the first segment whose first record has
+                this timestamp or a later one
+        """
+        moved = {}  # {(old serial, old offset): (new serial, new offset)}
+        dropped_upto = {}  # {chat_id: newest message id dropped}
+        with self.lock:
+            serials = [segment.serial for segment in self.segments[:-1]]
+        for serial in serials:
+            with self.lock:
+                segment = self.by_serial.get(serial)
+                if segment is None or not segment.end:
+                    continue
+                if older_than is not None and segment.read(0)[5] >= older_than:
+                    return
+                records, dropped = [], []
+                offset = 0
+                while offset < segment.end:
+                    message_id, chat_id, sender_id, prev, content, timestamp, stop = segment.read(offset)
+                    if drop(message_id, chat_id, timestamp):
+                        dropped.append((message_id, chat_id, sender_id, content, timestamp))
+                    else:
+                        records.append((offset, message_id, chat_id, sender_id, prev, content, timestamp))
+                    offset = stop
+                if not dropped:
+                    continue
+                if archive is not None:
+                    archive(dropped)
+                for message_id, chat_id, _, _, _ in dropped:
+                    dropped_upto[chat_id] = message_id
+                replacement = self._rewrite(segment, records, moved, dropped_upto)
+                position = self.segments.index(segment)
+                if replacement:
+                    self.segments[position] = replacement
+                    self.by_serial[replacement.serial] = replacement
+                else:
+                    del self.segments[position]
+                del self.by_serial[segment.serial]
+                segment.close()
+                os.unlink(segment.path)
+                for chat_id, (message_id, head_serial, head_offset) in list(self.heads.items()):
+                    if message_id <= dropped_upto.get(chat_id, 0):
+                        del self.heads[chat_id]
+                    elif (head_serial, head_offset) in moved:
+                        self.heads[chat_id] = (message_id,) + moved[(head_serial, head_offset)]
+            yield len(dropped), segment.end - (replacement.end if replacement else 0)
+
+    def _rewrite(self, segment, records, moved, dropped_upto):
+        if not records:
+            return None
+        name = f"{records[0][1]:020d}.{self.next_serial}.log"
+        replacement = Segment(os.path.join(self.directory, name), records[0][1], self.next_serial, 0)
+        self.next_serial += 1
+        data = bytearray()
+        last_indexed = -self.index_interval
+        for old_offset, message_id, chat_id, sender_id, prev, content, timestamp in records:
+            if prev is not None:
+                if prev[0] <= dropped_upto.get(chat_id, 0):
+                    prev = None
+                elif (prev[1], prev[2]) in moved:
+                    prev = (prev[0],) + moved[(prev[1], prev[2])]
+            offset = len(data)
+            moved[(segment.serial, old_offset)] = (replacement.serial, offset)
+            if offset - last_indexed >= self.index_interval:
+                replacement.index_ids.append(message_id)
+                replacement.index_offsets.append(offset)
+                last_indexed = offset
+            data += encode_record(message_id, chat_id, sender_id, prev, timestamp, content)
+        os.pwrite(replacement.fd, bytes(data), 0)
+        replacement.end = len(data)
+        replacement.sync()
+        replacement.seal()
+        return replacement
+
+    def scan(self, batch_size=1000):
+        """
+        Every record, oldest first, as (message_id, chat_id, sender_id, message_content, timestamp).
+
+        The partition is locked for one batch at a time. Each batch starts
+        after the last id read, so compaction in between is harmless.
+        """
+        last_id = 0
+        while True:
+            rows = []
+            with self.lock:
+                position = max(bisect.bisect_right([segment.base_id for segment in self.segments], last_id) - 1, 0)
+                for segment in self.segments[position:]:
+                    offset = segment.seek(last_id + 1)
+                    while offset < segment.end and len(rows) < batch_size:
+                        message_id, chat_id, sender_id, _, content, timestamp, offset = segment.read(offset)
+                        rows.append((message_id, chat_id, sender_id, content, timestamp))
+                    if len(rows) >= batch_size:
+                        break
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def backup(self, directory, chunk_size=2**20):
+        """Copy the segments, as far as they are written, into directory."""
+        os.makedirs(directory, exist_ok=True)
+        # Bytes before a segment's end never change (compaction writes a new
+        # file), so only taking the list needs the lock. The duplicated
+        # descriptors keep files compacted away meanwhile readable
+        with self.lock:
+            segments = [(os.path.basename(segment.path), os.dup(segment.fd), segment.end)
+                        for segment in self.segments]
+        for name, fd, end in segments:
+            try:
+                with open(os.path.join(directory, name), "wb") as target:
+                    for offset in range(0, end, chunk_size):
+                        target.write(os.pread(fd, min(chunk_size, end - offset), offset))
+            finally:
+                os.close(fd)
+
+    def sync(self):
+        with self.lock:
+            self.segments[-1].sync()
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+            self.by_serial = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "segments": len(self.segments),
+                "bytes": sum(segment.end for segment in self.segments),
+                "chats": len(self.heads)
+            }
+
+
+class MessageLog:
+    """
+    Append-only message store: each chat's messages appended to a log file.
+
+    Chat traffic is appends and reads of a chat's newest messages, which a
+    log serves without B-tree inserts or ORDER BY lookups. Chats are
+    spread over partitions by chat_id, each a series of segment files of
+    length-prefixed, checksummed records with a sparse message_id index.
+    Reads go through mmap. Full segments roll over to a new file, and
+    compact() rewrites the sealed ones without dropped messages.
+
+    The log is rebuilt from the files when opened (only the newest segment
+    is checksummed) and is owned by one process at a time.
+    """
+
+    def __init__(self, directory, partitions=8, id_floor=0, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 index_interval=DEFAULT_INDEX_INTERVAL):
+        """
+        Args:
+            directory: Where the partitions' segment files live
+            partitions: Number of partitions chats are spread over
+            id_floor: Message ids up to this one are already taken
+            segment_bytes: Size at which a segment is sealed and a new one started
+            index_interval: Bytes of log between sparse index entries
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock_file = open(os.path.join(directory, "LOCK"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.lock_file.close()
+                raise RuntimeError(f"Message log {directory} is open in another process")
+        self.partitions = [
+            Partition(os.path.join(directory, f"p{index}"), index, partitions, id_floor,
+                      segment_bytes, index_interval)
+            for index in range(partitions)
+        ]
+
+    def _partition(self, chat_id):
+        return self.partitions[int(chat_id) % len(self.partitions)]
+
+    def append(self, chat_id, sender_id, content, timestamp, message_id=None):
+        """Append a message; returns its message_id (the given one when copying messages in)."""
+        return self._partition(chat_id).append(chat_id, sender_id, content, timestamp, message_id)
+
+    def copy_in(self, rows):
+        """
+        Append existing messages, keeping their ids and timestamps.
+
+        Args:
+            rows: (message_id, chat_id, sender_id, message_content, timestamp)
+                tuples, oldest first; ones already in the log are skipped, so
+                a copy interrupted half way can simply be run again
+        """
+        for message_id, chat_id, sender_id, message_content, timestamp in rows:
+            partition = self._partition(chat_id)
+            if message_id > partition.last_id:
+                partition.append(chat_id, sender_id, message_content, str(timestamp), message_id)
+
+    def recent(self, chat_id, limit=50, before_id=None):
+        """A chat's newest messages first, as (message_id, sender_id, message_content, timestamp) tuples."""
+        return self._partition(chat_id).recent(chat_id, limit, before_id)
+
+    def compact_steps(self, drop, archive=None, older_than=None):
+        """
+        Rewrite every partition's sealed segments without dropped messages,
+        yielding (records dropped, bytes freed) per segment rewritten; see
+        Partition.compact_steps().
+        """
+        for partition in self.partitions:
+            yield from partition.compact_steps(drop, archive, older_than)
+
+    def compact(self, drop, archive=None):
+        """Run compact_steps() to the end; returns (records dropped, bytes freed)."""
+        dropped = freed = 0
+        for step_dropped, step_freed in self.compact_steps(drop, archive):
+            dropped += step_dropped
+            freed += step_freed
+        if dropped:
+            logger.info(f"Compacted message log: {dropped} messages dropped, {freed} bytes freed")
+        return dropped, freed
+
+    def scan(self, batch_size=1000):
+        """Every message ordered by message_id, as (message_id, chat_id, sender_id, message_content, timestamp)."""
+        return heapq.merge(*(partition.scan(batch_size) for partition in self.partitions))
+
+    def backup(self, directory):
+        """Copy the log into directory, one partition at a time, while it keeps being written."""
+        for partition in self.partitions:
+            partition.backup(os.path.join(directory, os.path.basename(partition.directory)))
+
+    def sync(self):
+        """fsync the segments being written."""
+        for partition in self.partitions:
+            partition.sync()
+
+    def close(self):
+        for partition in self.partitions:
+            partition.close()
+        self.lock_file.close()
+
+    def snapshot(self):
+        partitions = [partition.snapshot() for partition in self.partitions]
+        return {
+            "partitions": len(partitions),
+            "segments": sum(p["segments"] for p in partitions),
+            "bytes": sum(p["bytes"] for p in partitions),
+            "chats": sum(p["chats"] for p in partitions)
+        }
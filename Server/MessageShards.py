@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import threading
+import weakref
+from ServerLog import get_logger
+
+logger = get_logger("shards")
+
+
+class MessageShards:
+    """
+    The messages table split by chat_id across several SQLite files.
+
+    SQLite lets one connection at a time write to a database file, so when
+    every chat's messages live in the main database a busy chat's inserts
+    queue behind everybody else's. Here chat_id modulo the shard count
+    picks the file that holds a chat's messages. Each file has its own
+    write lock, so chats on different shards insert in parallel, while a
+    chat's history is still read from a single file. Users, sessions and
+    chat membership stay in the main database.
+
+    Message ids stay unique across shards: shard i only hands out ids that
+    are congruent to i modulo the shard count, above the highest id moved
+    in from the main database and above any it handed out before, even if
+    that message has been deleted since.
+    """
+
+    def __init__(self, db_path, count, connect, id_floor=0):
+        """
+        Args:
+            db_path: Path of the main database; shard files are created next to it
+            count: Number of shard files
+            connect: Called as connect(path) to open a connection to a shard file
+            id_floor: Message ids up to this one are taken by messages moved from the main database
+        """
+        root, ext = os.path.splitext(db_path)
+        self.paths = [f"{root}.messages-{index}{ext or '.db'}" for index in range(count)]
+        self.count = count
+        self.connect = connect
+        self.id_floor = id_floor
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()  # Closed together in close()
+        for index in range(count):
+            self._create_tables(self.conn(index))
+
+    def shard_for(self, chat_id):
+        """Index of the shard file holding chat_id's messages."""
+        return int(chat_id) % self.count
+
+    def conn(self, index):
+        """The calling thread's connection to shard index, created on first use."""
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = [None] * self.count
+        conn = connections[index]
+        if conn is None:
+            conn = connections[index] = self.connect(self.paths[index])
+            self._connections.add(conn)
+        return conn
+
+    def _create_tables(self, conn):
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id INTEGER PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    sender_id INTEGER,
+                    message_content TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, message_id)')
+            # The highest id handed out: MAX(message_id) goes down when the
+            # newest messages expire, and their ids must not come back
+            conn.execute('CREATE TABLE IF NOT EXISTS id_high_water (last_id INTEGER NOT NULL)')
+            conn.execute('''
+                INSERT INTO id_high_water (last_id)
+                SELECT COALESCE(MAX(message_id), 0) FROM messages
+                WHERE NOT EXISTS (SELECT 1 FROM id_high_water)
+            ''')
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error creating shard tables: {e}")
+            raise
+
+    def insert(self, chat_id, sender_id, message_content):
+        """Store a message in its chat's shard; returns the new message_id."""
+        index = self.shard_for(chat_id)
+        conn = self.conn(index)
+        try:
+            # The next id is worked out inside the UPDATE, which takes the
+            # shard's write lock, so concurrent writers (other threads or
+            # worker processes) can't hand out the same one. Messages copied
+            # in with their ids (insert_rows) count too
+            conn.execute('''
+                UPDATE id_high_water
+                SET last_id = (MAX(last_id, COALESCE((SELECT MAX(message_id) FROM messages), 0), ?) / ? + 1) * ? + ?
+            ''', (self.id_floor, self.count, self.count, index))
+            message_id = conn.execute('SELECT last_id FROM id_high_water').fetchone()[0]
+            conn.execute('INSERT INTO messages (message_id, chat_id, sender_id, message_content) VALUES (?, ?, ?, ?)',
+                         (message_id, chat_id, sender_id, message_content))
+            conn.commit()
+            return message_id
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    def delete(self, chat_id, message_id):
+        """Remove a message from its chat's shard, undoing an insert whose other writes failed."""
+        conn = self.conn(self.shard_for(chat_id))
+        try:
+            conn.execute('DELETE FROM messages WHERE message_id = ?', (message_id,))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    def insert_rows(self, rows):
+        """
+        Copy existing messages into their shards, keeping their ids.
+
+        Args:
+            rows: (message_id, chat_id, sender_id, message_content, timestamp) tuples
+        """
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(self.shard_for(row[1]), []).append(tuple(row))
+        for index, shard_rows in by_shard.items():
+            conn = self.conn(index)
+            try:
+                # OR IGNORE: a move interrupted half way can simply be run again
+                conn.executemany('''
+                    INSERT OR IGNORE INTO messages (message_id, chat_id, sender_id, message_content, timestamp)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', shard_rows)
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
+    def recent(self, chat_id, limit=50, before_id=None):
+        """A chat's newest messages (older than before_id) first, as (message_id, sender_id, message_content, timestamp) tuples."""
+        cursor = self.conn(self.shard_for(chat_id)).cursor()
+        cursor.row_factory = None  # Plain tuples, which are cheaper to build and unpack
+        cursor.execute('''
+            SELECT message_id, sender_id, message_content, timestamp
+            FROM messages
+            WHERE chat_id = ? AND message_id < ?
+            ORDER BY message_id DESC
+            LIMIT ?
+        ''', (chat_id, before_id or 2**63 - 1, limit))
+        return cursor.fetchall()
+
+    def checkpoint(self):
+        """Checkpoint every shard's WAL; returns the summed (wal_pages, copied_pages)."""
+        wal_total = copied_total = 0
+        for index in range(self.count):
+            busy, wal_pages, copied_pages = self.conn(index).execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            wal_total += max(wal_pages, 0)
+            copied_total += max(copied_pages, 0)
+        return wal_total, copied_total
+
+    def close(self):
+        """Close every thread's shard connections."""
+        for conn in list(self._connections):
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
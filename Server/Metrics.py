@@ -0,0 +1,233 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ServerLog import get_logger
+
+logger = get_logger("metrics")
+
+# Upper bounds in seconds; bcrypt-bound logins land around 0.25-0.5
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRIC_PREFIX = "intechat_"
+
+
+class Histogram:
+    """Fixed-bucket latency histogram (not thread-safe, Metrics locks around it)."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        cumulative = []
+        seen = 0
+        for count in self.counts:
+            seen += count
+            cumulative.append(seen)
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.50),
+            "p99": self.quantile(0.99),
+            "buckets": {str(bound): total for bound, total in zip(self.buckets + ("+Inf",), cumulative)}
+        }
+
+
+class QueryTimer:
+    """
+    Per-thread accumulator of time spent in the database.
+
+    The database layer adds to it after every statement; the request
+    dispatcher takes the total when a handler returns, which attributes
+    DB time to the request type without passing timers through every call.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def add(self, seconds):
+        self._local.seconds = getattr(self._local, "seconds", 0.0) + seconds
+
+    def take(self):
+        """Return the time accumulated on this thread and reset it."""
+        seconds = getattr(self._local, "seconds", 0.0)
+        self._local.seconds = 0.0
+        return seconds
+
+
+query_timer = QueryTimer()
+
+
+class Metrics:
+    """
+    Thread-safe counters, latency histograms and gauges for the server.
+
+    Counters and histograms carry at most one label, the request type
+    unless describe() names a different one.
+    Gauges are callables sampled when a snapshot is taken; a gauge may
+    return a dict to expose several related values at once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}  # {name: {label: value}}
+        self.histograms = {}  # {name: {label: Histogram}}
+        self.gauges = {}  # {name: callable}
+        self.descriptions = {}  # {name: help text}
+        self.label_names = {}  # {name: label name}, "type" when not set
+
+    def describe(self, name, text, label="type"):
+        self.descriptions[name] = text
+        self.label_names[name] = label
+
+    def increment(self, name, label=None, amount=1):
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[label] = values.get(label, 0) + amount
+
+    def observe(self, name, label, seconds):
+        with self.lock:
+            histograms = self.histograms.setdefault(name, {})
+            histogram = histograms.get(label)
+            if histogram is None:
+                histogram = histograms[label] = Histogram()
+            histogram.observe(seconds)
+
+    def register_gauge(self, name, function, description=None):
+        self.gauges[name] = function
+        if description:
+            self.describe(name, description)
+
+    def _sample_gauges(self):
+        values = {}
+        for name, function in self.gauges.items():
+            try:
+                values[name] = function()
+            except Exception as e:
+                logger.error(f"Error sampling gauge {name}: {e}")
+        return values
+
+    def snapshot(self):
+        """Return every metric as plain data (used by the get_metrics request)."""
+        with self.lock:
+            counters = {name: {label or "": value for label, value in values.items()}
+                        for name, values in self.counters.items()}
+            histograms = {name: {label or "": histogram.snapshot() for label, histogram in values.items()}
+                          for name, values in self.histograms.items()}
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "counters": counters,
+            "histograms": histograms,
+            "gauges": self._sample_gauges()
+        }
+
+    def prometheus_text(self):
+        """Render every metric in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def header(name, kind):
+            if name in self.descriptions:
+                lines.append(f"# HELP {METRIC_PREFIX}{name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+
+        def labels(name, label, extra=None):
+            pairs = [f'{self.label_names.get(name, "type")}="{label}"'] if label else []
+            if extra:
+                pairs.append(extra)
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        for name, values in sorted(snapshot["counters"].items()):
+            header(name, "counter")
+            for label, value in sorted(values.items()):
+                lines.append(f"{METRIC_PREFIX}{name}{labels(name, label)} {value}")
+
+        for name, values in sorted(snapshot["histograms"].items()):
+            header(name, "histogram")
+            for label, histogram in sorted(values.items()):
+                for bound, total in histogram["buckets"].items():
+                    bucket_labels = labels(name, label, 'le="%s"' % bound)
+                    lines.append(f"{METRIC_PREFIX}{name}_bucket{bucket_labels} {total}")
+                lines.append(f"{METRIC_PREFIX}{name}_sum{labels(name, label)} {histogram['sum']}")
+                lines.append(f"{METRIC_PREFIX}{name}_count{labels(name, label)} {histogram['count']}")
+
+        for name, value in sorted(snapshot["gauges"].items()):
+            # Dict gauges become one gauge per key
+            values = value.items() if isinstance(value, dict) else [(None, value)]
+            for key, item in values:
+                if not isinstance(item, (int, float)):
+                    continue
+                full_name = f"{name}_{key}" if key else name
+                header(full_name, "gauge")
+                lines.append(f"{METRIC_PREFIX}{full_name} {item}")
+
+        header("uptime_seconds", "gauge")
+        lines.append(f"{METRIC_PREFIX}uptime_seconds {snapshot['uptime_seconds']}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHTTPServer:
+    """Serves Metrics.prometheus_text() at /metrics from a background thread."""
+
+    def __init__(self, metrics, host="127.0.0.1", port=9100):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes every few seconds would drown the server log
+
+        try:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            logger.error(f"Failed to start metrics endpoint: {e}")
+            return False
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Metrics available at http://{self.host}:{self.port}/metrics")
+        return True
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
@@ -0,0 +1,218 @@
+import select
+import socket
+import threading
+from collections import deque
+from ServerLog import get_logger
+
+logger = get_logger("outbound")
+
+# Neither exists on Windows, where select() says which connections can
+# take more and a send is kept from blocking by making the socket
+# non-blocking for its duration
+HAS_POLL = hasattr(select, "poll")
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", None)
+
+
+class Outbox:
+    """Frames waiting to go out on one connection."""
+
+    __slots__ = ("send_lock", "frames", "queued_bytes", "partial", "holding", "closed")
+
+    def __init__(self, send_lock):
+        self.send_lock = send_lock  # The connection's, so queued frames never interleave with direct sends
+        self.frames = deque()
+        self.queued_bytes = 0
+        self.partial = None  # What is left of a frame sent only in part
+        self.holding = False  # Whether the writer holds send_lock for a partial frame
+        self.closed = False
+
+
+class OutboundWriter:
+    """
+    Sends queued frames to many connections from one thread.
+
+    Broadcasts queue their frames here instead of sending them, so the
+    thread delivering a message never waits on a recipient; the writer
+    sends with non-blocking writes to whichever connections can take more,
+    so one client that stops reading only holds up its own queue. A queue
+    that grows past max_queued_bytes is refused, and the caller drops that
+    connection.
+    """
+
+    def __init__(self, max_queued_bytes=4 * 1024 * 1024):
+        """
+        Args:
+            max_queued_bytes: Most bytes one connection may have waiting
+        """
+        self.max_queued_bytes = max_queued_bytes
+        self.lock = threading.Lock()
+        self.outboxes = {}  # {client_socket: Outbox}
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.frames_sent = 0
+        self.overflows = 0
+
+    def register(self, client_socket, send_lock):
+        """Give a new connection a queue; send_lock is the one its direct sends take."""
+        with self.lock:
+            self.outboxes[client_socket] = Outbox(send_lock)
+
+    def queue(self, client_socket, frame):
+        """
+        Queue a frame for a connection, behind any it already has waiting.
+
+        Returns:
+            False if the connection's queue is full (it isn't reading), else True
+
+        Raises:
+            ConnectionError: If the connection has closed
+        """
+        with self.lock:
+            outbox = self.outboxes.get(client_socket)
+            if outbox is None:
+                raise ConnectionError("Client disconnected")
+            if outbox.queued_bytes + len(frame) > self.max_queued_bytes:
+                self.overflows += 1
+                return False
+            was_idle = not outbox.frames and outbox.partial is None
+            outbox.frames.append(frame)
+            outbox.queued_bytes += len(frame)
+        if was_idle:
+            self._wake()
+        return True
+
+    def discard(self, client_socket):
+        """Drop a closed connection's queue, and the send lock if the writer holds it."""
+        with self.lock:
+            outbox = self.outboxes.pop(client_socket, None)
+            if outbox is None:
+                return
+            outbox.closed = True
+            self._release(outbox)
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="outbound", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self._wake()
+        if self.thread:
+            self.thread.join(timeout=2.0)
+            self.thread = None
+
+    def _wake(self):
+        try:
+            self.wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # A wakeup is already pending
+
+    def _release(self, outbox):
+        # Callers hold self.lock
+        if outbox.holding:
+            outbox.holding = False
+            outbox.send_lock.release()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            with self.lock:
+                pending = [(client_socket, outbox) for client_socket, outbox in self.outboxes.items()
+                           if outbox.frames or outbox.partial is not None]
+            by_fd = {}
+            for client_socket, outbox in pending:
+                fd = client_socket.fileno()
+                if fd != -1:
+                    by_fd[fd] = (client_socket, outbox)
+            # A connection busy with a direct send gets another try shortly
+            busy = False
+            for fd in self._wait(by_fd, None if not by_fd else 1.0):
+                if fd == self.wakeup_reader.fileno():
+                    try:
+                        while self.wakeup_reader.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                elif fd in by_fd:
+                    busy |= not self._write(*by_fd[fd])
+            if busy:
+                self.stop_event.wait(0.01)
+
+    def _wait(self, by_fd, timeout):
+        """File descriptors of the wakeup socket and the connections in by_fd that are ready."""
+        if HAS_POLL:
+            poller = select.poll()
+            poller.register(self.wakeup_reader, select.POLLIN)
+            for fd in by_fd:
+                poller.register(fd, select.POLLOUT)
+            return [fd for fd, _ in poller.poll(None if timeout is None else timeout * 1000)]
+        try:
+            readable, writable, _ = select.select([self.wakeup_reader], list(by_fd), [], timeout)
+        except OSError:
+            return []  # A connection closed since it was listed; the next round leaves it out
+        if readable:
+            writable.append(self.wakeup_reader.fileno())
+        return writable
+
+    def _send(self, client_socket, data):
+        if MSG_DONTWAIT is not None:
+            return client_socket.send(data, MSG_DONTWAIT)
+        # The writer holds the connection's send lock, so no direct send sees
+        # the switch; a recv() that does waits it out (ServerComm.receive_from_client)
+        client_socket.setblocking(False)
+        try:
+            return client_socket.send(data)
+        finally:
+            try:
+                client_socket.setblocking(True)
+            except OSError:
+                pass  # Closed meanwhile
+
+    def _write(self, client_socket, outbox):
+        """
+        Send as much of a connection's queue as it takes without blocking.
+
+        Returns:
+            False if another thread was mid-send on the connection, else True
+        """
+        while True:
+            if outbox.partial is None:
+                # Whole frames only, so take the connection's lock like any other sender
+                if not outbox.send_lock.acquire(blocking=False):
+                    return False
+                with self.lock:
+                    if outbox.closed or not outbox.frames:
+                        outbox.send_lock.release()
+                        return True
+                    outbox.holding = True
+                    outbox.partial = memoryview(outbox.frames.popleft())
+            try:
+                sent = self._send(client_socket, outbox.partial)
+            except BlockingIOError:
+                return True  # Full; poll says when it drains
+            except OSError as e:
+                # The connection's own thread notices too and closes it
+                logger.debug(f"Queued send failed: {e}")
+                self.discard(client_socket)
+                return True
+            with self.lock:
+                if outbox.closed:
+                    return True
+                outbox.queued_bytes -= sent
+                outbox.partial = outbox.partial[sent:] if sent < len(outbox.partial) else None
+                if outbox.partial is None:
+                    self.frames_sent += 1
+                    self._release(outbox)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "connections": sum(1 for outbox in self.outboxes.values()
+                                   if outbox.frames or outbox.partial is not None),
+                "queued_bytes": sum(outbox.queued_bytes for outbox in self.outboxes.values()),
+                "frames_sent": self.frames_sent,
+                "overflows": self.overflows
+            }
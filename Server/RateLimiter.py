@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter keyed by user, connection, username, etc.
+
+    Each key gets a bucket holding up to `burst` tokens that refills at
+    `rate` tokens per second; a request spends one token. Checking a key
+    is O(1). Buckets are kept in least-recently-used order, so the ones
+    idle for longer than `idle_timeout` are dropped from the front as a
+    side effect of later calls (at most once a second), without ever
+    scanning every bucket.
+    """
+
+    def __init__(self, rate, burst, idle_timeout=300.0):
+        """
+        Args:
+            rate: Tokens added per second
+            burst: Bucket capacity, i.e. how many requests may arrive at once
+            idle_timeout: Seconds without requests before a bucket is dropped
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        # A bucket idle this long has refilled completely, so dropping it
+        # can never let a client through earlier than it would otherwise
+        self.idle_timeout = max(float(idle_timeout), self.burst / self.rate)
+        self.buckets = OrderedDict()  # {key: [tokens, last_update]}, least recently used first
+        self.lock = threading.Lock()
+        self.next_eviction = 0.0
+
+    @classmethod
+    def from_config(cls, settings, defaults, idle_timeout=300.0):
+        """
+        Build a limiter from a config section like {"rate": 2, "burst": 10}.
+
+        Raises:
+            ValueError: If rate or burst isn't a positive number
+        """
+        settings = {**defaults, **(settings or {})}
+        for name in ("rate", "burst"):
+            value = settings[name]
+            # A zero rate would never refill (and divides by zero above); a zero burst refuses everything
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(f"Rate limit {name} must be a positive number, not {value!r}")
+        return cls(settings["rate"], settings["burst"], settings.get("idle_timeout", idle_timeout))
+
+    def allow(self, key, cost=1.0):
+        """Spend `cost` tokens from the key's bucket; returns False if it doesn't have them."""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self.buckets.move_to_end(key)
+            if now >= self.next_eviction:
+                self._evict_idle(now)
+
+            if bucket[0] < cost:
+                return False
+            bucket[0] -= cost
+            return True
+
+    def forget(self, key):
+        """Drop a key's bucket, e.g. a connection's once it closes and its id can be reused."""
+        with self.lock:
+            self.buckets.pop(key, None)
+
+    def evict_idle(self):
+        """Drop idle buckets now; returns how many are left. For when traffic has stopped."""
+        with self.lock:
+            self._evict_idle(time.monotonic())
+            return len(self.buckets)
+
+    def _evict_idle(self, now):
+        # At most once a second, the front of the LRU order is all that's ever examined
+        self.next_eviction = now + 1.0
+        buckets = self.buckets
+        while buckets:
+            key = next(iter(buckets))
+            if now - buckets[key][1] < self.idle_timeout:
+                break
+            del buckets[key]
+
+    def __len__(self):
+        return len(self.buckets)
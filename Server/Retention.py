@@ -0,0 +1,122 @@
+import time
+from Storage import StorageError
+from ServerLog import get_logger
+
+logger = get_logger("retention")
+
+CHAT_TYPES = ("private", "group")
+
+
+class MessageRetention:
+    """
+    Archives messages past their chat type's retention, then reclaims the space.
+
+    A pass moves expired messages to the archive in batches and then runs
+    incremental vacuum steps. run() is called from the scheduler every few
+    seconds. Each call works for at most slice_seconds and then returns,
+    leaving the rest of the pass to the next call, and it pauses between
+    batches so live writes wait for one batch at most. A new pass starts
+    pass_interval seconds after the last one did.
+    """
+
+    def __init__(self, storage, retention_days, pass_interval=3600, batch_size=500, vacuum_pages=256,
+                 slice_seconds=0.2, pause=0.05):
+        """
+        Args:
+            storage: Storage engine holding the messages
+            retention_days: {chat_type: days messages are kept}, None to keep them forever
+            pass_interval: Seconds between the starts of two passes
+            batch_size: Messages archived per batch (one transaction)
+            vacuum_pages: Pages handed back per vacuum step
+            slice_seconds: How long one run() may keep working
+            pause: Seconds to sleep between batches, letting waiting writers in
+        """
+        self.storage = storage
+        self.retention_days = {chat_type: days for chat_type, days in retention_days.items() if days}
+        self.pass_interval = pass_interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.slice_seconds = slice_seconds
+        self.pause = pause
+        self.next_pass = 0.0  # time.time() the next pass may start
+        self.expiring = None  # Generator of the pass in progress, while it archives
+        self.vacuuming = False
+        self.passes = 0
+        self.archived = 0
+        self.pages_freed = 0
+
+    @classmethod
+    def from_config(cls, storage, settings):
+        """Build from the "retention" section of config.json."""
+        settings = settings or {}
+        return cls(
+            storage,
+            {chat_type: settings.get(f"{chat_type}_days") for chat_type in CHAT_TYPES},
+            pass_interval=settings.get("pass_interval", 3600),
+            batch_size=settings.get("batch_size", 500),
+            vacuum_pages=settings.get("vacuum_pages", 256),
+            slice_seconds=settings.get("slice_seconds", 0.2),
+            pause=settings.get("pause", 0.05)
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.retention_days)
+
+    def cutoffs(self, now=None):
+        """{chat_type: timestamp} before which that chat type's messages expire."""
+        now = time.time() if now is None else now
+        return {
+            chat_type: time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - days * 86400))
+            for chat_type, days in self.retention_days.items()
+        }
+
+    def run(self):
+        """Work on the current pass for up to slice_seconds, starting a new one when due."""
+        if not self.enabled:
+            return
+        deadline = time.monotonic() + self.slice_seconds
+        if self.expiring is None and not self.vacuuming:
+            if time.time() < self.next_pass:
+                return
+            self.next_pass = time.time() + self.pass_interval
+            self.expiring = self.storage.expire_messages(self.cutoffs(), self.batch_size)
+            self.passes += 1
+
+        try:
+            while self.expiring is not None:
+                archived = next(self.expiring, None)
+                if archived is None:
+                    self.expiring = None
+                    self.vacuuming = True
+                    break
+                self.archived += archived
+                if time.monotonic() >= deadline:
+                    return
+                time.sleep(self.pause)
+
+            while self.vacuuming:
+                freed = self.storage.vacuum_step(self.vacuum_pages)
+                self.pages_freed += freed
+                if not freed:
+                    self.vacuuming = False
+                    logger.info(f"Retention pass done: {self.archived} messages archived, "
+                                f"{self.pages_freed} pages freed so far")
+                elif time.monotonic() >= deadline:
+                    return
+                else:
+                    time.sleep(self.pause)
+        except StorageError as e:
+            # Dropped; the next pass picks up where this one failed
+            logger.error(f"Error applying message retention: {e}")
+            self.expiring = None
+            self.vacuuming = False
+
+    def snapshot(self):
+        return {
+            "retention_days": dict(self.retention_days),
+            "passes": self.passes,
+            "in_progress": self.expiring is not None or self.vacuuming,
+            "archived": self.archived,
+            "pages_freed": self.pages_freed
+        }
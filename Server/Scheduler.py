@@ -0,0 +1,169 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from ServerLog import get_logger
+
+logger = get_logger("scheduler")
+
+
+class ScheduledTask:
+    """A periodic or one-shot task plus its run-time accounting."""
+
+    def __init__(self, name, function, interval, jitter=0.0):
+        self.name = name
+        self.function = function
+        self.interval = interval  # None for one-shot tasks
+        self.jitter = jitter  # Up to this many seconds are added to every delay
+        self.cancelled = False
+        self.due = None  # Next run time before jitter, what the cadence is kept on
+        self.next_run = None
+        self.runs = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_run = None  # Wall-clock time of the last run
+        self.last_error = None
+
+    def snapshot(self):
+        return {
+            "interval": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            "total_seconds": round(self.total_seconds, 6),
+            "mean_seconds": round(self.total_seconds / self.runs, 6) if self.runs else 0.0,
+            "max_seconds": round(self.max_seconds, 6),
+            "last_run": self.last_run,
+            "last_error": self.last_error
+        }
+
+
+class Scheduler:
+    """
+    Runs periodic and delayed maintenance tasks on one background thread.
+
+    Tasks wait in a heap ordered by their next run time, and the thread
+    sleeps on a condition until the earliest one is due, so an idle
+    scheduler costs nothing. Tasks run one after another and should be
+    short; anything slow belongs on its own thread.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics  # Optional Metrics that receive run times and failures
+        self.heap = []  # [(next_run, sequence, ScheduledTask)]
+        self.tasks = {}  # {name: ScheduledTask}
+        self.sequence = itertools.count()  # Tie-breaker so tasks never get compared
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def every(self, name, interval, function, jitter=0.0, initial_delay=None):
+        """
+        Run function() every `interval` seconds.
+
+        Args:
+            name: Unique task name, used in metrics and for cancel()
+            interval: Seconds between runs
+            function: Callable taking no arguments
+            jitter: Random extra delay, up to this many seconds, so tasks
+                started together don't keep firing together
+            initial_delay: Seconds until the first run (defaults to interval)
+        """
+        task = ScheduledTask(name, function, interval, jitter)
+        self._add(task, interval if initial_delay is None else initial_delay)
+        return task
+
+    def call_later(self, name, delay, function):
+        """Run function() once, `delay` seconds from now."""
+        task = ScheduledTask(name, function, None)
+        self._add(task, delay)
+        return task
+
+    def cancel(self, name):
+        with self.condition:
+            task = self.tasks.pop(name, None)
+            if task:
+                task.cancelled = True  # Dropped when it reaches the top of the heap
+
+    def _add(self, task, delay):
+        with self.condition:
+            replaced = self.tasks.get(task.name)
+            if replaced:
+                replaced.cancelled = True
+            self.tasks[task.name] = task
+            self._push(task, time.monotonic() + delay)
+            self.condition.notify()
+
+    def _push(self, task, due):
+        task.due = due
+        task.next_run = due + random.uniform(0, task.jitter) if task.jitter else due
+        heapq.heappush(self.heap, (task.next_run, next(self.sequence), task))
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5.0)
+        self.thread = None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                task = None
+                while self.running:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    next_run, _, candidate = self.heap[0]
+                    if candidate.cancelled:
+                        heapq.heappop(self.heap)
+                        continue
+                    delay = next_run - time.monotonic()
+                    if delay > 0:
+                        self.condition.wait(delay)
+                        continue
+                    heapq.heappop(self.heap)
+                    task = candidate
+                    break
+                if task is None:
+                    return
+            self._execute(task)
+
+    def _execute(self, task):
+        start = time.perf_counter()
+        try:
+            task.function()
+            task.last_error = None
+        except Exception as e:
+            task.failures += 1
+            task.last_error = str(e)
+            logger.exception(f"Scheduled task {task.name} failed: {e}")
+            if self.metrics:
+                self.metrics.increment("task_failures_total", task.name)
+        elapsed = time.perf_counter() - start
+        task.runs += 1
+        task.total_seconds += elapsed
+        task.max_seconds = max(task.max_seconds, elapsed)
+        task.last_run = time.time()
+        if self.metrics:
+            self.metrics.observe("task_run_seconds", task.name, elapsed)
+
+        with self.condition:
+            if task.interval is None:
+                if self.tasks.get(task.name) is task:
+                    del self.tasks[task.name]
+            elif not task.cancelled:
+                # Keep the cadence, but don't try to catch up on missed runs
+                self._push(task, max(task.due + task.interval, time.monotonic()))
+
+    def snapshot(self):
+        """Run-time accounting for every task, keyed by name."""
+        with self.condition:
+            return {name: task.snapshot() for name, task in self.tasks.items()}
@@ -1,58 +1,126 @@
 import socket
 import threading
 import json
+import logging
+import select
 import time
 from Encryption import EncryptionManager
+from Codec import (MessageCodec, CompressionStats, FrameTooLargeError, extract_frame, build_chunk_header,
+                   available_encodings, available_compressions, negotiate_encoding, negotiate_compression,
+                   DEFAULT_COMPRESSION_THRESHOLD, MAX_FRAME_SIZE)
+from Metrics import Metrics, query_timer
+from ServerLog import get_logger, log_event
+from TimerWheel import TimerWheel
+from Outbound import OutboundWriter
 
-class RateLimiter:
-    def __init__(self):
-        self.message_timestamps = {}  # user_id -> list of timestamps
-        self.WINDOW_SIZE = 5  # seconds
-        self.MAX_MESSAGES = 10  # max messages per window
-        
-    def can_send_message(self, user_id):
-        """Check if user can send a message based on rate limit."""
-        current_time = time.time()
-        
-        # Get user's message timestamps
-        timestamps = self.message_timestamps.get(user_id, [])
-        
-        # Remove timestamps outside the window
-        timestamps = [ts for ts in timestamps if current_time - ts <= self.WINDOW_SIZE]
-        
-        # Update timestamps list
-        self.message_timestamps[user_id] = timestamps
-        
-        # Check if user is within rate limit
-        if len(timestamps) >= self.MAX_MESSAGES:
-            return False
-            
-        # Add new timestamp
-        timestamps.append(current_time)
-        return True
-
+logger = get_logger("comm")
 
 class ServerConnection:
-    def __init__(self, handlers=None, config_path="../config.json"):
-        """Initialize the server connection manager."""
+    def __init__(self, handlers=None, config_path=None, scheduler=None, encryption=None, reuse_port=False):
+        """
+        Initialize the server connection manager.
+
+        Args:
+            handlers: {request type: handler(client_socket, data)}
+            config_path: Path to config.json
+            scheduler: Scheduler to drive the heartbeat timer wheel
+            encryption: EncryptionManager holding the server's key pair
+                (a new key pair is generated when not given)
+            reuse_port: Bind with SO_REUSEPORT, so several worker
+                processes can accept on the same port
+        """
         self.server_socket = None
         self.connected_clients = {}  # {client_socket: ClientInfo}
+        self.clients_by_user = {}  # {user_id: {client_socket}}, for delivering to chat members
+        self.users_lock = threading.Lock()
+        self.presence_callback = None  # Called as (user_id, online) when a user's first connection logs in or last one closes
+        self.close_callback = None  # Called with each client_socket as its connection closes
+        self.chunk_callback = None  # Called as (client_socket, data) with each uploaded attachment chunk
         self.server_ip = None
         self.server_port = None
-        self.encryption = EncryptionManager()
+        self.encryption = encryption or EncryptionManager()
+        self.reuse_port = reuse_port
         self.is_running = False
         self.accept_thread = None
         self.handlers = handlers or {}  # Store message handlers
         self.receive_buffers = {}  # Add buffer for each client
+        self.encodings = available_encodings()  # Wire encodings in order of preference
+        self.compressions = available_compressions()  # Compression methods in order of preference
+        self.compression_threshold = DEFAULT_COMPRESSION_THRESHOLD
+        self.compression_stats = CompressionStats()  # Shared by every client's codec
+        self.max_frame_size = MAX_FRAME_SIZE  # Longest request payload, before or after decompression
+        self.ping_interval = 30.0  # Ping clients that have been quiet this long
+        self.pong_timeout = 10.0  # Close clients that don't answer a ping within this
+        self.handshake_timeout = 10.0  # Close connections that haven't finished the handshake by then
+        self.idle_timeout = 3600.0  # Close connections with no requests for this long (0 disables)
+        self.timer_wheel = TimerWheel()  # One heartbeat timer per connection
+        self.outbound = OutboundWriter()  # Sends broadcasts, so delivering never waits on a recipient
+        self.scheduler = scheduler  # Drives the timer wheel when given, else it gets its own thread
+        self.metrics = Metrics()
+        self._register_metrics()
         self.load_config(config_path)
         
-        # Generate server keys on initialization
-        self.encryption.generate_keys()
+        # Generate server keys on initialization, unless they were handed in
+        if self.encryption.private_key is None:
+            self.encryption.generate_keys()
+
+    def process_request(self, message_type, client_socket, data, request_id=None):
+        """
+        Process a client request and return the appropriate response.
+        
+        The request_id, when the client sent one, is echoed back on the
+        response so the client can match it to the request that caused it.
+        """
+        label = self._metric_label(message_type)
+        query_timer.take()  # Don't bill this request for earlier queries on the thread
+        start = time.perf_counter()
+        response = self._dispatch_request(message_type, client_socket, data)
+        self.metrics.observe("request_dispatch_seconds", label, time.perf_counter() - start)
+        self.metrics.observe("request_db_seconds", label, query_timer.take())
+        self.metrics.increment("requests_total", label)
+        if response.get("type") == "error_response":
+            self.metrics.increment("request_errors_total", label)
+        if request_id is not None:
+            response["request_id"] = request_id
+        return response
 
-    def process_request(self, message_type, client_socket, data):
-        """Process a client request and return the appropriate response."""
+    def _metric_label(self, message_type):
+        """Request type to label metrics with; unknown types share one label."""
+        return message_type if message_type in self.handlers else "unknown"
+
+    def _register_metrics(self):
+        """Describe the request metrics and register the server's gauges."""
+        metrics = self.metrics
+        metrics.describe("requests_total", "Requests handled, by request type")
+        metrics.describe("request_errors_total", "Requests answered with an error_response")
+        metrics.describe("connections_total", "Client connections accepted")
+        metrics.describe("connections_reaped_total", "Connections closed by the heartbeat reaper", label="reason")
+        metrics.describe("pings_sent_total", "Heartbeat pings sent to quiet clients")
+        metrics.describe("request_dispatch_seconds", "Time spent in the request handler")
+        metrics.describe("request_db_seconds", "Time the request handler spent in the database")
+        metrics.describe("request_send_seconds", "Time spent serializing and sending the response")
+        metrics.register_gauge("connected_clients", lambda: len(self.connected_clients),
+                               "Open client connections")
+        metrics.register_gauge(
+            "established_sessions",
+            lambda: sum(1 for info in list(self.connected_clients.values()) if info.session_established),
+            "Connections that completed the secure handshake"
+        )
+        metrics.register_gauge(
+            "receive_buffer_bytes",
+            lambda: sum(len(buffer) for buffer in list(self.receive_buffers.values())),
+            "Bytes received but not yet parsed into requests"
+        )
+        metrics.register_gauge("threads", threading.active_count, "Live server threads")
+        metrics.register_gauge("heartbeat_timers", lambda: len(self.timer_wheel),
+                               "Heartbeat timers scheduled on the timer wheel")
+        metrics.register_gauge("compression", self.compression_stats.snapshot)
+        metrics.register_gauge("outbound", self.outbound.snapshot)
+
+    def _dispatch_request(self, message_type, client_socket, data):
+        """Run the handler for a request and wrap its result in a response."""
         try:
-            print(f"Processing {message_type} request with data: {data}")
+            log_event(logger, logging.DEBUG, "request", type=message_type, data=data)
             
             # Use the handler from our handlers dictionary
             if message_type in self.handlers:
@@ -66,7 +134,7 @@ class ServerConnection:
                         "data": handler_response
                     }
                 except Exception as handler_error:
-                    print(f"Handler error: {handler_error}")
+                    logger.exception(f"Handler error in {message_type}: {handler_error}")
                     response = {
                         "type": "error_response",
                         "data": {
@@ -83,11 +151,11 @@ class ServerConnection:
                     }
                 }
                 
-            print(f"Sending response: {response}")
+            log_event(logger, logging.DEBUG, "response", type=response["type"], data=response["data"])
             return response
             
         except Exception as e:
-            print(f"Error processing request: {e}")
+            logger.exception(f"Error processing request: {e}")
             return {
                 "type": "error_response",
                 "data": {
@@ -103,45 +171,45 @@ class ServerConnection:
             self.client_id = client_id
             self.public_key = None
             self.session_established = False
-            self.last_activity = time.time()
+            self.last_activity = time.time()  # Any frame, heartbeats included
+            self.last_request = time.time()  # Last frame that wasn't a heartbeat
+            self.ping_sent_at = None  # Set while waiting for the client's pong
+            self.heartbeat_timer = None
+            self.send_lock = threading.Lock()  # Keeps frames from different threads from interleaving
             self.user_id = None  # Store user_id after login
+            self.codec = MessageCodec()  # JSON until the handshake negotiates otherwise
+            self.pending_encoding = "json"  # Encoding to switch to once the session is confirmed
+            self.pending_compression = None  # Compression to enable once the session is confirmed
 
-    class MessageHandler:
-        def __init__(self, user_manager):
-            self.user_manager = user_manager
-            self.encryption = EncryptionManager()
-            self.pending_messages = {}
-            self.rate_limiter = RateLimiter()  # Add rate limiter
-
-        def save_message(self, chat_id, sender_id, content, encryption_keys=None):
-            """Save a message with rate limiting."""
-            try:
-                # Check rate limit
-                if not self.rate_limiter.can_send_message(sender_id):
-                    return False, "Message rate limit exceeded. Please wait a few seconds."
-
-                # Verify sender is in chat
-                is_member = self._verify_chat_membership(chat_id, sender_id)
-                if not is_member:
-                    return False, "Sender is not a member of this chat"
-
-                # Rest of the existing save_message code...
-                
-            except Exception as e:
-                return False, f"Error saving message: {str(e)}"
-
-    
     def load_config(self, config_path):
         """Load server IP and port from config.json."""
         try:
             import os
-            config_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "config.json"))
+            if config_path is None:
+                config_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "config.json"))
             with open(config_path, "r") as file:
                 config = json.load(file)
                 self.server_ip = config.get("server_ip_address")
                 self.server_port = config.get("server_port")
                 if not self.server_ip or not self.server_port:
                     raise ValueError("Missing server configuration")
+                protocol = config.get("protocol", {})
+                if "encodings" in protocol:
+                    self.encodings = [name for name in protocol["encodings"]
+                                      if name in available_encodings()]
+                if "compression" in protocol:
+                    self.compressions = [name for name in protocol["compression"]
+                                         if name in available_compressions()]
+                self.compression_threshold = protocol.get(
+                    "compression_threshold", self.compression_threshold
+                )
+                self.max_frame_size = protocol.get("max_frame_size", self.max_frame_size)
+                heartbeat = config.get("heartbeat", {})
+                self.ping_interval = heartbeat.get("ping_interval", self.ping_interval)
+                self.pong_timeout = heartbeat.get("pong_timeout", self.pong_timeout)
+                self.handshake_timeout = heartbeat.get("handshake_timeout", self.handshake_timeout)
+                self.idle_timeout = heartbeat.get("idle_timeout", self.idle_timeout)
+                self.outbound.max_queued_bytes = protocol.get("max_queued_bytes", self.outbound.max_queued_bytes)
         except Exception as e:
             raise RuntimeError(f"Failed to load configuration: {str(e)}")
     
@@ -150,10 +218,17 @@ class ServerConnection:
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_socket.bind((self.server_ip, self.server_port))
-            self.server_socket.listen(10)
+            self.server_socket.listen(socket.SOMAXCONN)  # Don't drop connection bursts
             self.is_running = True
-            print(f"Server started on {self.server_ip}:{self.server_port}")
+            if self.scheduler:
+                self.scheduler.every("heartbeats", self.timer_wheel.tick, self.timer_wheel.advance)
+            else:
+                self.timer_wheel.start()
+            self.outbound.start()
+            logger.info(f"Server started on {self.server_ip}:{self.server_port}")
             
             # Start accepting connections in a separate thread
             self.accept_thread = threading.Thread(target=self._accept_connections)
@@ -162,7 +237,7 @@ class ServerConnection:
             
             return True
         except Exception as e:
-            print(f"Failed to start server: {str(e)}")
+            logger.error(f"Failed to start server: {str(e)}")
             self.is_running = False
             return False
     
@@ -173,8 +248,11 @@ class ServerConnection:
                 client_socket, client_address = self.server_socket.accept()
                 client_id = id(client_socket)
                 client_info = self.ClientInfo(client_address, client_id)
+                self.outbound.register(client_socket, client_info.send_lock)
                 self.connected_clients[client_socket] = client_info
-                print(f"New connection from {client_address}")
+                self.metrics.increment("connections_total")
+                log_event(logger, logging.INFO, "connection_opened", address=client_address)
+                self._schedule_heartbeat(client_socket, client_info, self.handshake_timeout)
                 
                 # Start client handler thread
                 threading.Thread(target=self.handle_client, 
@@ -182,7 +260,7 @@ class ServerConnection:
                                daemon=True).start()
             except Exception as e:
                 if self.is_running:
-                    print(f"Error accepting connection: {str(e)}")
+                    logger.error(f"Error accepting connection: {str(e)}")
                     time.sleep(1)  # Prevent tight loop on error
     
     def handle_client(self, client_socket):
@@ -196,38 +274,52 @@ class ServerConnection:
                 data = self.receive_from_client(client_socket)
                 if not data:
                     break
+                client_info.last_activity = time.time()
                 
                 if not client_info.session_established:
                     # Handle secure connection establishment
                     if not self._handle_security_handshake(client_socket, data):
                         break
                     else:
-                        print(f"Security handshake completed with {client_info.address}")
+                        log_event(logger, logging.DEBUG, "handshake_step", address=client_info.address)
                 else:
                     # Process the message based on its type
                     message_type = data.get('type')
-                    print(f"Received message type: {message_type} from {client_info.address}")
                     
-                    if message_type in self.handlers:
-                        # Process the request
-                        response = self.process_request(message_type, client_socket, data.get('data', {}))
-                        # Send response back to client
-                        self.send_to_client(client_socket, response)
-                    else:
-                        print(f"Unknown message type: {message_type}")
-                        response = {
-                            "type": "error_response",
-                            "data": {
-                                "success": False,
-                                "message": f"Unknown message type: {message_type}"
-                            }
-                        }
-                        self.send_to_client(client_socket, response)
-
-                client_info.last_activity = time.time()
+                    if message_type == "pong":
+                        continue  # Answer to our ping, last_activity already says it's alive
+                    if message_type == "ping":
+                        self.send_to_client(client_socket, {
+                            "type": "pong",
+                            "data": {"success": True},
+                            "request_id": data.get('request_id')
+                        })
+                        continue
+                    client_info.last_request = client_info.last_activity
+                    if message_type == "attachment_chunk":
+                        # Upload data, answered only once the upload is finished
+                        if self.chunk_callback:
+                            self.chunk_callback(client_socket, data['data'])
+                        continue
+                    
+                    if message_type not in self.handlers:
+                        log_event(logger, logging.WARNING, "unknown_request_type",
+                                  type=message_type, address=client_info.address)
+                    
+                    # Process the request (unknown types get an error response)
+                    response = self.process_request(
+                        message_type, client_socket, data.get('data', {}), data.get('request_id')
+                    )
+                    # Send response back to client
+                    start = time.perf_counter()
+                    self.send_to_client(client_socket, response)
+                    self.metrics.observe("request_send_seconds", self._metric_label(message_type),
+                                         time.perf_counter() - start)
                 
         except Exception as e:
-            print(f"Error handling client {client_info.address}: {str(e)}")
+            # Clients hanging up is routine, anything else is worth a look
+            level = logging.DEBUG if isinstance(e, ConnectionError) else logging.WARNING
+            log_event(logger, level, "client_error", address=client_info.address, error=str(e))
         finally:
             self.close_connection(client_socket)
 
@@ -236,10 +328,10 @@ class ServerConnection:
         client_info = self.connected_clients[client_socket]
         try:
             if not isinstance(data, dict):
-                print(f"Invalid data format received: {data}")
+                log_event(logger, logging.WARNING, "invalid_handshake_data", data=data)
                 return False
 
-            print(f"Processing handshake data: {data}")  # Debug print
+            log_event(logger, logging.DEBUG, "handshake_data", data=data)
             
             msg_type = data.get('type', '')
             msg_data = data.get('data', {})
@@ -247,6 +339,15 @@ class ServerConnection:
             if msg_type == "key_exchange":
                 # Receive client's public key and send server's
                 client_info.public_key = msg_data.get("client_public_key", "").encode()
+                
+                # Pick the wire encoding for after the handshake; clients that
+                # don't offer any stay on JSON
+                client_info.pending_encoding = negotiate_encoding(
+                    msg_data.get("encodings"), self.encodings
+                )
+                client_info.pending_compression = negotiate_compression(
+                    msg_data.get("compression"), self.compressions
+                )
                 response = {
                     "type": "key_exchange",
                     "data": {
@@ -262,105 +363,235 @@ class ServerConnection:
                 session_key = self.encryption.decrypt_session_key(encrypted_key)
                 self.encryption.store_client_session_key(client_info.client_id, session_key)
                 
-                # Confirm session establishment
+                # Confirm session establishment and announce the wire format
+                encoding = client_info.pending_encoding
+                compression = client_info.pending_compression
                 response = {
                     "type": "session_confirmed",
-                    "data": {}
+                    "data": {
+                        "encoding": encoding,
+                        "compression": compression,
+                        "compression_threshold": self.compression_threshold
+                    }
                 }
                 self.send_to_client(client_socket, response)
                 
+                # Every frame after the confirmation uses the negotiated format
+                client_info.codec = MessageCodec(
+                    encoding,
+                    compression=compression,
+                    compression_threshold=self.compression_threshold,
+                    stats=self.compression_stats,
+                    max_frame_size=self.max_frame_size
+                )
                 client_info.session_established = True
-                print(f"Secure session established with {client_info.address}")
+                log_event(logger, logging.INFO, "session_established", address=client_info.address,
+                          encoding=encoding, compression=compression)
                 return True
                 
         except Exception as e:
-            print(f"Security handshake failed: {str(e)}")
+            log_event(logger, logging.WARNING, "handshake_failed", address=client_info.address, error=str(e))
             return False
         
         return True
     
+    def _get_codec(self, client_socket):
+        """Return the codec negotiated with a client (JSON by default)."""
+        client_info = self.connected_clients.get(client_socket)
+        if client_info:
+            return client_info.codec
+        return MessageCodec()
+
     def send_to_client(self, client_socket, data):
         """Send data to a specific client with message framing."""
         try:
-            # Convert response to JSON string
-            json_data = json.dumps(data)
-            
-            # Create frame with message length prefix and delimiter
-            frame = f"{len(json_data)}::{json_data}"
+            # Serialize with the client's encoding and add the length prefix
+            client_info = self.connected_clients.get(client_socket)
+            codec = client_info.codec if client_info else MessageCodec()
+            frame = codec.build_frame(data)
             
-            # Send the framed message
-            client_socket.sendall(frame.encode())
+            # Send the framed message; responses, broadcasts and pings come
+            # from different threads, so one frame at a time per socket
+            if client_info:
+                with client_info.send_lock:
+                    client_socket.sendall(frame)
+            else:
+                client_socket.sendall(frame)
         except Exception as e:
-            print(f"Error sending to client: {str(e)}")
+            log_event(logger, logging.INFO, "send_failed", error=str(e))
             raise
 
+    def send_file_frame(self, client_socket, transfer_id, file, offset, count):
+        """
+        Send count bytes of a file from offset as an attachment chunk frame.
+
+        The bytes go from the page cache to the socket with sendfile where
+        the OS has it, never passing through Python. Other frames for the
+        client wait for one chunk at most.
+        """
+        client_info = self.connected_clients.get(client_socket)
+        if client_info is None:
+            raise ConnectionError("Client disconnected")
+        with client_info.send_lock:
+            client_socket.sendall(build_chunk_header(transfer_id, offset, count))
+            client_socket.sendfile(file, offset, count)
+
     def receive_from_client(self, client_socket):
         """Receive framed data from a client."""
         try:
             if client_socket not in self.receive_buffers:
-                self.receive_buffers[client_socket] = ""
+                self.receive_buffers[client_socket] = bytearray()
             
             buffer = self.receive_buffers[client_socket]
             
             while True:
-                # Read more data if needed
-                if '::' not in buffer:
-                    data = client_socket.recv(4096).decode()
-                    if not data:
-                        raise ConnectionError("Client disconnected")
-                    buffer += data
-                
                 # Process framed message
-                if '::' in buffer:
-                    length_str, rest = buffer.split('::', 1)
+                try:
+                    frame = extract_frame(buffer, self.max_frame_size)
+                except FrameTooLargeError:
+                    # Not worth reading to resync; the connection goes
+                    raise
+                except ValueError:
+                    # Invalid length prefix, clear buffer and try again
+                    buffer.clear()
+                    frame = None
+                
+                if frame is not None:
                     try:
-                        length = int(length_str)
-                    except ValueError:
-                        # Invalid length prefix, clear buffer and try again
-                        buffer = ""
-                        continue
-                    
-                    # Check if we have a complete message
-                    if len(rest) >= length:
-                        message = rest[:length]
-                        buffer = rest[length:]  # Keep remaining data
-                        self.receive_buffers[client_socket] = buffer
-                        
-                        try:
-                            return json.loads(message)
-                        except json.JSONDecodeError as e:
-                            print(f"Invalid JSON received: {str(e)}")
-                            raise
-                    
-                    # Need more data for complete message
-                    continue
+                        return self._get_codec(client_socket).decode_frame(frame)
+                    except Exception as e:
+                        log_event(logger, logging.WARNING, "invalid_message", error=str(e))
+                        raise
                 
                 # No complete message yet, read more
-                data = client_socket.recv(4096).decode()
+                try:
+                    data = client_socket.recv(4096)
+                except BlockingIOError:
+                    # The outbound writer made the socket non-blocking for a
+                    # send (where there's no MSG_DONTWAIT); wait for data instead
+                    select.select([client_socket], [], [])
+                    continue
                 if not data:
                     raise ConnectionError("Client disconnected")
                 buffer += data
                 
         except Exception as e:
-            print(f"Error receiving from client: {str(e)}")
+            log_event(logger, logging.DEBUG, "receive_failed", error=str(e))
             raise
         
+    def _schedule_heartbeat(self, client_socket, client_info, delay):
+        client_info.heartbeat_timer = self.timer_wheel.schedule(delay, self._check_heartbeat, client_socket)
+
+    def _check_heartbeat(self, client_socket):
+        """
+        Heartbeat timer callback, runs on the timer wheel's thread.
+
+        Every connection has exactly one pending timer. When it fires we look
+        at what happened since: recent traffic just pushes the next check
+        out, a full quiet interval gets a ping, and no frame at all by the
+        time the pong is due means the peer is gone.
+        """
+        client_info = self.connected_clients.get(client_socket)
+        if client_info is None:
+            return  # Already closed
+        now = time.time()
+
+        if not client_info.session_established:
+            self._reap(client_socket, client_info, "handshake")
+            return
+        if self.idle_timeout and now - client_info.last_request >= self.idle_timeout:
+            self._reap(client_socket, client_info, "idle")
+            return
+        if client_info.ping_sent_at is not None:
+            if client_info.last_activity < client_info.ping_sent_at:
+                self._reap(client_socket, client_info, "unresponsive")
+                return
+            client_info.ping_sent_at = None
+
+        quiet = now - client_info.last_activity
+        if quiet < self.ping_interval:
+            self._schedule_heartbeat(client_socket, client_info, self.ping_interval - quiet)
+            return
+
+        # Set before sending so a fast pong can't look older than the ping
+        client_info.ping_sent_at = now
+        if self._send_ping(client_socket, client_info):
+            self.metrics.increment("pings_sent_total")
+        else:
+            client_info.ping_sent_at = None
+            if not self._is_writable(client_socket):
+                # The client has stopped reading and its receive window is full
+                self._reap(client_socket, client_info, "unresponsive")
+                return
+        self._schedule_heartbeat(client_socket, client_info, self.pong_timeout)
+
+    def _send_ping(self, client_socket, client_info):
+        """Send a ping without ever blocking the timer thread; returns False if it wasn't sent."""
+        return self._send_without_blocking(client_socket, client_info, {"type": "ping", "data": {}})
+
+    def _send_without_blocking(self, client_socket, client_info, data):
+        # Another thread mid-send means the socket is busy, not dead; try again later
+        if not client_info.send_lock.acquire(blocking=False):
+            return False
+        try:
+            # A small frame always fits once the socket is writable
+            if not self._is_writable(client_socket):
+                return False
+            client_socket.sendall(client_info.codec.build_frame(data))
+            return True
+        except OSError:
+            return False
+        finally:
+            client_info.send_lock.release()
+
+    def _is_writable(self, client_socket):
+        try:
+            if hasattr(select, "poll"):
+                poller = select.poll()
+                poller.register(client_socket, select.POLLOUT)
+                return bool(poller.poll(0))
+            return bool(select.select([], [client_socket], [], 0)[1])
+        except (OSError, ValueError):
+            return False
+
+    def _reap(self, client_socket, client_info, reason):
+        """Close a dead or idle connection from outside its handler thread."""
+        log_event(logger, logging.INFO, "connection_reaped", address=client_info.address, reason=reason)
+        self.metrics.increment("connections_reaped_total", reason)
+        try:
+            # Wakes the handler thread's recv(); it then cleans up via close_connection
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            self.close_connection(client_socket)
+
     def close_connection(self, client_socket):
         """Close a specific client connection."""
         try:
             client_info = self.connected_clients.get(client_socket)
             if client_info:
-                print(f"Closing connection from {client_info.address}")
+                log_event(logger, logging.INFO, "connection_closed", address=client_info.address)
+                if client_info.heartbeat_timer:
+                    client_info.heartbeat_timer.cancel()
                 if client_socket in self.receive_buffers:
                     del self.receive_buffers[client_socket]
-                del self.connected_clients[client_socket]
+                with self.users_lock:
+                    self._unbind_user(client_socket, client_info)
+                    del self.connected_clients[client_socket]
+                self.outbound.discard(client_socket)
+                if self.close_callback:
+                    self.close_callback(client_socket)
             client_socket.close()
         except Exception as e:
-            print(f"Error closing connection: {str(e)}")
+            logger.error(f"Error closing connection: {str(e)}")
     
     def stop_server(self):
         """Stop the server and close all connections."""
         self.is_running = False
+        if self.scheduler:
+            self.scheduler.cancel("heartbeats")
+        else:
+            self.timer_wheel.stop()
+        self.outbound.stop()
         
         # Close all client connections
         for client_socket in list(self.connected_clients.keys()):
@@ -368,6 +599,11 @@ class ServerConnection:
         
         # Close server socket
         if self.server_socket:
+            try:
+                # Wakes the accept thread; close() alone leaves it blocked on Linux
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             try:
                 self.server_socket.close()
             except:
@@ -377,16 +613,78 @@ class ServerConnection:
         if self.accept_thread:
             self.accept_thread.join(timeout=2.0)
         
-        print("Server stopped.")
+        logger.info("Server stopped.")
 
-    def broadcast_to_users(self, user_ids, message):
-        """Broadcast a message to specific users."""
-        for client_socket, client_info in self.connected_clients.items():
-            if client_info.user_id in user_ids:
-                try:
-                    self.send_to_client(client_socket, message)
-                except Exception as e:
-                    print(f"Error broadcasting to user {client_info.user_id}: {e}")
+    def bind_user(self, client_socket, user_id):
+        """Record which user is logged in on a connection, so broadcasts can find it."""
+        client_info = self.connected_clients.get(client_socket)
+        if client_info is None or client_info.user_id == user_id:
+            return
+        with self.users_lock:
+            if client_socket not in self.connected_clients:
+                return  # Closed in the meantime
+            self._unbind_user(client_socket, client_info)
+            client_info.user_id = user_id
+            sockets = self.clients_by_user.setdefault(user_id, set())
+            sockets.add(client_socket)
+            if len(sockets) == 1 and self.presence_callback:
+                self.presence_callback(user_id, True)
+
+    def _unbind_user(self, client_socket, client_info):
+        # Callers hold users_lock
+        sockets = self.clients_by_user.get(client_info.user_id)
+        if sockets is not None:
+            sockets.discard(client_socket)
+            if not sockets:
+                del self.clients_by_user[client_info.user_id]
+                if self.presence_callback:
+                    self.presence_callback(client_info.user_id, False)
+        client_info.user_id = None
+
+    def broadcast_to_users(self, user_ids, message, exclude_client=None):
+        """
+        Broadcast a message to every connection of the given users.
+
+        Args:
+            user_ids: Recipients
+            message: Message to send
+            exclude_client: client_id of a connection to leave out, e.g. the sender's
+
+        Returns:
+            int: Number of connections the message was queued for
+        """
+        return self.send_to_clients(self.connections_of(user_ids, exclude_client), message)
+
+    def connections_of(self, user_ids, exclude_client=None):
+        """Every connection the given users are logged in on, except the one whose client_id is exclude_client."""
+        with self.users_lock:
+            return [client_socket for user_id in user_ids
+                    for client_socket in self.clients_by_user.get(user_id, ())
+                    if id(client_socket) != exclude_client]  # client_id is id(socket)
+
+    def send_to_clients(self, targets, message):
+        """
+        Queue a message for each of the given connections; returns how many it was queued for.
+
+        Never blocks: the outbound writer sends the frames, in the order they
+        were queued, as each connection can take them. A connection whose
+        queue is full has stopped reading and is closed.
+        """
+        queued = 0
+        for client_socket in targets:
+            client_info = self.connected_clients.get(client_socket)
+            if client_info is None:
+                continue  # Closed meanwhile
+            try:
+                if self.outbound.queue(client_socket, client_info.codec.build_frame(message)):
+                    queued += 1
+                else:
+                    self._reap(client_socket, client_info, "slow_consumer")
+            except ConnectionError:
+                pass
+            except Exception as e:
+                logger.error(f"Error broadcasting to client: {e}")
+        return queued
 
 # Test Cases
 if __name__ == "__main__":
@@ -0,0 +1,194 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+ROOT_LOGGER = "intechat"
+
+DEFAULT_SETTINGS = {
+    "level": "INFO",  # Level written to the log file
+    "console_level": "INFO",  # Level echoed to stdout; "OFF" disables the console
+    "directory": None,  # Defaults to Server/logs
+    "filename": "server.log",
+    "max_bytes": 10 * 1024 * 1024,
+    "backup_count": 5,
+    "sampling": {}  # {event: fraction of DEBUG/INFO records to keep}
+}
+
+# Values under these keys never reach a log, at any level
+SENSITIVE_KEYS = {"password", "token", "session_token", "encrypted_session_key"}
+MAX_LOGGED_ITEMS = 5  # Lists longer than this (e.g. chat histories) are summarized
+MAX_LOGGED_CHARS = 200
+
+_sample_rates = {}
+_listener = None
+_handlers = []  # Handlers doing the file and console I/O, on the listener or called directly
+
+
+def get_logger(name):
+    """Return the logger for one server component, e.g. get_logger("comm")."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def redact(value):
+    """
+    Return a copy of value that is safe to log.
+
+    Credentials are masked, long lists are replaced by their length and
+    long strings are cut, so a log line stays small whatever the request.
+    """
+    if isinstance(value, dict):
+        return {key: "***" if key in SENSITIVE_KEYS else redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if len(value) > MAX_LOGGED_ITEMS:
+            return f"<{len(value)} items>"
+        return [redact(item) for item in value]
+    if isinstance(value, str) and len(value) > MAX_LOGGED_CHARS:
+        return value[:MAX_LOGGED_CHARS] + f"...<{len(value)} chars>"
+    if isinstance(value, bytes):
+        return f"<{len(value)} bytes>"
+    return value
+
+
+def log_event(logger, level, event, **fields):
+    """
+    Log a structured event.
+
+    Nothing is built unless the level is enabled, and DEBUG/INFO events
+    with a sampling rate configured are dropped before any work is done,
+    which keeps per-request logging cheap on hot paths. Fields are redacted
+    on the calling thread, since the record is formatted later on the
+    listener thread and the caller may mutate its dicts in between.
+
+    Args:
+        logger: Logger from get_logger()
+        level: logging level, e.g. logging.DEBUG
+        event: Short event name, also the key for sampling
+        **fields: Structured data to attach to the record
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate = _sample_rates.get(event)
+    if rate is not None and level < logging.WARNING and random.random() >= rate:
+        return
+    logger.log(level, event, extra={"fields": redact(fields)})
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Readable one-line format for the terminal."""
+
+    def format(self, record):
+        line = f"[{record.levelname}] {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+def setup_logging(settings=None, background=True):
+    """
+    Configure server logging from the "logging" section of config.json.
+
+    Loggers only put records on an in-memory queue; a background listener
+    thread formats them and does the file and console I/O, so request
+    threads never block on disk or terminal writes.
+
+    Args:
+        settings: The "logging" section of config.json
+        background: False writes records on the logging thread instead,
+            for processes that fork and so must not run other threads
+
+    Returns:
+        The root server logger
+    """
+    global _listener, _handlers, _sample_rates
+
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    directory = settings["directory"] or os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+    os.makedirs(directory, exist_ok=True)
+
+    file_handler = RotatingFileHandler(
+        os.path.join(directory, settings["filename"]),
+        maxBytes=settings["max_bytes"],
+        backupCount=settings["backup_count"],
+        encoding="utf-8"
+    )
+    file_handler.setLevel(settings["level"])
+    file_handler.setFormatter(StructuredFormatter())
+    handlers = [file_handler]
+    levels = [file_handler.level]
+
+    if str(settings["console_level"]).upper() != "OFF":
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(settings["console_level"])
+        console_handler.setFormatter(ConsoleFormatter())
+        handlers.append(console_handler)
+        levels.append(console_handler.level)
+
+    shutdown_logging()
+    _sample_rates = dict(settings["sampling"])
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    # Gate at the most verbose handler so disabled levels cost one comparison
+    logger.setLevel(min(levels))
+    logger.propagate = False
+    _handlers = handlers
+    if not background:
+        for handler in handlers:
+            logger.addHandler(handler)
+        return logger
+    logger.addHandler(QueueHandler(queue.SimpleQueue()))
+
+    _listener = QueueListener(logger.handlers[0].queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return logger
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener, _handlers
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    for handler in _handlers:
+        handler.close()
+    _handlers = []
+
+
+def reset_logging_after_fork():
+    """
+    In a forked child, forget the parent's logging without flushing or
+    closing any of it: its listener thread didn't survive the fork, and
+    its buffers belong to the parent. Call setup_logging() afterwards.
+    """
+    global _listener, _handlers
+    _listener = None
+    _handlers = []
+    logger = logging.getLogger(ROOT_LOGGER)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+
+atexit.register(shutdown_logging)
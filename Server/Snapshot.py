@@ -0,0 +1,199 @@
+"""
+Backups and NDJSON snapshots of the chat database.
+
+Backups copy the database files while the server keeps running (an admin
+starts one with the backup request). Snapshots stream users, chats and
+messages to and from newline-delimited JSON, one record per line, in
+constant memory however big the database is:
+
+    python Server/Snapshot.py export snapshot.ndjson
+    python Server/Snapshot.py import snapshot.ndjson   # into an empty database
+"""
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from ServerLog import get_logger
+from Storage import StorageError, create_storage
+
+logger = get_logger("snapshot")
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.json")
+
+
+def export_ndjson(storage, out, batch_size=1000):
+    """
+    Write every user, chat and message to out, one JSON object per line.
+
+    Users come first, then chats with their members, then messages oldest
+    first, which is the order import_ndjson() needs. Password hashes are
+    included so that accounts survive a restore; treat the file like the
+    database itself. Returns {record type: count}.
+    """
+    counts = {"user": 0, "chat": 0, "message": 0}
+    for user in storage.iter_users(batch_size):
+        password_hash = user["password_hash"]
+        if isinstance(password_hash, bytes):
+            password_hash = password_hash.decode("ascii")
+        out.write(json.dumps({"type": "user", "user_id": user["user_id"], "username": user["username"],
+                              "password_hash": password_hash, "created_at": user["created_at"]},
+                             ensure_ascii=False) + "\n")
+        counts["user"] += 1
+    for chat in storage.iter_chats(batch_size):
+        out.write(json.dumps({"type": "chat", **chat}, ensure_ascii=False) + "\n")
+        counts["chat"] += 1
+    for message_id, chat_id, sender_id, message_content, timestamp in storage.iter_messages(batch_size):
+        out.write(json.dumps({"type": "message", "message_id": message_id, "chat_id": chat_id,
+                              "sender_id": sender_id, "message_content": message_content,
+                              "timestamp": str(timestamp)}, ensure_ascii=False) + "\n")
+        counts["message"] += 1
+    return counts
+
+
+def import_ndjson(storage, lines, batch_size=1000):
+    """
+    Load an export_ndjson() file into an empty storage engine, keeping ids.
+
+    Records are stored in batches of batch_size as they are read. Returns
+    {record type: count}.
+    """
+    if next(iter(storage.iter_users(1)), None) is not None:
+        raise StorageError("Snapshots can only be imported into an empty database")
+    importers = {
+        "user": storage.import_users,
+        "chat": storage.import_chats,
+        "message": lambda records: storage.import_messages([
+            (record["message_id"], record["chat_id"], record["sender_id"],
+             record["message_content"], record["timestamp"])
+            for record in records
+        ])
+    }
+    counts = {record_type: 0 for record_type in importers}
+    records = (json.loads(line) for line in lines if line.strip())
+    # Consecutive records of one type go in together, batch_size at a time
+    for record_type, group in itertools.groupby(records, key=lambda record: record.get("type")):
+        if record_type not in importers:
+            raise StorageError(f"Unknown record type in snapshot: {record_type}")
+        for batch in iter(lambda: list(itertools.islice(group, batch_size)), []):
+            importers[record_type](batch)
+            counts[record_type] += len(batch)
+    return counts
+
+
+class BackupJob:
+    """
+    Runs Storage.backup() on a background thread, one backup at a time.
+
+    Each backup goes to a new directory named after its start time (UTC)
+    under the configured backup directory.
+    """
+
+    def __init__(self, storage, directory, pages=256, pause=0.01):
+        """
+        Args:
+            storage: Storage engine to back up
+            directory: Where the backup directories are created
+            pages: Database pages copied per backup step
+            pause: Seconds to sleep between steps
+        """
+        self.storage = storage
+        self.directory = directory
+        self.pages = pages
+        self.pause = pause
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running_path = None
+        self.last_path = None
+        self.last_error = None
+        self.last_seconds = None
+        self.completed = 0
+
+    @classmethod
+    def from_config(cls, storage, config, db_path):
+        """Build from the "backup" section of config.json; backups default to a backups/ directory by db_path."""
+        settings = config.get("backup") or {}
+        directory = settings.get("directory") or os.path.join(os.path.dirname(os.path.abspath(db_path)), "backups")
+        return cls(storage, directory, settings.get("pages_per_step", 256), settings.get("pause", 0.01))
+
+    def start(self):
+        """
+        Start a backup unless one is running, or the engine has nothing to back up.
+
+        Returns:
+            (success, result): the backup directory, or why none was started
+        """
+        if not self.storage.can_backup:
+            return False, "This storage engine keeps nothing on disk to back up"
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False, f"A backup to {self.running_path} is already running"
+            path = os.path.join(self.directory, time.strftime("%Y%m%d-%H%M%S", time.gmtime()))
+            if os.path.exists(path):
+                return False, f"{path} already exists"
+            self.running_path = path
+            self.thread = threading.Thread(target=self._run, args=(path,), name="backup", daemon=True)
+            self.thread.start()
+            return True, path
+
+    def _run(self, path):
+        start = time.perf_counter()
+        try:
+            files = self.storage.backup(path, self.pages, self.pause)
+            self.last_path, self.last_error = path, None
+            self.completed += 1
+            logger.info(f"Backup to {path} finished: {len(files)} files")
+        except (StorageError, OSError) as e:
+            self.last_error = str(e)
+            logger.error(f"Backup to {path} failed: {e}")
+        finally:
+            self.last_seconds = round(time.perf_counter() - start, 3)
+            self.running_path = None
+
+    def snapshot(self):
+        return {
+            "running": self.running_path,
+            "completed": self.completed,
+            "last_path": self.last_path,
+            "last_seconds": self.last_seconds,
+            "last_error": self.last_error
+        }
+
+
+def main():
+    import argparse
+    from UserManager import DEFAULT_DB_PATH
+    parser = argparse.ArgumentParser(description="Export or import an NDJSON snapshot of the chat database")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("path", help="snapshot file, or - for stdout/stdin")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH, help="path to config.json (defaults to the repository's)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="records read or written per batch")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    storage = create_storage(config.get("storage"), config.get("database_path") or DEFAULT_DB_PATH)
+    try:
+        if args.action == "export":
+            if args.path == "-":
+                counts = export_ndjson(storage, sys.stdout, args.batch_size)
+            else:
+                with open(args.path, "w", encoding="utf-8") as out:
+                    counts = export_ndjson(storage, out, args.batch_size)
+        elif args.path == "-":
+            counts = import_ndjson(storage, sys.stdin, args.batch_size)
+        else:
+            with open(args.path, "r", encoding="utf-8") as lines:
+                counts = import_ndjson(storage, lines, args.batch_size)
+    except StorageError as e:
+        print(f"{args.action.capitalize()} failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        storage.close()
+    print(f"{args.action.capitalize()}ed {counts['user']} users, {counts['chat']} chats, "
+          f"{counts['message']} messages", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1411 @@
+import bisect
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from MessageArchive import MessageArchive
+from MessageLog import MessageLog
+from MessageShards import MessageShards
+from Metrics import query_timer
+from ServerLog import get_logger
+
+logger = get_logger("storage")
+
+MAX_MESSAGE_ID = 2**63 - 1  # SQLite's largest integer, used for "no before_id"
+
+
+def create_storage(settings, db_path, session_ttl=24 * 3600):
+    """
+    Build the storage engine configured in the "storage" section of config.json.
+
+    {"engine": "sqlite"} (the default) keeps everything in the database at
+    db_path, with messages optionally split over "message_shards" files or,
+    with "message_store": "log", appended to a MessageLog configured by
+    "message_log"; {"engine": "memory"} keeps everything in this process
+    until it exits.
+    """
+    settings = settings or {}
+    engine = settings.get("engine", "sqlite")
+    if engine == "memory":
+        return MemoryStorage()
+    if engine != "sqlite":
+        raise ValueError(f"Unknown storage engine: {engine}")
+    return SQLiteStorage(db_path, message_shards=settings.get("message_shards", 0), session_ttl=session_ttl,
+                         message_store=settings.get("message_store", "sqlite"),
+                         message_log=settings.get("message_log"))
+
+
+def utc_timestamp():
+    """The current time the way SQLite's CURRENT_TIMESTAMP writes it."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+class StorageError(Exception):
+    """A storage engine failed to read or write; the message says why."""
+
+
+class Storage:
+    """
+    Where UserManager keeps users, sessions, chats, membership and messages.
+
+    Engines only store and look up records; validation, password hashing,
+    session expiry rules and caching stay in UserManager. Records come
+    back as mappings indexed by column name (dicts, or sqlite3.Row).
+    Failures raise StorageError. Every method may be called from any
+    client handler thread.
+    """
+
+    # Whether backup() has files to copy; BackupJob checks it before starting
+    can_backup = False
+
+    # Users
+
+    def add_user(self, username, password_hash):
+        """Create a user; returns the new user_id, or None if the username is taken (case insensitive)."""
+        raise NotImplementedError
+
+    def get_user(self, user_id):
+        """{user_id, username, created_at} of a user, or None."""
+        raise NotImplementedError
+
+    def get_user_by_username(self, username):
+        """{user_id, username, created_at} of a user matched case insensitively, or None."""
+        raise NotImplementedError
+
+    def get_credentials(self, username):
+        """{user_id, username, password_hash} of a user matched case insensitively, or None."""
+        raise NotImplementedError
+
+    def list_usernames(self):
+        """Every username, as registered."""
+        raise NotImplementedError
+
+    # Sessions
+
+    def add_session(self, session_id, user_id, expires_at):
+        raise NotImplementedError
+
+    def get_session(self, session_id):
+        """{user_id, expires_at} of a session, or None."""
+        raise NotImplementedError
+
+    def renew_sessions(self, renewals):
+        """Move sessions' expiry forward: {session_id: expires_at}, never backwards."""
+        raise NotImplementedError
+
+    def delete_expired_sessions(self, now, chunk_size=500):
+        """Remove sessions that expired by now; returns how many were removed."""
+        raise NotImplementedError
+
+    # Chats and membership
+
+    def create_chat(self, chat_type, user_ids):
+        """Create a chat with its members; returns the new chat_id."""
+        raise NotImplementedError
+
+    def find_private_chat(self, user1_id, user2_id):
+        """chat_id of the private chat between exactly these two users, or None."""
+        raise NotImplementedError
+
+    def get_user_chats(self, user_id):
+        """{chat_id, chat_type, created_at} of every chat the user is a member of."""
+        raise NotImplementedError
+
+    def is_member(self, chat_id, user_id):
+        raise NotImplementedError
+
+    def get_chat_members(self, chat_id):
+        """User ids of a chat's members."""
+        raise NotImplementedError
+
+    # Messages
+
+    def add_message(self, chat_id, sender_id, message_content, attachment_id=None, filename=None):
+        """
+        Store a message; returns its message_id, which grows with every message in a chat.
+
+        With attachment_id, the message is stored together with its link to
+        that attachment (under the file name the sender gave it), or not at all.
+
+        Raises:
+            StorageError: If the attachment was never uploaded, or the write fails
+        """
+        raise NotImplementedError
+
+    def get_messages(self, chat_id, limit=50, before_id=None):
+        """
+        A chat's newest messages first, as (message_id, sender_id, message_content, timestamp) tuples;
+        with before_id, the newest of those older than that message (the page before it).
+        """
+        raise NotImplementedError
+
+    # Attachments
+
+    def add_attachment(self, attachment_id, size, uploader_id):
+        """Record that a user uploaded an attachment (named by the SHA-256 of its content); repeats are ignored."""
+        raise NotImplementedError
+
+    def get_attachment(self, attachment_id):
+        """{attachment_id, size, uploader_id, created_at} of an attachment's first upload, or None."""
+        raise NotImplementedError
+
+    def get_message_attachments(self, chat_id, message_ids):
+        """{message_id: {attachment_id, filename, size}} of those of a chat's messages that have an attachment."""
+        raise NotImplementedError
+
+    def can_read_attachment(self, attachment_id, user_id):
+        """Whether the user uploaded the attachment or is in a chat where it was sent."""
+        raise NotImplementedError
+
+    # Retention
+
+    def expire_messages(self, cutoffs, batch_size=500):
+        """
+        Move messages past their retention into the archive, a slice at a time.
+
+        A generator: each step archives and removes up to batch_size
+        messages and yields how many it removed. Nothing stays locked
+        between steps, so the caller may pause or stop after any of them.
+        Engines whose messages don't outlive the process expire nothing.
+
+        Args:
+            cutoffs: {chat_type: timestamp}; messages in chats of that type
+                written before the timestamp expire
+        """
+        return iter(())
+
+    def search_archive(self, chat_id, query, limit=20):
+        """A chat's archived messages matching query, newest first, as (message_id, sender_id, message_content, timestamp) tuples."""
+        return []
+
+    def enable_incremental_vacuum(self):
+        """Make the space of deleted messages returnable by vacuum_step(), rebuilding files once if needed."""
+
+    def vacuum_step(self, pages=256):
+        """Give up to pages free pages of each database file back to the file system; returns how many were freed."""
+        return 0
+
+    # Snapshots
+
+    def iter_users(self, batch_size=1000):
+        """Every user as {user_id, username, password_hash, created_at}, ordered by user_id."""
+        raise NotImplementedError
+
+    def iter_chats(self, batch_size=1000):
+        """Every chat as {chat_id, chat_type, created_at, members: [user_id]}, ordered by chat_id."""
+        raise NotImplementedError
+
+    def iter_messages(self, batch_size=1000):
+        """Every message ordered by message_id, as (message_id, chat_id, sender_id, message_content, timestamp)."""
+        raise NotImplementedError
+
+    def import_users(self, users):
+        """Store users as iter_users() yields them, keeping their ids."""
+        raise NotImplementedError
+
+    def import_chats(self, chats):
+        """Store chats with their members as iter_chats() yields them, keeping their ids."""
+        raise NotImplementedError
+
+    def import_messages(self, rows):
+        """Store messages as iter_messages() yields them, oldest first, keeping their ids."""
+        raise NotImplementedError
+
+    def backup(self, directory, pages=256, pause=0.01):
+        """
+        Copy the stored data into directory while it keeps being used.
+
+        Args:
+            directory: Created if missing; gets a copy of every file
+            pages: Database pages copied per step
+            pause: Seconds to sleep between steps, letting live queries in
+        Returns:
+            Paths written
+        """
+        raise StorageError("This storage engine keeps nothing on disk to back up")
+
+    # Upkeep
+
+    def checkpoint(self):
+        """Flush write-ahead logs; returns (wal_pages, copied_pages)."""
+        return 0, 0
+
+    def close(self):
+        pass
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports time spent executing and fetching to the query timer."""
+
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            query_timer.add(time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            query_timer.add(time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            query_timer.add(time.perf_counter() - start)
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            query_timer.add(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            query_timer.add(time.perf_counter() - start)
+
+
+class ThreadConnection(sqlite3.Connection):
+    """
+    SQLite connection owned by one thread (a subclass so it can be weakly
+    referenced). Its cursors, shortcut executes and commits are timed.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            query_timer.add(time.perf_counter() - start)
+
+
+class SQLiteErrors:
+    """Context manager that turns SQLite errors into StorageError."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and issubclass(exc_type, sqlite3.Error):
+            raise StorageError(str(exc)) from exc
+        return False
+
+
+# A class rather than @contextmanager: it wraps every query, and this is cheaper
+sqlite_errors = SQLiteErrors()
+
+
+class BackupRestarted(Exception):
+    """Raised from BackupProgress to stop a backup that keeps starting over."""
+
+
+class BackupProgress:
+    """Progress callback of sqlite3's backup(): pauses between steps and counts restarts."""
+
+    def __init__(self, pause, max_restarts):
+        self.pause = pause
+        self.max_restarts = max_restarts
+        self.remaining = None
+        self.total = 0
+        self.restarts = 0
+
+    def __call__(self, status, remaining, total):
+        # A step that didn't bring remaining down was a restart
+        if self.remaining is not None and remaining >= self.remaining:
+            self.restarts += 1
+            if self.restarts > self.max_restarts:
+                raise BackupRestarted()
+        self.remaining = remaining
+        self.total = total
+        time.sleep(self.pause)
+
+
+class SQLiteStorage(Storage):
+    """Storage in a SQLite database file, with messages optionally in MessageShards or a MessageLog."""
+
+    can_backup = True
+
+    def __init__(self, db_path, message_shards=0, session_ttl=24 * 3600, message_store="sqlite", message_log=None):
+        """
+        Args:
+            db_path: SQLite file; created with its tables if missing
+            message_shards: Number of SQLite files to spread messages over by
+                chat_id; 0 keeps them in the main database
+            session_ttl: Lifetime given to sessions stored before sessions had an expiry
+            message_store: "sqlite" keeps messages in SQLite tables, "log"
+                appends them to a MessageLog next to the database
+            message_log: MessageLog settings: partitions, segment_bytes, index_interval
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # Every client handler thread gets its own connection: sharing one
+        # sqlite3 connection across threads lets one thread's commit or
+        # rollback cut into another thread's statements
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()  # Closed together in close()
+        self.session_ttl = session_ttl
+        self.archive_path = f"{os.path.splitext(db_path)[0]}.archive.db"
+        self._archive = None  # MessageArchive, opened when first needed
+        self._archive_lock = threading.Lock()
+        self._create_tables()
+        if message_store not in ("sqlite", "log"):
+            raise ValueError(f"Unknown message store: {message_store}")
+        if message_store == "log" and message_shards:
+            raise ValueError("storage.message_shards only applies to the sqlite message store")
+        self.message_shards = self._open_message_shards(message_shards)
+        self.message_log = self._open_message_log(message_store == "log", message_log or {})
+
+    @property
+    def conn(self):
+        """The calling thread's database connection, created on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._create_connection()
+            self._local.conn = conn
+            self._connections.add(conn)
+        return conn
+
+    def _create_connection(self, path=None):
+        """Create a connection to the database, or to the file at path."""
+        try:
+            conn = sqlite3.connect(path or self.db_path, timeout=10.0, factory=ThreadConnection)
+            conn.row_factory = sqlite3.Row  # This enables name-based access to columns
+            # Lets vacuum_step() hand deleted messages' pages back; it only
+            # takes effect on a new file, and has to come before WAL is set
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            # WAL lets readers in other threads proceed while one thread writes
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            return conn
+        except sqlite3.Error as e:
+            logger.error(f"Error connecting to database: {e}")
+            raise
+
+    @contextmanager
+    def _transaction(self):
+        """A cursor whose writes are committed together, or rolled back on error."""
+        conn = self.conn
+        with sqlite_errors:
+            try:
+                yield conn.cursor()
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
+    def _create_tables(self):
+        """Create necessary database tables if they don't exist."""
+        try:
+            cursor = self.conn.cursor()
+
+            # Users table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # Every username lookup is case-insensitive through LOWER(username)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (LOWER(username))')
+
+            # Sessions table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    user_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    expires_at INTEGER,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+            self._migrate_session_expiry(cursor)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)')
+
+            # Chats table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chats (
+                    chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_type TEXT CHECK(chat_type IN ('private', 'group')) NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Chat members table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_members (
+                    chat_id INTEGER,
+                    user_id INTEGER,
+                    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (chat_id, user_id),
+                    FOREIGN KEY (chat_id) REFERENCES chats (chat_id),
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+
+            # Messages table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER,
+                    sender_id INTEGER,
+                    message_content TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (chat_id) REFERENCES chats (chat_id),
+                    FOREIGN KEY (sender_id) REFERENCES users (user_id)
+                )
+            ''')
+            # Chat history reads one chat's newest messages
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, message_id)')
+
+            # Attachments, by the SHA-256 of their content, and the messages they were sent with.
+            # Links live here whichever store holds the messages, with the chat so access can be checked
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS attachments (
+                    attachment_id TEXT NOT NULL,
+                    uploader_id INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (attachment_id, uploader_id),
+                    FOREIGN KEY (uploader_id) REFERENCES users (user_id)
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS message_attachments (
+                    message_id INTEGER PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    attachment_id TEXT NOT NULL,
+                    filename TEXT NOT NULL
+                )
+            ''')
+            self._migrate_message_attachments(cursor)
+            cursor.execute('''CREATE INDEX IF NOT EXISTS idx_message_attachments_attachment
+                              ON message_attachments (attachment_id, chat_id)''')
+
+            # Storage settings the data on disk depends on, such as the message shard count
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS storage_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error creating tables: {e}")
+            raise
+
+    def _migrate_session_expiry(self, cursor):
+        """Add expires_at to session tables created before it existed."""
+        cursor.execute('PRAGMA table_info(sessions)')
+        if any(column['name'] == 'expires_at' for column in cursor.fetchall()):
+            return
+        cursor.execute('ALTER TABLE sessions ADD COLUMN expires_at INTEGER')
+        cursor.execute(
+            "UPDATE sessions SET expires_at = CAST(strftime('%s', created_at) AS INTEGER) + ?",
+            (self.session_ttl,)
+        )
+
+    def _migrate_message_attachments(self, cursor):
+        """
+        Drop the foreign key message_attachments was first created with: it
+        named attachments.attachment_id, which isn't unique (one row per
+        uploader), so SQLite would reject every link if foreign keys were on.
+        """
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'message_attachments'")
+        if 'REFERENCES attachments' not in cursor.fetchone()['sql']:
+            return
+        cursor.execute('ALTER TABLE message_attachments RENAME TO message_attachments_old')
+        cursor.execute('''
+            CREATE TABLE message_attachments (
+                message_id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                attachment_id TEXT NOT NULL,
+                filename TEXT NOT NULL
+            )
+        ''')
+        cursor.execute('''INSERT INTO message_attachments (message_id, chat_id, attachment_id, filename)
+                          SELECT message_id, chat_id, attachment_id, filename FROM message_attachments_old''')
+        cursor.execute('DROP TABLE message_attachments_old')
+
+    def _open_message_shards(self, count, batch_size=5000):
+        """
+        Open the message shard files, moving messages out of the main
+        database the first time sharding is turned on.
+
+        Returns:
+            MessageShards, or None when messages stay in the main database
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT key, value FROM storage_meta WHERE key IN ('message_shards', 'message_id_floor')")
+        meta = {row['key']: int(row['value']) for row in cursor.fetchall()}
+        stored = meta.get('message_shards', 0)
+        if stored and stored != count:
+            # Messages would be looked for in the wrong files
+            raise ValueError(f"Messages are stored in {stored} shards, "
+                             f"storage.message_shards can't be changed to {count}")
+        if not count:
+            return None
+        if stored:
+            id_floor = max(meta.get('message_id_floor', 0), self._archived_id_floor())
+            return MessageShards(self.db_path, count, self._create_connection, id_floor)
+
+        id_floor = self._message_id_floor(cursor)
+        shards = MessageShards(self.db_path, count, self._create_connection, id_floor)
+        moved = self._move_messages(cursor, shards.insert_rows, batch_size)
+        try:
+            cursor.executemany('INSERT OR REPLACE INTO storage_meta (key, value) VALUES (?, ?)',
+                               [('message_shards', str(count)), ('message_id_floor', str(id_floor))])
+            cursor.execute('DELETE FROM messages')
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        logger.info(f"Moved {moved} messages into {count} shard files")
+        return shards
+
+    def _message_id_floor(self, cursor):
+        """The highest message id the main database ever handed out; new ids must stay above it."""
+        cursor.execute('''
+            SELECT MAX(COALESCE((SELECT MAX(message_id) FROM messages), 0),
+                       COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0))
+        ''')
+        return cursor.fetchone()[0]
+
+    def _archived_id_floor(self):
+        """The highest message id ever archived; new ids stay above it even if a store lost track of it."""
+        if not os.path.exists(self.archive_path):
+            return 0
+        return self.archive.last_id()
+
+    def _move_messages(self, cursor, insert_rows, batch_size):
+        """Pass the main database's messages to insert_rows() in batches, oldest first; returns how many."""
+        moved = last_id = 0
+        while True:
+            cursor.execute('''
+                SELECT message_id, chat_id, sender_id, message_content, timestamp
+                FROM messages WHERE message_id > ? ORDER BY message_id LIMIT ?
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return moved
+            insert_rows(rows)
+            moved += len(rows)
+            last_id = rows[-1]['message_id']
+
+    def _open_message_log(self, enabled, settings, batch_size=5000):
+        """
+        Open the message log, moving messages out of the main database the
+        first time the log store is turned on.
+
+        Returns:
+            MessageLog, or None when messages stay in SQLite
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT key, value FROM storage_meta WHERE key IN ('message_store', 'message_id_floor')")
+        meta = {row['key']: row['value'] for row in cursor.fetchall()}
+        stored = meta.get('message_store') == 'log'
+        if stored and not enabled:
+            # The main database no longer holds the messages
+            raise ValueError('Messages are stored in the message log, '
+                             'storage.message_store can\'t be changed back to "sqlite"')
+        if not enabled:
+            return None
+        root = os.path.splitext(self.db_path)[0]
+        log_settings = {key: settings[key] for key in ("partitions", "segment_bytes", "index_interval")
+                        if key in settings}
+        if stored:
+            id_floor = max(int(meta.get('message_id_floor', 0)), self._archived_id_floor())
+            return MessageLog(f"{root}.messagelog", id_floor=id_floor, **log_settings)
+
+        id_floor = self._message_id_floor(cursor)
+        message_log = MessageLog(f"{root}.messagelog", id_floor=id_floor, **log_settings)
+        moved = self._move_messages(cursor, message_log.copy_in, batch_size)
+        try:
+            cursor.executemany('INSERT OR REPLACE INTO storage_meta (key, value) VALUES (?, ?)',
+                               [('message_store', 'log'), ('message_id_floor', str(id_floor))])
+            cursor.execute('DELETE FROM messages')
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            message_log.close()
+            raise
+        logger.info(f"Moved {moved} messages into the message log")
+        return message_log
+
+    def add_user(self, username, password_hash):
+        with self._transaction() as cursor:
+            cursor.execute('SELECT 1 FROM users WHERE LOWER(username) = LOWER(?)', (username,))
+            if cursor.fetchone():
+                return None
+            # Stored with its original case
+            cursor.execute(
+                'INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                (username, password_hash)
+            )
+            return cursor.lastrowid
+
+    def get_user(self, user_id):
+        with sqlite_errors:
+            return self.conn.execute(
+                'SELECT user_id, username, created_at FROM users WHERE user_id = ?',
+                (user_id,)
+            ).fetchone()
+
+    def get_user_by_username(self, username):
+        with sqlite_errors:
+            return self.conn.execute(
+                'SELECT user_id, username, created_at FROM users WHERE LOWER(username) = LOWER(?)',
+                (username,)
+            ).fetchone()
+
+    def get_credentials(self, username):
+        with sqlite_errors:
+            return self.conn.execute(
+                'SELECT user_id, username, password_hash FROM users WHERE LOWER(username) = LOWER(?)',
+                (username,)
+            ).fetchone()
+
+    def list_usernames(self):
+        with sqlite_errors:
+            return [row[0] for row in self.conn.execute('SELECT username FROM users')]
+
+    def add_session(self, session_id, user_id, expires_at):
+        with self._transaction() as cursor:
+            cursor.execute(
+                'INSERT INTO sessions (session_id, user_id, expires_at) VALUES (?, ?, ?)',
+                (session_id, user_id, expires_at)
+            )
+
+    def get_session(self, session_id):
+        with sqlite_errors:
+            return self.conn.execute(
+                'SELECT user_id, expires_at FROM sessions WHERE session_id = ?',
+                (session_id,)
+            ).fetchone()
+
+    def renew_sessions(self, renewals):
+        with self._transaction() as cursor:
+            cursor.executemany(
+                'UPDATE sessions SET expires_at = ? WHERE session_id = ? AND expires_at < ?',
+                [(expires_at, session_id, expires_at) for session_id, expires_at in renewals.items()]
+            )
+
+    def delete_expired_sessions(self, now, chunk_size=500):
+        # Deletes through the expires_at index in chunks, committing after
+        # each, so other writers never wait long for the write lock however
+        # many sessions have expired
+        removed = 0
+        while True:
+            with self._transaction() as cursor:
+                cursor.execute(
+                    '''DELETE FROM sessions WHERE rowid IN (
+                           SELECT rowid FROM sessions WHERE expires_at <= ? LIMIT ?
+                       )''',
+                    (now, chunk_size)
+                )
+            removed += cursor.rowcount
+            if cursor.rowcount < chunk_size:
+                return removed
+
+    def create_chat(self, chat_type, user_ids):
+        with self._transaction() as cursor:
+            cursor.execute('INSERT INTO chats (chat_type) VALUES (?)', (chat_type,))
+            chat_id = cursor.lastrowid
+            cursor.executemany(
+                'INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)',
+                [(chat_id, user_id) for user_id in user_ids]
+            )
+            return chat_id
+
+    def find_private_chat(self, user1_id, user2_id):
+        with sqlite_errors:
+            row = self.conn.execute('''
+                SELECT c.chat_id
+                FROM chats c
+                JOIN chat_members cm1 ON c.chat_id = cm1.chat_id
+                JOIN chat_members cm2 ON c.chat_id = cm2.chat_id
+                WHERE c.chat_type = 'private'
+                AND cm1.user_id = ?
+                AND cm2.user_id = ?
+                AND (
+                    SELECT COUNT(*) FROM chat_members
+                    WHERE chat_id = c.chat_id
+                ) = 2
+            ''', (user1_id, user2_id)).fetchone()
+            return row['chat_id'] if row else None
+
+    def get_user_chats(self, user_id):
+        with sqlite_errors:
+            return self.conn.execute('''
+                SELECT c.chat_id, c.chat_type, c.created_at
+                FROM chats c
+                JOIN chat_members cm ON c.chat_id = cm.chat_id
+                WHERE cm.user_id = ?
+            ''', (user_id,)).fetchall()
+
+    def is_member(self, chat_id, user_id):
+        with sqlite_errors:
+            return self.conn.execute(
+                'SELECT 1 FROM chat_members WHERE chat_id = ? AND user_id = ?',
+                (chat_id, user_id)
+            ).fetchone() is not None
+
+    def get_chat_members(self, chat_id):
+        with sqlite_errors:
+            return [row['user_id'] for row in self.conn.execute(
+                'SELECT user_id FROM chat_members WHERE chat_id = ?',
+                (chat_id,)
+            )]
+
+    def add_message(self, chat_id, sender_id, message_content, attachment_id=None, filename=None):
+        if attachment_id is not None:
+            return self._add_message_with_attachment(chat_id, sender_id, message_content, attachment_id, filename)
+        if self.message_log:
+            try:
+                return self.message_log.append(chat_id, sender_id, message_content, utc_timestamp())
+            except OSError as e:
+                raise StorageError(str(e)) from e
+        if self.message_shards:
+            # Only takes the write lock of this chat's shard file
+            with sqlite_errors:
+                return self.message_shards.insert(chat_id, sender_id, message_content)
+        with self._transaction() as cursor:
+            cursor.execute(
+                '''INSERT INTO messages
+                   (chat_id, sender_id, message_content)
+                   VALUES (?, ?, ?)''',
+                (chat_id, sender_id, message_content)
+            )
+            return cursor.lastrowid
+
+    def _add_message_with_attachment(self, chat_id, sender_id, message_content, attachment_id, filename):
+        """
+        Store a message and its attachment link in one go.
+
+        The link always lives in the main database. Messages kept there go in
+        the same transaction as it; messages kept in a shard or the log are
+        written while that transaction holds the main database's write lock,
+        so the link can only fail after that on a commit error, and a shard
+        message is then deleted again.
+        """
+        conn = self.conn
+        with sqlite_errors:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                if conn.execute('SELECT 1 FROM attachments WHERE attachment_id = ? LIMIT 1',
+                                (attachment_id,)).fetchone() is None:
+                    raise StorageError(f"No attachment {attachment_id}")
+                if self.message_log or self.message_shards:
+                    message_id = self.add_message(chat_id, sender_id, message_content)
+                else:
+                    message_id = conn.execute(
+                        'INSERT INTO messages (chat_id, sender_id, message_content) VALUES (?, ?, ?)',
+                        (chat_id, sender_id, message_content)
+                    ).lastrowid
+                try:
+                    conn.execute(
+                        'INSERT INTO message_attachments (message_id, chat_id, attachment_id, filename) '
+                        'VALUES (?, ?, ?, ?)',
+                        (message_id, chat_id, attachment_id, filename)
+                    )
+                    conn.commit()
+                except sqlite3.Error:
+                    self._discard_message(chat_id, message_id)
+                    raise
+                return message_id
+            except Exception:
+                conn.rollback()
+                raise
+
+    def _discard_message(self, chat_id, message_id):
+        """Take back a message stored outside the main database whose link failed to commit."""
+        if self.message_shards:
+            try:
+                self.message_shards.delete(chat_id, message_id)
+            except sqlite3.Error as e:
+                logger.error(f"Could not remove message {message_id} after its attachment link failed: {e}")
+        elif self.message_log:
+            # The log is append-only; the message stays, without its attachment
+            logger.error(f"Message {message_id} is in the message log without its attachment link")
+
+    def get_messages(self, chat_id, limit=50, before_id=None):
+        if self.message_log:
+            return self.message_log.recent(chat_id, limit, before_id)
+        with sqlite_errors:
+            if self.message_shards:
+                return self.message_shards.recent(chat_id, limit, before_id)
+            cursor = self.conn.cursor()
+            cursor.row_factory = None  # Plain tuples, which are cheaper to build and unpack
+            return cursor.execute('''
+                SELECT message_id, sender_id, message_content, timestamp
+                FROM messages
+                WHERE chat_id = ? AND message_id < ?
+                ORDER BY message_id DESC
+                LIMIT ?
+            ''', (chat_id, before_id or MAX_MESSAGE_ID, limit)).fetchall()
+
+    def add_attachment(self, attachment_id, size, uploader_id):
+        with self._transaction() as cursor:
+            cursor.execute('INSERT OR IGNORE INTO attachments (attachment_id, size, uploader_id) VALUES (?, ?, ?)',
+                           (attachment_id, size, uploader_id))
+
+    def get_attachment(self, attachment_id):
+        with sqlite_errors:
+            return self.conn.execute(
+                'SELECT attachment_id, size, uploader_id, created_at FROM attachments WHERE attachment_id = ? LIMIT 1',
+                (attachment_id,)
+            ).fetchone()
+
+    def get_message_attachments(self, chat_id, message_ids):
+        message_ids = list(message_ids)
+        found = {}
+        with sqlite_errors:
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                for message_id, attachment_id, filename, size in self.conn.execute(f'''
+                    SELECT ma.message_id, ma.attachment_id, ma.filename,
+                           (SELECT size FROM attachments WHERE attachment_id = ma.attachment_id LIMIT 1)
+                    FROM message_attachments ma
+                    WHERE ma.message_id IN ({",".join("?" * len(chunk))}) AND ma.chat_id = ?
+                ''', chunk + [chat_id]):
+                    found[message_id] = {"attachment_id": attachment_id, "filename": filename, "size": size}
+        return found
+
+    def can_read_attachment(self, attachment_id, user_id):
+        with sqlite_errors:
+            return self.conn.execute('''
+                SELECT 1 FROM attachments WHERE attachment_id = ? AND uploader_id = ?
+                UNION ALL
+                SELECT 1 FROM message_attachments ma
+                JOIN chat_members cm ON cm.chat_id = ma.chat_id
+                WHERE ma.attachment_id = ? AND cm.user_id = ?
+                LIMIT 1
+            ''', (attachment_id, user_id, attachment_id, user_id)).fetchone() is not None
+
+    @property
+    def archive(self):
+        """The MessageArchive next to the database, opened on first use."""
+        with self._archive_lock:
+            if self._archive is None:
+                self._archive = MessageArchive(self.archive_path, self._create_connection)
+            return self._archive
+
+    def expire_messages(self, cutoffs, batch_size=500):
+        cutoffs = {chat_type: cutoff for chat_type, cutoff in cutoffs.items() if cutoff}
+        if not cutoffs:
+            return
+        with sqlite_errors:
+            chat_cutoffs = {row['chat_id']: cutoffs.get(row['chat_type'])
+                            for row in self.conn.execute('SELECT chat_id, chat_type FROM chats')}
+        newest_cutoff = max(cutoffs.values())
+
+        def expired(chat_id, timestamp):
+            cutoff = chat_cutoffs.get(chat_id)
+            return cutoff is not None and timestamp < cutoff
+
+        if self.message_log:
+            # Log segments are rewritten one at a time. The active segment
+            # is left alone, so messages there expire once it is sealed
+            try:
+                for dropped, _ in self.message_log.compact_steps(
+                        lambda message_id, chat_id, timestamp: expired(chat_id, timestamp),
+                        self._archive_log_rows, older_than=newest_cutoff):
+                    yield dropped
+            except (sqlite3.Error, OSError) as e:
+                raise StorageError(str(e)) from e
+            return
+
+        if self.message_shards:
+            sources = [lambda index=index: self.message_shards.conn(index) for index in range(self.message_shards.count)]
+        else:
+            sources = [lambda: self.conn]
+        for connection in sources:
+            # Message ids grow with time, so the scan starts at the oldest
+            # message and ends where no chat type's cutoff reaches
+            last_id = 0
+            while True:
+                with sqlite_errors:
+                    conn = connection()
+                    cursor = conn.cursor()
+                    cursor.row_factory = None
+                    rows = cursor.execute('''
+                        SELECT message_id, chat_id, sender_id, message_content, timestamp
+                        FROM messages WHERE message_id > ? ORDER BY message_id LIMIT ?
+                    ''', (last_id, batch_size)).fetchall()
+                    if not rows:
+                        break
+                    expired_rows = [row for row in rows if expired(row[1], row[4])]
+                    if expired_rows:
+                        # Archived first: if the delete fails, archiving them again is skipped
+                        self.archive.add(expired_rows)
+                        # Links live in the main database: with the messages there too one
+                        # transaction removes both, otherwise it commits once the shard's has
+                        with self._transaction() as links:
+                            self._unlink_attachments(links, expired_rows)
+                            try:
+                                conn.executemany('DELETE FROM messages WHERE message_id = ?',
+                                                 [(row[0],) for row in expired_rows])
+                                conn.commit()
+                            except sqlite3.Error:
+                                conn.rollback()
+                                raise
+                yield len(expired_rows)
+                if rows[-1][4] >= newest_cutoff:
+                    break
+                last_id = rows[-1][0]
+
+    def _unlink_attachments(self, cursor, rows):
+        """Delete the attachment links of expiring messages, given as (message_id, chat_id, ...) rows."""
+        cursor.executemany('DELETE FROM message_attachments WHERE message_id = ? AND chat_id = ?',
+                           [(row[0], row[1]) for row in rows])
+
+    def _archive_log_rows(self, rows):
+        # The log rewrites its segment after this; if that fails, the
+        # messages stay a pass longer without their links
+        self.archive.add(rows)
+        with self._transaction() as cursor:
+            self._unlink_attachments(cursor, rows)
+
+    def search_archive(self, chat_id, query, limit=20):
+        if self._archive is None and not os.path.exists(self.archive_path):
+            return []
+        with sqlite_errors:
+            return self.archive.search(chat_id, query, limit)
+
+    def _database_connections(self):
+        """The calling thread's connections to the main database and every message shard."""
+        connections = [self.conn]
+        if self.message_shards:
+            connections.extend(self.message_shards.conn(index) for index in range(self.message_shards.count))
+        return connections
+
+    def enable_incremental_vacuum(self):
+        with sqlite_errors:
+            for conn in self._database_connections():
+                if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:  # 2 is INCREMENTAL
+                    path = conn.execute('PRAGMA database_list').fetchone()['file']
+                    logger.info(f"Rebuilding {path} once so deleted messages' space can be reclaimed")
+                    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                    conn.executescript('VACUUM')
+
+    def vacuum_step(self, pages=256):
+        freed = 0
+        with sqlite_errors:
+            for conn in self._database_connections():
+                free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if free_pages:
+                    # executescript() runs the pragma to the end, execute() would free a single page
+                    conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+                    freed += free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return freed
+
+    def _keyset(self, connection, query, batch_size):
+        """Rows of query (which takes the last key and a limit) in batches, each batch its own read."""
+        last_key = 0
+        while True:
+            with sqlite_errors:
+                cursor = connection().cursor()
+                cursor.row_factory = None
+                rows = cursor.execute(query, (last_key, batch_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_key = rows[-1][0]
+
+    def iter_users(self, batch_size=1000):
+        for user_id, username, password_hash, created_at in self._keyset(
+            lambda: self.conn,
+            'SELECT user_id, username, password_hash, created_at FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+            batch_size
+        ):
+            yield {"user_id": user_id, "username": username, "password_hash": password_hash, "created_at": created_at}
+
+    def iter_chats(self, batch_size=1000):
+        chats = self._keyset(
+            lambda: self.conn,
+            'SELECT chat_id, chat_type, created_at FROM chats WHERE chat_id > ? ORDER BY chat_id LIMIT ?',
+            batch_size
+        )
+        for batch in iter(lambda: list(itertools.islice(chats, batch_size)), []):
+            members = {}
+            with sqlite_errors:
+                for chat_id, user_id in self.conn.execute(
+                    'SELECT chat_id, user_id FROM chat_members WHERE chat_id BETWEEN ? AND ?',
+                    (batch[0][0], batch[-1][0])
+                ):
+                    members.setdefault(chat_id, []).append(user_id)
+            for chat_id, chat_type, created_at in batch:
+                yield {"chat_id": chat_id, "chat_type": chat_type, "created_at": created_at,
+                       "members": members.get(chat_id, [])}
+
+    def iter_messages(self, batch_size=1000):
+        if self.message_log:
+            return self.message_log.scan(batch_size)
+        query = '''
+            SELECT message_id, chat_id, sender_id, message_content, timestamp
+            FROM messages WHERE message_id > ? ORDER BY message_id LIMIT ?
+        '''
+        if self.message_shards:
+            return heapq.merge(*(
+                self._keyset(lambda index=index: self.message_shards.conn(index), query, batch_size)
+                for index in range(self.message_shards.count)
+            ))
+        return self._keyset(lambda: self.conn, query, batch_size)
+
+    def import_users(self, users):
+        with self._transaction() as cursor:
+            cursor.executemany(
+                'INSERT INTO users (user_id, username, password_hash, created_at) VALUES (?, ?, ?, ?)',
+                [(user["user_id"], user["username"], user["password_hash"], user["created_at"]) for user in users]
+            )
+
+    def import_chats(self, chats):
+        with self._transaction() as cursor:
+            cursor.executemany(
+                'INSERT INTO chats (chat_id, chat_type, created_at) VALUES (?, ?, ?)',
+                [(chat["chat_id"], chat["chat_type"], chat["created_at"]) for chat in chats]
+            )
+            cursor.executemany(
+                'INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)',
+                [(chat["chat_id"], user_id) for chat in chats for user_id in chat["members"]]
+            )
+
+    def import_messages(self, rows):
+        if self.message_log:
+            try:
+                self.message_log.copy_in(rows)
+            except OSError as e:
+                raise StorageError(str(e)) from e
+            return
+        if self.message_shards:
+            with sqlite_errors:
+                self.message_shards.insert_rows(rows)
+            return
+        with self._transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO messages (message_id, chat_id, sender_id, message_content, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+
+    def backup(self, directory, pages=256, pause=0.01, max_restarts=3):
+        """
+        Copy the database files (and the message log) into directory with
+        SQLite's backup API, a few pages per step.
+
+        Any write from another connection makes SQLite start a file's copy
+        over, so under busy traffic it could keep restarting; after
+        max_restarts the rest is copied in one step. That step is a single
+        read transaction, which under WAL doesn't block writers either.
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = [self.db_path]
+        if self.message_shards:
+            paths.extend(self.message_shards.paths)
+        if os.path.exists(self.archive_path):
+            paths.append(self.archive_path)
+        written = []
+        for path in paths:
+            target_path = os.path.join(directory, os.path.basename(path))
+            with sqlite_errors:
+                self._backup_file(path, target_path, pages, pause, max_restarts)
+            written.append(target_path)
+        if self.message_log:
+            target_path = os.path.join(directory, os.path.basename(self.message_log.directory))
+            try:
+                self.message_log.backup(target_path)
+            except OSError as e:
+                raise StorageError(str(e)) from e
+            written.append(target_path)
+        return written
+
+    def _backup_file(self, path, target_path, pages, pause, max_restarts):
+        source = self._create_connection(path)
+        target = sqlite3.connect(target_path)
+        progress = BackupProgress(pause, max_restarts)
+        try:
+            try:
+                source.backup(target, pages=pages, progress=progress)
+            except BackupRestarted:
+                logger.info(f"Backup of {path} keeps restarting under writes, copying the rest in one step")
+                source.backup(target)
+            logger.info(f"Backed up {path} to {target_path} ({progress.total} pages, {progress.restarts} restarts)")
+        finally:
+            target.close()
+            source.close()
+
+    def checkpoint(self):
+        """
+        Copy the WAL back into the database file so the WAL doesn't keep
+        growing, and fsync the message log.
+        """
+        with sqlite_errors:
+            busy, wal_pages, copied_pages = self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            if self.message_shards:
+                shard_wal_pages, shard_copied_pages = self.message_shards.checkpoint()
+                wal_pages += shard_wal_pages
+                copied_pages += shard_copied_pages
+        if self.message_log:
+            self.message_log.sync()
+        return wal_pages, copied_pages
+
+    def close(self):
+        """Close every thread's database connection."""
+        if self._archive:
+            self._archive.close()
+        if self.message_log:
+            self.message_log.close()
+        if self.message_shards:
+            self.message_shards.close()
+        for conn in list(self._connections):
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+class MemoryStorage(Storage):
+    """
+    Storage in plain dicts and lists, gone when the process exits.
+
+    Nothing touches the disk, so tests run fast and a load test measures
+    network and CPU cost alone. Every worker process has its own copy, so
+    run a memory-backed server with a single worker. One lock guards all
+    of it; each operation is a few dict or list steps.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}  # {user_id: {user_id, username, created_at}}
+        self.password_hashes = {}  # {user_id: password_hash}
+        self.user_ids_by_name = {}  # {lowercased username: user_id}
+        self.sessions = {}  # {session_id: (user_id, expires_at)}
+        self.chats = {}  # {chat_id: {chat_id, chat_type, created_at}}
+        self.members = {}  # {chat_id: [user_id]}
+        self.chats_by_user = {}  # {user_id: [chat_id]}
+        self.messages = {}  # {chat_id: [(message_id, sender_id, message_content, timestamp)]}, oldest first
+        self.attachments = {}  # {attachment_id: {attachment_id, size, uploader_id, created_at}} of the first upload
+        self.uploaders = {}  # {attachment_id: {user_id}}
+        self.message_attachments = {}  # {message_id: (attachment_id, filename, chat_id)}
+        self.attachment_chats = {}  # {attachment_id: {chat_id}} of the chats it was sent in
+        self.user_ids = itertools.count(1)
+        self.chat_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def add_user(self, username, password_hash):
+        with self.lock:
+            if username.lower() in self.user_ids_by_name:
+                return None
+            user_id = next(self.user_ids)
+            self.users[user_id] = {"user_id": user_id, "username": username, "created_at": utc_timestamp()}
+            self.password_hashes[user_id] = password_hash
+            self.user_ids_by_name[username.lower()] = user_id
+            return user_id
+
+    def get_user(self, user_id):
+        with self.lock:
+            user = self.users.get(user_id)
+            return dict(user) if user else None
+
+    def get_user_by_username(self, username):
+        with self.lock:
+            user = self.users.get(self.user_ids_by_name.get(username.lower()))
+            return dict(user) if user else None
+
+    def get_credentials(self, username):
+        with self.lock:
+            user = self.users.get(self.user_ids_by_name.get(username.lower()))
+            if user is None:
+                return None
+            return {"user_id": user["user_id"], "username": user["username"],
+                    "password_hash": self.password_hashes[user["user_id"]]}
+
+    def list_usernames(self):
+        with self.lock:
+            return [user["username"] for user in self.users.values()]
+
+    def add_session(self, session_id, user_id, expires_at):
+        with self.lock:
+            if session_id in self.sessions:
+                raise StorageError("Session already exists")
+            self.sessions[session_id] = (user_id, expires_at)
+
+    def get_session(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        return {"user_id": session[0], "expires_at": session[1]}
+
+    def renew_sessions(self, renewals):
+        with self.lock:
+            for session_id, expires_at in renewals.items():
+                session = self.sessions.get(session_id)
+                if session is not None and session[1] < expires_at:
+                    self.sessions[session_id] = (session[0], expires_at)
+
+    def delete_expired_sessions(self, now, chunk_size=500):
+        with self.lock:
+            expired = [session_id for session_id, (_, expires_at) in self.sessions.items() if expires_at <= now]
+            for session_id in expired:
+                del self.sessions[session_id]
+        return len(expired)
+
+    def create_chat(self, chat_type, user_ids):
+        if chat_type not in ('private', 'group'):
+            raise StorageError(f"Invalid chat type: {chat_type}")
+        with self.lock:
+            chat_id = next(self.chat_ids)
+            self.chats[chat_id] = {"chat_id": chat_id, "chat_type": chat_type, "created_at": utc_timestamp()}
+            members = self.members[chat_id] = []
+            for user_id in user_ids:
+                if user_id not in members:
+                    members.append(user_id)
+                    self.chats_by_user.setdefault(user_id, []).append(chat_id)
+            self.messages[chat_id] = []
+            return chat_id
+
+    def find_private_chat(self, user1_id, user2_id):
+        with self.lock:
+            for chat_id in self.chats_by_user.get(user1_id, ()):
+                members = self.members[chat_id]
+                if (self.chats[chat_id]["chat_type"] == 'private' and len(members) == 2
+                        and user2_id in members):
+                    return chat_id
+            return None
+
+    def get_user_chats(self, user_id):
+        with self.lock:
+            return [dict(self.chats[chat_id]) for chat_id in self.chats_by_user.get(user_id, ())]
+
+    def is_member(self, chat_id, user_id):
+        with self.lock:
+            return user_id in self.members.get(chat_id, ())
+
+    def get_chat_members(self, chat_id):
+        with self.lock:
+            return list(self.members.get(chat_id, ()))
+
+    def add_message(self, chat_id, sender_id, message_content, attachment_id=None, filename=None):
+        with self.lock:
+            messages = self.messages.get(chat_id)
+            if messages is None:
+                raise StorageError(f"No chat {chat_id}")
+            if attachment_id is not None and attachment_id not in self.attachments:
+                raise StorageError(f"No attachment {attachment_id}")
+            message_id = next(self.message_ids)
+            messages.append((message_id, sender_id, message_content, utc_timestamp()))
+            if attachment_id is not None:
+                self.message_attachments[message_id] = (attachment_id, filename, chat_id)
+                self.attachment_chats.setdefault(attachment_id, set()).add(chat_id)
+            return message_id
+
+    def get_messages(self, chat_id, limit=50, before_id=None):
+        with self.lock:
+            messages = self.messages.get(chat_id, [])
+            # Sorted by message_id, and (before_id,) sorts before any message with that id
+            end = bisect.bisect_left(messages, (before_id,)) if before_id is not None else len(messages)
+            newest = messages[max(end - limit, 0):end] if limit > 0 else []
+        newest.reverse()
+        return newest
+
+    def add_attachment(self, attachment_id, size, uploader_id):
+        with self.lock:
+            self.attachments.setdefault(attachment_id, {"attachment_id": attachment_id, "size": size,
+                                                        "uploader_id": uploader_id, "created_at": utc_timestamp()})
+            self.uploaders.setdefault(attachment_id, set()).add(uploader_id)
+
+    def get_attachment(self, attachment_id):
+        with self.lock:
+            attachment = self.attachments.get(attachment_id)
+            return dict(attachment) if attachment else None
+
+    def get_message_attachments(self, chat_id, message_ids):
+        found = {}
+        with self.lock:
+            for message_id in message_ids:
+                link = self.message_attachments.get(message_id)
+                if link is not None and link[2] == chat_id:
+                    found[message_id] = {"attachment_id": link[0], "filename": link[1],
+                                         "size": self.attachments[link[0]]["size"]}
+        return found
+
+    def can_read_attachment(self, attachment_id, user_id):
+        with self.lock:
+            if user_id in self.uploaders.get(attachment_id, ()):
+                return True
+            return any(user_id in self.members.get(chat_id, ())
+                       for chat_id in self.attachment_chats.get(attachment_id, ()))
+
+    def iter_users(self, batch_size=1000):
+        with self.lock:
+            users = [dict(user, password_hash=self.password_hashes[user_id])
+                     for user_id, user in sorted(self.users.items())]
+        return iter(users)
+
+    def iter_chats(self, batch_size=1000):
+        with self.lock:
+            chats = [dict(chat, members=list(self.members[chat_id])) for chat_id, chat in sorted(self.chats.items())]
+        return iter(chats)
+
+    def iter_messages(self, batch_size=1000):
+        with self.lock:
+            messages = [(message_id, chat_id, sender_id, message_content, timestamp)
+                        for chat_id, chat_messages in self.messages.items()
+                        for message_id, sender_id, message_content, timestamp in chat_messages]
+        messages.sort()
+        return iter(messages)
+
+    def import_users(self, users):
+        with self.lock:
+            for user in users:
+                user_id = user["user_id"]
+                self.users[user_id] = {"user_id": user_id, "username": user["username"],
+                                       "created_at": user["created_at"]}
+                self.password_hashes[user_id] = user["password_hash"]
+                self.user_ids_by_name[user["username"].lower()] = user_id
+            self.user_ids = itertools.count(max(self.users, default=0) + 1)
+
+    def import_chats(self, chats):
+        with self.lock:
+            for chat in chats:
+                chat_id = chat["chat_id"]
+                self.chats[chat_id] = {"chat_id": chat_id, "chat_type": chat["chat_type"],
+                                       "created_at": chat["created_at"]}
+                self.members[chat_id] = list(chat["members"])
+                for user_id in chat["members"]:
+                    self.chats_by_user.setdefault(user_id, []).append(chat_id)
+                self.messages.setdefault(chat_id, [])
+            self.chat_ids = itertools.count(max(self.chats, default=0) + 1)
+
+    def import_messages(self, rows):
+        with self.lock:
+            for message_id, chat_id, sender_id, message_content, timestamp in rows:
+                if chat_id not in self.messages:
+                    raise StorageError(f"No chat {chat_id}")
+                self.messages[chat_id].append((message_id, sender_id, message_content, timestamp))
+            if rows:
+                # Rows come oldest first, so new ids continue after the last one
+                self.message_ids = itertools.count(rows[-1][0] + 1)
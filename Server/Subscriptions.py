@@ -0,0 +1,130 @@
+"""
+Which chats each connection is watching.
+
+A connection that has sent subscribe or unsubscribe gets full new_message
+pushes only for the chats it subscribed to. For its other chats the
+server just counts messages, and flush() sends the counts that changed
+as one small unread_counts frame per connection. Connections that never
+subscribe get every chat in full, as before subscriptions existed.
+"""
+import threading
+from ServerLog import get_logger
+
+logger = get_logger("subscriptions")
+
+UNREAD_FRAME = "unread_counts"
+
+
+class ChatSubscriptions:
+    """Per-connection chat subscriptions and unread counts."""
+
+    def __init__(self, server, max_subscriptions=100):
+        """
+        Args:
+            server: ServerConnection the pushes go through
+            max_subscriptions: Most chats one connection may subscribe to
+        """
+        self.server = server
+        self.max_subscriptions = max_subscriptions
+        self.lock = threading.Lock()
+        self.watching = {}  # {client_socket: {chat_id}}, for connections that have subscribed
+        self.unread = {}  # {client_socket: {chat_id: messages pushed as a count only}}
+        self.changed = {}  # {client_socket: {chat_id}} whose count flush() hasn't sent yet
+        self.delivered = 0
+        self.counted = 0
+
+    @classmethod
+    def from_config(cls, server, settings):
+        """Build from the "subscriptions" section of config.json."""
+        settings = settings or {}
+        return cls(server, max_subscriptions=settings.get("max_subscriptions", 100))
+
+    def subscribe(self, client_socket, chat_ids):
+        """
+        Start pushing these chats to a connection in full.
+
+        Returns:
+            (success, result): {chat_id: unread count until now} of the chats, or why not
+        """
+        with self.lock:
+            watching = self.watching.setdefault(client_socket, set())
+            if len(watching | set(chat_ids)) > self.max_subscriptions:
+                return False, f"At most {self.max_subscriptions} chats can be subscribed to"
+            watching.update(chat_ids)
+            unread = self.unread.get(client_socket, {})
+            changed = self.changed.get(client_socket, set())
+            counts = {}
+            for chat_id in chat_ids:
+                counts[chat_id] = unread.pop(chat_id, 0)
+                changed.discard(chat_id)
+            return True, counts
+
+    def unsubscribe(self, client_socket, chat_ids):
+        """Push these chats to a connection as unread counts only."""
+        with self.lock:
+            self.watching.setdefault(client_socket, set()).difference_update(chat_ids)
+
+    def subscriptions(self, client_socket):
+        """The chats a connection subscribed to, or None if it never did (it gets every chat)."""
+        with self.lock:
+            watching = self.watching.get(client_socket)
+            return None if watching is None else set(watching)
+
+    def deliver(self, user_ids, message, exclude_client=None):
+        """
+        Push a message to the users' connections: in full where its chat
+        is wanted, as a count to flush() later everywhere else.
+
+        Returns:
+            Number of connections the full message was queued for
+        """
+        chat_id = message.get("data", {}).get("chat_id")
+        targets = self.server.connections_of(user_ids, exclude_client)
+        if chat_id is None:
+            return self.server.send_to_clients(targets, message)
+        full = []
+        with self.lock:
+            for client_socket in targets:
+                watching = self.watching.get(client_socket)
+                if watching is None or chat_id in watching:
+                    full.append(client_socket)
+                    continue
+                if client_socket not in self.server.connected_clients:
+                    continue  # Closed meanwhile; don't start counting for it again
+                unread = self.unread.setdefault(client_socket, {})
+                unread[chat_id] = unread.get(chat_id, 0) + 1
+                self.changed.setdefault(client_socket, set()).add(chat_id)
+                self.counted += 1
+            self.delivered += len(full)
+        return self.server.send_to_clients(full, message)
+
+    def flush(self):
+        """Queue each connection the unread counts that changed since the last flush; returns how many were queued."""
+        with self.lock:
+            pending = [
+                (client_socket, [{"chat_id": chat_id, "unread": self.unread[client_socket].get(chat_id, 0)}
+                                 for chat_id in chat_ids])
+                for client_socket, chat_ids in self.changed.items() if chat_ids
+            ]
+            self.changed = {}
+        sent = 0
+        for client_socket, chats in pending:
+            # Queued like broadcasts, behind the connection's new_message frames, so
+            # counts never overtake them and the scheduler thread never waits on a send
+            sent += self.server.send_to_clients([client_socket], {"type": UNREAD_FRAME, "data": {"chats": chats}})
+        return sent
+
+    def close_connection(self, client_socket):
+        with self.lock:
+            self.watching.pop(client_socket, None)
+            self.unread.pop(client_socket, None)
+            self.changed.pop(client_socket, None)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "subscribed_connections": len(self.watching),
+                "subscriptions": sum(len(chats) for chats in self.watching.values()),
+                "pushed_in_full": self.delivered,
+                "pushed_as_count": self.counted
+            }
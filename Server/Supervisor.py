@@ -0,0 +1,232 @@
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+from Encryption import EncryptionManager
+from MessageBroker import MessageBroker
+from MessageBus import BrokerBus, create_bus
+from ServerLog import setup_logging, shutdown_logging, reset_logging_after_fork, get_logger
+from UserManager import UserManager
+
+logger = get_logger("supervisor")
+
+
+class Supervisor:
+    """
+    Runs the chat server as several forked worker processes on one port.
+
+    Every worker is a complete ChatServer with its own listening socket,
+    bound with SO_REUSEPORT so the kernel spreads new connections across
+    them, which gets the server past one process's GIL. The supervisor
+    makes the RSA identity key once so all workers present the same
+    server key, and runs a MessageBroker on a Unix socket so a message
+    sent on one worker reaches chat members connected to another (when
+    config.json puts the server in a cluster, the workers join the
+    cluster's broker instead). Workers that die are restarted; SIGTERM or
+    Ctrl+C stops them all.
+
+    The supervisor forks workers for as long as it runs, so it runs no
+    threads of its own: a child only gets the forking thread, and a lock
+    another thread held at the time would stay locked in it forever. The
+    broker runs in a process of its own and the supervisor logs without
+    a listener thread.
+    """
+
+    def __init__(self, config_path, run_worker, workers=None):
+        """
+        Args:
+            config_path: Path to config.json
+            run_worker: Called as run_worker(worker_id, encryption, bus) in
+                each forked worker; runs the server until it shuts down
+            workers: Number of workers; None reads supervisor.workers from
+                the config, 0 means one per CPU
+        """
+        self.config_path = config_path
+        self.run_worker = run_worker
+        with open(config_path, "r") as f:
+            self.config = json.load(f)
+        settings = self.config.get("supervisor", {})
+        if workers is None:
+            workers = settings.get("workers", 1)
+        self.workers = workers or os.cpu_count() or 1
+        self.restart_delay = settings.get("restart_delay", 1.0)  # Pause before restarting a worker that crashed on startup
+        self.children = {}  # {pid: (worker_id, started)}
+        self.encryption = None
+        self.bus_dir = None
+        self.broker_address = None
+        self.broker_pid = None
+        self.stopping = False
+
+    @staticmethod
+    def supported():
+        """Workers need fork(), SO_REUSEPORT and Unix sockets, which Windows lacks."""
+        return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT") and hasattr(socket, "AF_UNIX")
+
+    def run(self):
+        """Start the workers and keep them running until told to stop."""
+        setup_logging(self.config.get("logging"), background=False)
+        logger.info(f"Starting {self.workers} workers on "
+                    f"{self.config['server_ip_address']}:{self.config['server_port']}")
+
+        if self.config.get("storage", {}).get("engine") == "memory" and self.workers > 1:
+            logger.warning("Memory storage is per process: each worker will have its own users and chats")
+        # Create or migrate the database once, not in every worker at the same time
+        UserManager.from_config(self.config).close()
+        self.encryption = EncryptionManager()
+        self.encryption.generate_keys()
+        if self.config.get("cluster", {}).get("bus", "local") == "local":
+            self.bus_dir = tempfile.mkdtemp(prefix="intechat-bus-")
+            self.broker_address = os.path.join(self.bus_dir, "broker.sock")
+
+        signal.signal(signal.SIGTERM, self.handle_shutdown)
+        signal.signal(signal.SIGINT, self.handle_shutdown)
+        try:
+            if self.broker_address:
+                self._spawn_broker()
+            for worker_id in range(self.workers):
+                self._spawn(worker_id)
+            self._monitor()
+        finally:
+            if self.broker_pid:
+                self._stop_broker()
+            if self.bus_dir:
+                shutil.rmtree(self.bus_dir, ignore_errors=True)
+            logger.info("Supervisor stopped")
+            shutdown_logging()
+
+    def _fork(self):
+        """Fork; in the child, drop the supervisor's logging and signal handling."""
+        pid = os.fork()
+        if pid == 0:
+            reset_logging_after_fork()
+            # The supervisor forwards Ctrl+C as SIGTERM
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        return pid
+
+    def _spawn_broker(self):
+        pid = self._fork()
+        if pid:
+            self.broker_pid = pid
+            self._wait_for_broker()
+            logger.info(f"Message broker started (pid {pid})")
+            return
+
+        # In the broker process, which never returns into the supervisor's code
+        code = 1
+        try:
+            logging_settings = dict(self.config.get("logging") or {})
+            logging_settings["filename"] = "server-broker.log"
+            setup_logging(logging_settings)
+            broker = MessageBroker(self.broker_address)
+            stopped = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+            broker.start()
+            while not stopped.wait(1.0):
+                pass
+            broker.stop()
+            code = 0
+        except BaseException as e:
+            logger.exception(f"Message broker failed: {e}")
+        finally:
+            shutdown_logging()
+            os._exit(code)
+
+    def _wait_for_broker(self, timeout=5.0):
+        """Wait until the broker accepts connections, so workers join it as they start."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    probe.connect(self.broker_address)
+                return True
+            except OSError:
+                time.sleep(0.05)
+        logger.warning("Message broker not listening yet; workers will keep trying to reach it")
+        return False
+
+    def _stop_broker(self):
+        try:
+            os.kill(self.broker_pid, signal.SIGTERM)
+            os.waitpid(self.broker_pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+        self.broker_pid = None
+
+    def _spawn(self, worker_id):
+        pid = self._fork()
+        if pid:
+            self.children[pid] = (worker_id, time.monotonic())
+            logger.info(f"Worker {worker_id} started (pid {pid})")
+            return
+
+        # In the worker, which must never return into the supervisor's code
+        code = 1
+        try:
+            if self.broker_address:
+                bus = BrokerBus(self.broker_address)
+            else:
+                bus = create_bus(self.config.get("cluster"))
+            self.run_worker(worker_id, self.encryption, bus)
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException as e:
+            logger.exception(f"Worker {worker_id} failed: {e}")
+            shutdown_logging()
+        finally:
+            os._exit(code)
+
+    def _monitor(self):
+        """Wait on the workers, restarting any that exit until shutdown."""
+        deadline = None
+        while self.children:
+            if self.stopping:
+                # Give the workers time to close their connections, then insist
+                if deadline is None:
+                    deadline = time.monotonic() + 10.0
+                elif time.monotonic() > deadline:
+                    self._signal_children(signal.SIGKILL)
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    time.sleep(0.1)
+                    continue
+            else:
+                pid, status = os.waitpid(-1, 0)
+
+            if pid == self.broker_pid:
+                self.broker_pid = None
+                if not self.stopping:
+                    # Workers deliver locally until they reconnect to the new one
+                    logger.warning(f"Message broker (pid {pid}) exited with code "
+                                   f"{os.waitstatus_to_exitcode(status)}, restarting")
+                    time.sleep(self.restart_delay)
+                    self._spawn_broker()
+                continue
+            worker_id, started = self.children.pop(pid, (None, None))
+            if worker_id is None or self.stopping:
+                continue
+            logger.warning(f"Worker {worker_id} (pid {pid}) exited with code "
+                           f"{os.waitstatus_to_exitcode(status)}, restarting")
+            if time.monotonic() - started < 5.0:
+                time.sleep(self.restart_delay)  # Don't spin on a worker that can't start
+            if not self.stopping:
+                self._spawn(worker_id)
+
+    def _signal_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def handle_shutdown(self, signum, frame):
+        """Handle shutdown signals by stopping every worker."""
+        if not self.stopping:
+            logger.info("Stopping workers...")
+            self.stopping = True
+            self._signal_children(signal.SIGTERM)
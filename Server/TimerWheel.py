@@ -0,0 +1,108 @@
+import math
+import threading
+import time
+from ServerLog import get_logger
+
+logger = get_logger("timers")
+
+
+class Timer:
+    """Handle for a scheduled callback; cancel() stops it from firing."""
+
+    __slots__ = ("deadline_tick", "callback", "args", "cancelled")
+
+    def __init__(self, deadline_tick, callback, args):
+        self.deadline_tick = deadline_tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel for large numbers of coarse, mostly-cancelled timers.
+
+    Time is cut into ticks and each timer goes into the slot its deadline
+    tick hashes to, so scheduling and cancelling are O(1) and each tick only
+    looks at one slot instead of at every timer. Deadlines are rounded up
+    to whole ticks; timers further out than one revolution stay in their
+    slot until the revolution they're due in.
+    """
+
+    def __init__(self, tick=0.5, slots=512):
+        """
+        Args:
+            tick: Resolution in seconds
+            slots: Number of slots; one revolution covers tick * slots seconds
+        """
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.current_tick = 0  # Last tick whose slot has been processed
+        self.pending = 0  # Scheduled timers, including cancelled ones not yet dropped
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) on the wheel's thread after at least `delay` seconds."""
+        with self.lock:
+            elapsed_ticks = (time.monotonic() - self.started) / self.tick
+            deadline_tick = max(self.current_tick + 1, math.ceil(elapsed_ticks + delay / self.tick))
+            timer = Timer(deadline_tick, callback, args)
+            self.slots[deadline_tick % len(self.slots)].append(timer)
+            self.pending += 1
+            return timer
+
+    def advance(self):
+        """Fire every timer that is due; returns how many fired."""
+        now_tick = int((time.monotonic() - self.started) / self.tick)
+        due = []
+        with self.lock:
+            while self.current_tick < now_tick:
+                self.current_tick += 1
+                slot = self.slots[self.current_tick % len(self.slots)]
+                if not slot:
+                    continue
+                keep = []
+                for timer in slot:
+                    if timer.cancelled:
+                        self.pending -= 1
+                    elif timer.deadline_tick <= self.current_tick:
+                        self.pending -= 1
+                        due.append(timer)
+                    else:
+                        keep.append(timer)  # Due in a later revolution
+                slot[:] = keep
+
+        # Callbacks run outside the lock so they can schedule new timers
+        for timer in due:
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logger.exception(f"Timer callback failed: {e}")
+        return len(due)
+
+    def start(self):
+        """Advance the wheel from a background thread until stop() is called."""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.tick):
+            self.advance()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=2.0)
+            self.thread = None
+
+    def __len__(self):
+        return self.pending
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+
+class UserCache:
+    """
+    Bounded LRU cache of user records, looked up by id or by username.
+
+    Records are plain dicts with user_id, username and created_at. Usernames
+    are matched case-insensitively, like the LOWER() lookups in UserManager.
+    Only hits are cached; a miss always goes to the database, so a newly
+    registered user is found without any invalidation.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.by_id = OrderedDict()  # {user_id: record}, least recently used first
+        self.id_by_name = {}  # {lowercased username: user_id}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_by_id(self, user_id):
+        with self.lock:
+            record = self.by_id.get(user_id)
+            if record is None:
+                self.misses += 1
+                return None
+            self.by_id.move_to_end(user_id)
+            self.hits += 1
+            return record
+
+    def get_by_username(self, username):
+        with self.lock:
+            user_id = self.id_by_name.get(username.lower())
+            record = self.by_id.get(user_id) if user_id is not None else None
+            if record is None:
+                self.misses += 1
+                return None
+            self.by_id.move_to_end(user_id)
+            self.hits += 1
+            return record
+
+    def put(self, record):
+        """Cache a user record (anything with user_id, username and created_at keys)."""
+        record = {"user_id": record["user_id"], "username": record["username"],
+                  "created_at": record["created_at"]}
+        with self.lock:
+            old = self.by_id.pop(record["user_id"], None)
+            if old is not None:
+                self.id_by_name.pop(old["username"].lower(), None)
+            self.by_id[record["user_id"]] = record
+            self.id_by_name[record["username"].lower()] = record["user_id"]
+            while len(self.by_id) > self.capacity:
+                _, evicted = self.by_id.popitem(last=False)
+                self.id_by_name.pop(evicted["username"].lower(), None)
+        return record
+
+    def invalidate(self, user_id=None, username=None):
+        """Forget a user, e.g. after their record changes."""
+        with self.lock:
+            if user_id is None and username is not None:
+                user_id = self.id_by_name.get(username.lower())
+            record = self.by_id.pop(user_id, None)
+            if record is not None:
+                self.id_by_name.pop(record["username"].lower(), None)
+            if username is not None:
+                self.id_by_name.pop(username.lower(), None)
+
+    def clear(self):
+        with self.lock:
+            self.by_id.clear()
+            self.id_by_name.clear()
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.by_id),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
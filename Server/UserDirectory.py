@@ -0,0 +1,80 @@
+import threading
+from bisect import bisect_left
+
+
+class UserDirectory:
+    """
+    In-memory username index for prefix search (directory autocomplete).
+
+    Usernames are kept lowercased in one sorted list per username length.
+    A search walks the lengths from the prefix's own upward and bisects
+    each list for the prefix's range, so results come out ranked (exact
+    match first, then shorter names, then alphabetically) and a query
+    touches at most one bisect pair per possible length, never the whole
+    matching range. Usernames are 4-20 characters, so that is at most 17
+    lists however many users there are.
+    """
+
+    def __init__(self):
+        self.keys = {}  # {length: sorted lowercased usernames}
+        self.names = {}  # {length: usernames as registered, parallel to keys}
+        self.lock = threading.Lock()
+
+    def load(self, usernames):
+        """Replace the index with the given usernames; returns how many were loaded."""
+        by_length = {}
+        for username in usernames:
+            by_length.setdefault(len(username), []).append((username.lower(), username))
+        keys, names = {}, {}
+        for length, entries in by_length.items():
+            entries.sort()
+            keys[length] = [key for key, _ in entries]
+            names[length] = [name for _, name in entries]
+        with self.lock:
+            self.keys, self.names = keys, names
+        return sum(len(entries) for entries in keys.values())
+
+    def add(self, username):
+        """Index a newly registered username."""
+        key = username.lower()
+        length = len(username)
+        with self.lock:
+            keys = self.keys.setdefault(length, [])
+            names = self.names.setdefault(length, [])
+            index = bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                return
+            keys.insert(index, key)
+            names.insert(index, username)
+
+    def search(self, prefix, limit=10, exclude=None):
+        """
+        Return up to `limit` usernames starting with prefix, case-insensitively.
+
+        Args:
+            prefix: Start of the username
+            limit: Maximum number of results
+            exclude: Username to leave out (e.g. whoever is searching)
+        """
+        prefix = prefix.lower()
+        exclude = exclude.lower() if exclude else None
+        # Every key starting with prefix sorts between prefix and prefix + U+10FFFF
+        upper = prefix + "\U0010ffff"
+        results = []
+        with self.lock:
+            for length in sorted(self.keys):
+                if length < len(prefix):
+                    continue
+                keys = self.keys[length]
+                start = bisect_left(keys, prefix)
+                end = bisect_left(keys, upper, start)
+                for index in range(start, min(end, start + limit - len(results) + 1)):
+                    if keys[index] != exclude:
+                        results.append(self.names[length][index])
+                    if len(results) >= limit:
+                        return results
+        return results
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(keys) for keys in self.keys.values())
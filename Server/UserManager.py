@@ -1,99 +1,72 @@
-import sqlite3
 import bcrypt
 import secrets
 from datetime import datetime
 import time
 import os
 import re
+import threading
+from ServerLog import get_logger
+from Storage import SQLiteStorage, StorageError, create_storage
+from UserCache import UserCache
+from UserDirectory import UserDirectory
+
+logger = get_logger("users")
+
+# Database used when none is configured, relative to the server directory
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage", "chat_database.db")
+DEFAULT_SESSION_TTL = 24 * 3600  # Seconds a session stays valid after its last use
+DEFAULT_RENEW_AFTER = 300  # Only renew sessions whose stored expiry is this many seconds stale
 
 class UserManager:
-    def __init__(self, db_path="./server/storage/chat_database.db"):
-        """Initialize the UserManager with database connection."""
-        # Get the absolute path of the current directory
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        # Construct storage path relative to server directory
-        self.db_path = os.path.join(current_dir, "storage", "chat_database.db")
-        self._ensure_db_directory()
-        self.conn = self._create_connection()
-        self._create_tables()
-
-    def _ensure_db_directory(self):
-        """Ensure the database directory exists."""
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-
-    def _create_connection(self):
-        """Create a database connection."""
-        try:
-            conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            conn.row_factory = sqlite3.Row  # This enables name-based access to columns
-            return conn
-        except sqlite3.Error as e:
-            print(f"Error connecting to database: {e}")
-            raise
-
-    def _create_tables(self):
-        """Create necessary database tables if they don't exist."""
-        try:
-            cursor = self.conn.cursor()
-            
-            # Users table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Sessions table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sessions (
-                    session_id TEXT PRIMARY KEY,
-                    user_id INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            ''')
-            
-            # Chats table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chats (
-                    chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_type TEXT CHECK(chat_type IN ('private', 'group')) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Chat members table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chat_members (
-                    chat_id INTEGER,
-                    user_id INTEGER,
-                    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (chat_id, user_id),
-                    FOREIGN KEY (chat_id) REFERENCES chats (chat_id),
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            ''')
-            
-            # Messages table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER,
-                    sender_id INTEGER,
-                    message_content TEXT,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES chats (chat_id),
-                    FOREIGN KEY (sender_id) REFERENCES users (user_id)
-                )
-            ''')
-            
-            self.conn.commit()
-        except sqlite3.Error as e:
-            print(f"Error creating tables: {e}")
-            raise
+    def __init__(self, db_path=None, session_ttl=DEFAULT_SESSION_TTL, renew_after=DEFAULT_RENEW_AFTER,
+                 user_cache_size=10000, message_shards=0, storage=None):
+        """
+        Initialize the UserManager with database connection.
+        
+        Args:
+            db_path: SQLite file (defaults to Server/storage/chat_database.db)
+            session_ttl: Seconds of inactivity after which a session expires
+            renew_after: Minimum seconds between stored renewals of one session
+            user_cache_size: User records kept in memory for id/username lookups
+            message_shards: Number of SQLite files to spread messages over by
+                chat_id; 0 keeps them in the main database
+            storage: Storage engine to use instead of a SQLiteStorage on db_path
+        """
+        self.db_path = db_path or DEFAULT_DB_PATH
+        self.session_ttl = session_ttl
+        self.renew_after = renew_after
+        if storage is None:
+            storage = SQLiteStorage(self.db_path, message_shards=message_shards, session_ttl=session_ttl)
+        self.storage = storage
+        # Sliding expiry is renewed in memory and written in batches by
+        # flush_session_renewals(), not with an UPDATE on every request
+        self._pending_renewals = {}  # {session_id: new expires_at}
+        self._renewals_lock = threading.Lock()
+        self.user_cache = UserCache(user_cache_size)
+        # Username prefix index for search_users; filled by load_user_directory()
+        self.user_directory = UserDirectory()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a UserManager with the database, session, cache and storage settings in config.json."""
+        sessions = config.get("sessions", {})
+        session_ttl = int(sessions.get("ttl_hours", 24) * 3600)
+        db_path = config.get("database_path") or DEFAULT_DB_PATH
+        storage = create_storage(config.get("storage"), db_path, session_ttl)
+        retention = config.get("retention") or {}
+        if retention.get("private_days") or retention.get("group_days"):
+            # A one-off rebuild for databases created before retention existed
+            try:
+                storage.enable_incremental_vacuum()
+            except StorageError as e:
+                logger.error(f"Error enabling incremental vacuum: {e}")
+        return cls(
+            db_path,
+            session_ttl=session_ttl,
+            renew_after=sessions.get("renew_after_seconds", 300),
+            user_cache_size=config.get("cache", {}).get("user_cache_size", 10000),
+            storage=storage
+        )
 
     def validate_username(self, username):
         """
@@ -132,8 +105,6 @@ class UserManager:
     def register_user(self, username, password):
         """Register a new user with validation."""
         try:
-            cursor = self.conn.cursor()
-            
             # Validate username
             is_valid, message = self.validate_username(username)
             if not is_valid:
@@ -145,220 +116,245 @@ class UserManager:
                 return False, message
             
             # Check if username already exists (case insensitive)
-            cursor.execute('SELECT 1 FROM users WHERE LOWER(username) = LOWER(?)', (username,))
-            if cursor.fetchone():
+            if self.storage.get_user_by_username(username):
                 return False, "Username already exists"
             
             # Hash the password
             salt = bcrypt.gensalt()
             password_hash = bcrypt.hashpw(password.encode(), salt)
             
-            # Insert new user (with original case)
-            cursor.execute(
-                'INSERT INTO users (username, password_hash) VALUES (?, ?)',
-                (username, password_hash)
-            )
-            self.conn.commit()
+            # Insert new user (with original case); it may have been taken while we hashed
+            if self.storage.add_user(username, password_hash) is None:
+                return False, "Username already exists"
+            self.user_cache.invalidate(username=username)
+            self.user_directory.add(username)
             
             return True, "User registered successfully"
             
-        except sqlite3.Error as e:
-            self.conn.rollback()
+        except StorageError as e:
             return False, f"Database error: {str(e)}"
 
     def authenticate_user(self, username, password):
         """Authenticate a user and return a session token."""
         try:
-            cursor = self.conn.cursor()
-            
             # Get user data (case insensitive username match)
-            cursor.execute(
-                'SELECT user_id, username, password_hash FROM users WHERE LOWER(username) = LOWER(?)',
-                (username,)
-            )
-            user = cursor.fetchone()
+            user = self.storage.get_credentials(username)
             
             if not user:
                 return False, "Invalid username or password", None
             
-            # Verify password
-            if not bcrypt.checkpw(password.encode(), user['password_hash'].encode()):
+            # Verify password (hashes were stored as bytes, so they come back as bytes)
+            password_hash = user['password_hash']
+            if isinstance(password_hash, str):
+                password_hash = password_hash.encode()
+            if not bcrypt.checkpw(password.encode(), password_hash):
                 return False, "Invalid username or password", None
             
             # Generate session token
             session_token = secrets.token_urlsafe(32)
             
             # Store session
-            cursor.execute(
-                'INSERT INTO sessions (session_id, user_id) VALUES (?, ?)',
-                (session_token, user['user_id'])
-            )
-            self.conn.commit()
+            self.storage.add_session(session_token, user['user_id'], int(time.time()) + self.session_ttl)
             
             return True, "Authentication successful", session_token
-        except sqlite3.Error as e:
-            self.conn.rollback()
+        except StorageError as e:
             return False, f"Database error: {str(e)}", None
         
     def validate_session(self, session_token):
         """Validate a session token and return user_id if valid."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                'SELECT user_id FROM sessions WHERE session_id = ?',
-                (session_token,)
-            )
-            session = cursor.fetchone()
-            
-            if session:
-                return True, session['user_id']
-            return False, None
-        except sqlite3.Error as e:
+            session = self.storage.get_session(session_token)
+            if not session:
+                return False, None
+            
+            now = int(time.time())
+            with self._renewals_lock:
+                expires_at = max(session['expires_at'] or 0, self._pending_renewals.get(session_token, 0))
+                if expires_at <= now:
+                    return False, None
+                # Slide the expiry forward, but only queue a write once it's worth one
+                if now + self.session_ttl - expires_at >= self.renew_after:
+                    self._pending_renewals[session_token] = now + self.session_ttl
+            return True, session['user_id']
+        except StorageError as e:
             return False, None
 
     def create_chat(self, user_ids, chat_type='private'):
         """Create a new chat between users."""
         try:
-            cursor = self.conn.cursor()
-            
-            # Create new chat
-            cursor.execute(
-                'INSERT INTO chats (chat_type) VALUES (?)',
-                (chat_type,)
-            )
-            chat_id = cursor.lastrowid
-            
-            # Add members to chat
-            for user_id in user_ids:
-                cursor.execute(
-                    'INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)',
-                    (chat_id, user_id)
-                )
-            
-            self.conn.commit()
-            return True, chat_id
-        except sqlite3.Error as e:
-            self.conn.rollback()
+            return True, self.storage.create_chat(chat_type, user_ids)
+        except StorageError as e:
             return False, str(e)
 
-    def store_message(self, chat_id, sender_id, message_content):
-        """Store an encrypted message."""
+    def store_message(self, chat_id, sender_id, message_content, attachment=None):
+        """Store an encrypted message, optionally with an attachment: {attachment_id, filename}."""
         try:
-            cursor = self.conn.cursor()
-            
             # Verify sender is member of chat
-            cursor.execute(
-                'SELECT 1 FROM chat_members WHERE chat_id = ? AND user_id = ?',
-                (chat_id, sender_id)
-            )
-            if not cursor.fetchone():
+            if not self.storage.is_member(chat_id, sender_id):
                 return False, "User is not a member of this chat"
             
-            # Store message
-            cursor.execute(
-                '''INSERT INTO messages 
-                   (chat_id, sender_id, message_content) 
-                   VALUES (?, ?, ?)''',
-                (chat_id, sender_id, message_content)
-            )
-            self.conn.commit()
-            return True, cursor.lastrowid
-        except sqlite3.Error as e:
-            self.conn.rollback()
+            # Store message, together with its attachment link
+            if attachment:
+                message_id = self.storage.add_message(chat_id, sender_id, message_content,
+                                                      attachment['attachment_id'], attachment['filename'])
+            else:
+                message_id = self.storage.add_message(chat_id, sender_id, message_content)
+            return True, message_id
+        except StorageError as e:
             return False, str(e)
 
+    def add_attachment(self, attachment_id, size, uploader_id):
+        """Record an upload; returns whether it was stored."""
+        try:
+            self.storage.add_attachment(attachment_id, size, uploader_id)
+            return True
+        except StorageError:
+            return False
+
+    def get_attachment(self, attachment_id):
+        """Get an attachment's size and first uploader, or None."""
+        try:
+            return self.storage.get_attachment(attachment_id)
+        except StorageError:
+            return None
+
+    def can_read_attachment(self, attachment_id, user_id):
+        """Check whether a user uploaded an attachment or is in a chat it was sent to."""
+        try:
+            return self.storage.can_read_attachment(attachment_id, user_id)
+        except StorageError:
+            return False
+
+    def _add_attachments(self, chat_id, messages):
+        """Add an 'attachment' {attachment_id, filename, size} to the chat's message dicts that have one."""
+        if messages:
+            attachments = self.storage.get_message_attachments(chat_id, [message['message_id'] for message in messages])
+            for message in messages:
+                if message['message_id'] in attachments:
+                    message['attachment'] = attachments[message['message_id']]
+        return messages
+
     def get_user_chats(self, user_id):
         """Get all chats for a user."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT c.chat_id, c.chat_type, c.created_at
-                FROM chats c
-                JOIN chat_members cm ON c.chat_id = cm.chat_id
-                WHERE cm.user_id = ?
-            ''', (user_id,))
-            return cursor.fetchall()
-        except sqlite3.Error as e:
+            return self.storage.get_user_chats(user_id)
+        except StorageError as e:
             return []
 
-    def get_chat_messages(self, chat_id, user_id, limit=50):
-        """Get messages for a chat (if user is a member)."""
+    def get_chat_messages(self, chat_id, user_id, limit=50, before_id=None):
+        """Get messages for a chat (if user is a member), newest first, optionally only those before before_id."""
         try:
-            cursor = self.conn.cursor()
-            
             # Verify user is member of chat
-            cursor.execute(
-                'SELECT 1 FROM chat_members WHERE chat_id = ? AND user_id = ?',
-                (chat_id, user_id)
-            )
-            if not cursor.fetchone():
+            if not self.storage.is_member(chat_id, user_id):
                 return False, "User is not a member of this chat"
             
             # Get messages
-            cursor.execute('''
-                SELECT message_id, sender_id, message_content, timestamp
-                FROM messages
-                WHERE chat_id = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (chat_id, limit))
-            
-            return True, cursor.fetchall()
-        except sqlite3.Error as e:
+            rows = self.storage.get_messages(chat_id, limit, before_id)
+            usernames = self._resolve_usernames(rows)
+            return True, self._add_attachments(chat_id, [{
+                'message_id': message_id,
+                'sender_id': sender_id,
+                'username': usernames[sender_id],
+                'message_content': message_content,
+                'timestamp': timestamp
+            } for message_id, sender_id, message_content, timestamp in rows])
+        except StorageError as e:
             return False, str(e)
 
-    def cleanup_old_sessions(self, max_age_hours=24):
-        """Remove sessions older than specified hours."""
+    def flush_session_renewals(self):
+        """Write queued session renewals in one transaction; returns how many were written."""
+        with self._renewals_lock:
+            renewals, self._pending_renewals = self._pending_renewals, {}
+        if not renewals:
+            return 0
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                'DELETE FROM sessions WHERE created_at < datetime("now", "-24 hours")'
-            )
-            self.conn.commit()
-        except sqlite3.Error as e:
-            self.conn.rollback()
-            print(f"Error cleaning up sessions: {e}")
-            
+            self.storage.renew_sessions(renewals)
+            return len(renewals)
+        except StorageError as e:
+            logger.error(f"Error renewing sessions: {e}")
+            # Put them back for the next flush, unless newer renewals arrived meanwhile
+            with self._renewals_lock:
+                for session_id, expires_at in renewals.items():
+                    self._pending_renewals.setdefault(session_id, expires_at)
+            return 0
+
+    def cleanup_old_sessions(self, chunk_size=500):
+        """
+        Remove expired sessions.
+        
+        The SQLite engine deletes through the expires_at index in chunks of
+        chunk_size rows, committing after each, so other writers never wait
+        long for the write lock however many sessions have expired.
+        
+        Returns:
+            Number of sessions removed
+        """
+        removed = 0
+        try:
+            # Renewed sessions must be stored before we judge them expired
+            self.flush_session_renewals()
+            removed = self.storage.delete_expired_sessions(int(time.time()), chunk_size)
+        except StorageError as e:
+            logger.error(f"Error cleaning up sessions: {e}")
+        if removed:
+            logger.info(f"Removed {removed} expired sessions")
+        return removed
+            
+    def checkpoint(self):
+        """Copy the WAL back into the database file so the WAL doesn't keep growing."""
+        try:
+            return self.storage.checkpoint()
+        except StorageError as e:
+            logger.error(f"Error checkpointing database: {e}")
+            return None
+
     def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
+        """Write pending session renewals and close the storage engine."""
+        self.flush_session_renewals()
+        self.storage.close()
 
     def get_user_by_username(self, username):
-        """Get user info by username."""
+        """Get user info by username (case insensitive), served from the user cache when possible."""
+        if not isinstance(username, str):
+            return None
+        user = self.user_cache.get_by_username(username)
+        if user is not None:
+            return user
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                'SELECT user_id, username, created_at FROM users WHERE LOWER(username) = LOWER(?)',
-                (username,)
-            )
-            return cursor.fetchone()
-        except sqlite3.Error:
+            user = self.storage.get_user_by_username(username)
+            return self.user_cache.put(user) if user else None
+        except StorageError:
             return None
 
+    def load_user_directory(self):
+        """Build the username search index from the stored users; returns how many were loaded."""
+        try:
+            return self.user_directory.load(self.storage.list_usernames())
+        except StorageError as e:
+            logger.error(f"Failed to load user directory: {e}")
+            return 0
+
+    def search_users(self, prefix, limit=10, exclude=None):
+        """
+        Find usernames starting with prefix (case insensitive), shortest first.
+
+        Args:
+            prefix: Start of the username
+            limit: Maximum number of results
+            exclude: Username to leave out of the results
+
+        Returns:
+            list: Matching usernames as registered
+        """
+        return self.user_directory.search(prefix, limit, exclude)
+
     def get_or_create_private_chat(self, user1_id, user2_id):
         """Get existing private chat between users or create new one."""
         try:
-            cursor = self.conn.cursor()
-            
             # Check if private chat already exists
-            cursor.execute('''
-                SELECT c.chat_id
-                FROM chats c
-                JOIN chat_members cm1 ON c.chat_id = cm1.chat_id
-                JOIN chat_members cm2 ON c.chat_id = cm2.chat_id
-                WHERE c.chat_type = 'private'
-                AND cm1.user_id = ?
-                AND cm2.user_id = ?
-                AND (
-                    SELECT COUNT(*) FROM chat_members 
-                    WHERE chat_id = c.chat_id
-                ) = 2
-            ''', (user1_id, user2_id))
-            
-            result = cursor.fetchone()
-            if result:
-                return result['chat_id']
+            chat_id = self.storage.find_private_chat(user1_id, user2_id)
+            if chat_id:
+                return chat_id
                 
             # Create new private chat
             success, chat_id = self.create_chat([user1_id, user2_id], 'private')
@@ -366,54 +362,117 @@ class UserManager:
                 return chat_id
             return None
                 
-        except sqlite3.Error:
+        except StorageError:
             return None
 
+    def _resolve_usernames(self, rows):
+        """
+        Map the senders of (message_id, sender_id, ...) rows to their usernames
+        (None for unknown users).
+
+        Names come from the user cache rather than a join, which works
+        whichever engine (or shard file) holds the messages.
+        """
+        usernames = {}
+        for sender_id in {row[1] for row in rows}:
+            user = self.get_user_by_id(sender_id)
+            usernames[sender_id] = user['username'] if user else None
+        return usernames
+
     def get_formatted_chat_messages(self, chat_id, limit=50):
         """Get messages with sender usernames and formatted timestamps."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT 
-                    m.message_id,
-                    m.message_content,
-                    m.timestamp,
-                    u.username as sender_username
-                FROM messages m
-                JOIN users u ON m.sender_id = u.user_id
-                WHERE m.chat_id = ?
-                ORDER BY m.timestamp DESC
-                LIMIT ?
-            ''', (chat_id, limit))
-            
-            return cursor.fetchall()
-        except sqlite3.Error:
+            rows = self.storage.get_messages(chat_id, limit)
+        except StorageError:
             return []
+        usernames = self._resolve_usernames(rows)
+        return [{
+            'message_id': message_id,
+            'message_content': message_content,
+            'timestamp': timestamp,
+            'sender_username': usernames[sender_id]
+        } for message_id, sender_id, message_content, timestamp in rows]
+
+    def iter_chat_history(self, chat_id, page_size=500):
+        """
+        Yield a chat's whole history a page at a time, newest first, as lists of
+        {message_id, username, content, timestamp}; membership is the caller's to check.
+
+        Each page is a read of its own for the messages before the previous
+        page's oldest, so nothing stays open between pages and only one page
+        is held however long the chat is.
+        """
+        before_id = None
+        while True:
+            rows = self.storage.get_messages(chat_id, page_size, before_id)
+            if not rows:
+                return
+            usernames = self._resolve_usernames(rows)
+            yield self._add_attachments(chat_id, [{
+                'message_id': message_id,
+                'username': usernames[sender_id],
+                'content': message_content,
+                'timestamp': timestamp
+            } for message_id, sender_id, message_content, timestamp in rows])
+            if len(rows) < page_size:
+                return
+            before_id = rows[-1][0]
+
+    def search_archived_messages(self, chat_id, user_id, query, limit=20):
+        """Search a chat's archived messages (if user is a member), newest first, with sender usernames."""
+        try:
+            if not self.storage.is_member(chat_id, user_id):
+                return False, "User is not a member of this chat"
+            rows = self.storage.search_archive(chat_id, query, limit)
+        except StorageError as e:
+            return False, str(e)
+        usernames = self._resolve_usernames(rows)
+        return True, [{
+            'message_id': message_id,
+            'username': usernames[sender_id],
+            'content': message_content,
+            'timestamp': timestamp
+        } for message_id, sender_id, message_content, timestamp in rows]
+
+    def get_last_message(self, chat_id):
+        """Get a chat's newest message with its sender's username, or None."""
+        messages = self.get_formatted_chat_messages(chat_id, limit=1)
+        return messages[0] if messages else None
         
     def get_user_by_id(self, user_id):
-        """Get user info by ID."""
+        """Get user info by ID, served from the user cache when possible."""
+        user = self.user_cache.get_by_id(user_id)
+        if user is not None:
+            return user
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                'SELECT user_id, username, created_at FROM users WHERE user_id = ?',
-                (user_id,)
-            )
-            return cursor.fetchone()
-        except sqlite3.Error:
+            user = self.storage.get_user(user_id)
+            return self.user_cache.put(user) if user else None
+        except StorageError:
             return None
 
+    def is_chat_member(self, chat_id, user_id):
+        """Check whether a user is a member of a chat."""
+        try:
+            return self.storage.is_member(chat_id, user_id)
+        except StorageError:
+            return False
+
     def get_chat_members(self, chat_id):
         """Get all member IDs for a chat."""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                'SELECT user_id FROM chat_members WHERE chat_id = ?',
-                (chat_id,)
-            )
-            return [row['user_id'] for row in cursor.fetchall()]
-        except sqlite3.Error:
+            return self.storage.get_chat_members(chat_id)
+        except StorageError:
             return []
 
+    def get_chat_member_names(self, chat_id):
+        """Get the usernames of a chat's members."""
+        names = []
+        for user_id in self.get_chat_members(chat_id):
+            user = self.get_user_by_id(user_id)
+            if user:
+                names.append(user['username'])
+        return names
+
 
 # Example usage and testing
 if __name__ == "__main__":
@@ -4,25 +4,90 @@ from ServerComm import ServerConnection
 from UserManager import UserManager
 from MessageHandler import MessageHandler
 from Encryption import EncryptionManager
+from Metrics import MetricsHTTPServer
+from RateLimiter import RateLimiter
+from Scheduler import Scheduler
+from Retention import MessageRetention
+from Snapshot import BackupJob
+from ChatExport import ChatExporter
+from Attachments import AttachmentTransfers, is_attachment_id
+from Subscriptions import ChatSubscriptions
+from Supervisor import Supervisor
+from MessageBus import create_bus
+import threading
+from ServerLog import setup_logging, shutdown_logging, get_logger
 import signal
 import sys
 from datetime import datetime  # Add this import
 import time
 
+logger = get_logger("server")
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.json")
+
+RATE_LIMIT_MESSAGE = "Too many requests. Please wait a few seconds."
+MAX_SEARCH_RESULTS = 50
+
 class ChatServer:
-   def __init__(self):
-      """Initialize the chat server and its components."""
+   def __init__(self, config_path=None, encryption=None, bus=None, worker_id=None):
+      """
+      Initialize the chat server and its components.
+      
+      Args:
+         config_path: Path to config.json
+         encryption: EncryptionManager with the server's identity key (generated when not given)
+         bus: MessageBus to the other server nodes (defaults to the one configured under cluster)
+         worker_id: Index of this worker process, None when running alone
+      """
+      self.config_path = config_path or DEFAULT_CONFIG_PATH
+      self.worker_id = worker_id
       self.load_config()
-      self.user_manager = UserManager()
+      self.bus = bus or create_bus(self.config.get("cluster"))
+      logging_settings = dict(self.config.get("logging") or {})
+      if worker_id is not None:
+         # Workers rotating one file between them would lose records
+         logging_settings["filename"] = f"server-worker{worker_id}.log"
+      setup_logging(logging_settings)
+      logger.info(f"Configuration loaded from {os.path.abspath(self.config_path)}")
+      self.user_manager = UserManager.from_config(self.config)
       self.message_handler = MessageHandler(self.user_manager)
-      self.encryption = EncryptionManager()
+      self.retention = MessageRetention.from_config(self.user_manager.storage, self.config.get("retention"))
+      self.backup = BackupJob.from_config(self.user_manager.storage, self.config, self.user_manager.db_path)
+      self.encryption = encryption or EncryptionManager()
       self.running = False
+      self.shutdown_event = threading.Event()  # The main thread sleeps on this until shutdown
+      self.scheduler = Scheduler()
+      self.setup_rate_limiters()
       
       # Create message handlers before creating server
       self.setup_message_handlers()
       
       # Initialize server with handlers
-      self.server = ServerConnection(handlers=self.handlers)
+      self.server = ServerConnection(handlers=self.handlers, config_path=self.config_path,
+                                     scheduler=self.scheduler, encryption=self.encryption,
+                                     reuse_port=worker_id is not None)
+      self.scheduler.metrics = self.server.metrics
+      self.exporter = ChatExporter.from_config(self.server, self.config.get("export"))
+      self.attachments = AttachmentTransfers.from_config(self.server, self.config, self.user_manager.db_path)
+      self.subscriptions = ChatSubscriptions.from_config(self.server, self.config.get("subscriptions"))
+      self.server.chunk_callback = self.attachments.receive_chunk
+      self.server.close_callback = self._connection_closed
+      self.server.metrics.describe("task_run_seconds", "Run time of scheduled maintenance tasks", label="task")
+      self.server.metrics.describe("task_failures_total", "Scheduled task runs that raised", label="task")
+      self.server.metrics.register_gauge("scheduled_tasks", self.scheduler.snapshot)
+      self.server.metrics.register_gauge("user_cache", self.user_manager.user_cache.snapshot)
+      self.server.metrics.register_gauge("retention", self.retention.snapshot)
+      self.server.metrics.register_gauge("backup", self.backup.snapshot)
+      self.server.metrics.register_gauge("exports", self.exporter.snapshot)
+      self.server.metrics.register_gauge("attachments", self.attachments.snapshot)
+      self.server.metrics.register_gauge("subscriptions", self.subscriptions.snapshot)
+      self.metrics_http = None
+      
+      # Chat messages reach members on every node through the bus
+      self.bus.on_deliver(self._deliver_local)
+      self.bus.subscribe("user_registered", self.user_manager.user_directory.add)
+      self.server.presence_callback = self.bus.set_presence
+      self.server.metrics.register_gauge("bus", self.bus.snapshot)
 
    def setup_message_handlers(self):
       """Set up handlers for different types of client messages."""
@@ -35,16 +100,91 @@ class ChatServer:
          "create_chat": self.handle_create_chat,
          "get_chats": self.handle_get_chats,
          "get_messages": self.handle_get_messages,
+         "export_chat": self.handle_export_chat,
+         "export_chat_ack": self.handle_export_chat_ack,
+         "upload_start": self.handle_upload_start,
+         "upload_finish": self.handle_upload_finish,
+         "download_start": self.handle_download_start,
+         "download_ack": self.handle_download_ack,
+         "subscribe": self.handle_subscribe,
+         "unsubscribe": self.handle_unsubscribe,
+         "get_metrics": self.handle_get_metrics,
+         "backup": self.handle_backup,
+         "search_users": self.handle_search_users,
+         "search_archive": self.handle_search_archive,
       }
 
+   def setup_rate_limiters(self):
+      """Create the token buckets configured under rate_limits in config.json."""
+      limits = self.config.get("rate_limits", {})
+      idle_timeout = limits.get("idle_timeout", 300)
+      # Per user: chat messages
+      self.message_limiter = RateLimiter.from_config(
+         limits.get("messages"), {"rate": 2, "burst": 10}, idle_timeout
+      )
+      # Per connection: every rate-limited request the connection makes
+      self.connection_limiter = RateLimiter.from_config(
+         limits.get("connection"), {"rate": 10, "burst": 20}, idle_timeout
+      )
+      # Per connection and per username: logins and registrations, each of which costs a bcrypt hash
+      self.auth_limiter = RateLimiter.from_config(
+         limits.get("auth"), {"rate": 0.2, "burst": 5}, idle_timeout
+      )
+
+   def schedule_maintenance(self):
+      """Register the periodic tasks configured under scheduler in config.json."""
+      settings = self.config.get("scheduler", {})
+      jitter = settings.get("jitter", 5)
+      # Database-wide chores only need one of several workers
+      if not self.worker_id:
+         self.scheduler.every("session_cleanup", settings.get("session_cleanup_interval", 3600),
+                              self.user_manager.cleanup_old_sessions, jitter=jitter)
+         self.scheduler.every("wal_checkpoint", settings.get("wal_checkpoint_interval", 300),
+                              self.user_manager.checkpoint, jitter=jitter)
+         if self.retention.enabled:
+            # Each run works one short slice of the retention pass in progress
+            self.scheduler.every("message_retention", settings.get("message_retention_interval", 5),
+                                 self.retention.run)
+         # Every worker shares the uploads directory; ones running elsewhere are still being written to
+         self.scheduler.every("partial_upload_expiry", settings.get("partial_upload_expiry_interval", 3600),
+                              self.attachments.expire_partials, jitter=jitter)
+      self.scheduler.every("session_renewal_flush", settings.get("session_renewal_flush_interval", 30),
+                           self.user_manager.flush_session_renewals)
+      self.scheduler.every("rate_limiter_eviction", settings.get("rate_limiter_eviction_interval", 60),
+                           self.evict_rate_limiters, jitter=jitter)
+      self.scheduler.every("unread_flush", settings.get("unread_flush_interval", 1),
+                           self.subscriptions.flush)
+      if settings.get("metrics_snapshot_interval"):
+         self.scheduler.every("metrics_snapshot", settings["metrics_snapshot_interval"],
+                              self.log_metrics_snapshot, jitter=jitter)
+
+   def evict_rate_limiters(self):
+      """Drop idle rate-limit buckets even when no requests arrive to do it."""
+      for limiter in (self.message_limiter, self.connection_limiter, self.auth_limiter):
+         limiter.evict_idle()
+
+   def log_metrics_snapshot(self):
+      """Write the counters and gauges to the log, for servers nobody scrapes."""
+      snapshot = self.server.metrics.snapshot()
+      logger.info("metrics_snapshot", extra={"fields": {
+         "counters": snapshot["counters"],
+         "gauges": snapshot["gauges"]
+      }})
+
+   def _rate_limited(self, limiter, key, request_type):
+      """Spend a token for key; returns True (and counts it) if the request must be rejected."""
+      if limiter.allow(key):
+         return False
+      self.server.metrics.increment("rate_limited_total", request_type)
+      return True
+
    def load_config(self):
       """Load server configuration from config.json."""
       try:
-         config_path = os.path.join(os.path.dirname(__file__), "..", "config.json")
-         with open(config_path, 'r') as f:
+         with open(self.config_path, 'r') as f:
                self.config = json.load(f)
-         print("Configuration loaded successfully")
       except Exception as e:
+         # Logging is configured from this file, so this one has to be a print
          print(f"Error loading configuration: {e}")
          sys.exit(1)
 
@@ -52,35 +192,51 @@ class ChatServer:
       """Start the chat server."""
       try:
          self.running = True
-         print("Starting chat server...")
+         logger.info("Starting chat server...")
+         
+         
+         # Username search answers from memory, so build its index before accepting clients
+         start = time.perf_counter()
+         count = self.user_manager.load_user_directory()
+         logger.info(f"User directory loaded: {count} usernames in {time.perf_counter() - start:.2f}s")
          
-         # Initialize encryption
-         self.encryption.generate_keys()
-         print("Encryption keys generated")
+         self.bus.start()
          
          # Start the server
          if self.server.start_server():
-               print(f"Server running on {self.config['server_ip_address']}:{self.config['server_port']}")
+               logger.info(f"Server running on {self.config['server_ip_address']}:{self.config['server_port']}")
+               
+               # Optional Prometheus endpoint, only when a port is configured
+               metrics_config = self.config.get("metrics", {})
+               if metrics_config.get("http_port"):
+                  self.metrics_http = MetricsHTTPServer(
+                     self.server.metrics,
+                     host=metrics_config.get("http_host", "127.0.0.1"),
+                     # Each worker has its own metrics, on consecutive ports
+                     port=metrics_config["http_port"] + (self.worker_id or 0)
+                  )
+                  self.metrics_http.start()
                
                # Set up message handlers
                self.setup_message_handlers()
                
-               # Keep the server running
-               last_cleanup = time.time()
-               while self.running:
-                  # Cleanup old sessions every hour
-                  current_time = time.time()
-                  if current_time - last_cleanup > 3600:  # 3600 seconds = 1 hour
-                     self.user_manager.cleanup_old_sessions()
-                     last_cleanup = current_time
-                  time.sleep(1)  # Sleep for 1 second to prevent high CPU usage
+               # Periodic maintenance runs on the scheduler's thread
+               self.schedule_maintenance()
+               self.scheduler.start()
+               
+               # Keep the server running until shutdown() sets the event. Windows
+               # can't interrupt an untimed wait with Ctrl+C, so wake up there
+               signal.signal(signal.SIGTERM, self.handle_shutdown)
+               wake_interval = 1.0 if os.name == "nt" else None
+               while not self.shutdown_event.wait(wake_interval):
+                  pass
                   
          else:
-               print("Failed to start server")
+               logger.error("Failed to start server")
                sys.exit(1)
                
       except Exception as e:
-         print(f"Server error: {e}")
+         logger.exception(f"Server error: {e}")
          self.shutdown()
          
    def handle_registration(self, client_socket, data):
@@ -90,8 +246,17 @@ class ChatServer:
       
       if not username or not password:
          return {"success": False, "message": "Missing credentials"}
+      
+      # Checked before touching the database or hashing anything
+      if (self._rate_limited(self.connection_limiter, id(client_socket), "register")
+            or self._rate_limited(self.auth_limiter, id(client_socket), "register")
+            or self._rate_limited(self.auth_limiter, str(username).lower(), "register")):
+         return {"success": False, "message": RATE_LIMIT_MESSAGE}
          
       success, message = self.user_manager.register_user(username, password)
+      if success:
+         # Other nodes' username search indexes
+         self.bus.publish("user_registered", username)
       return {"success": success, "message": message}
    
    def handle_login(self, client_socket, data):
@@ -101,8 +266,19 @@ class ChatServer:
       
       if not username or not password:
          return {"success": False, "message": "Missing credentials"}
+      
+      # Checked before touching the database or hashing anything
+      if (self._rate_limited(self.connection_limiter, id(client_socket), "login")
+            or self._rate_limited(self.auth_limiter, id(client_socket), "login")
+            or self._rate_limited(self.auth_limiter, str(username).lower(), "login")):
+         return {"success": False, "message": RATE_LIMIT_MESSAGE}
          
       success, message, token = self.user_manager.authenticate_user(username, password)
+      if success:
+         # Broadcasts for this user's chats now reach this connection
+         user = self.user_manager.get_user_by_username(username)
+         if user:
+            self.server.bind_user(client_socket, user['user_id'])
       return {
          "success": success,
          "message": message,
@@ -165,6 +341,7 @@ class ChatServer:
       token = data.get("token")
       chat_id = data.get("chat_id")
       limit = data.get("limit", 50)
+      before_id = data.get("before_id")  # Set to page back past the messages already fetched
       
       # Validate session
       is_valid, user_id = self.user_manager.validate_session(token)
@@ -172,13 +349,244 @@ class ChatServer:
          return {"success": False, "message": "Invalid session"}
          
       success, messages = self.message_handler.fetch_chat_history(
-         chat_id, user_id, limit
+         chat_id, user_id, limit, before_id
       )
       return {
          "success": success,
          "messages": messages if success else []
       }
 
+   def handle_export_chat(self, client_socket, data):
+      """Handle requests to stream a chat's whole history as export_chat_chunk frames."""
+      token = data.get("token")
+      chat_id = data.get("chat_id")
+      export_id = data.get("export_id")  # Chosen by the client, so it can route chunks that beat this response
+      
+      if self._rate_limited(self.connection_limiter, id(client_socket), "export_chat"):
+         return {"success": False, "message": RATE_LIMIT_MESSAGE}
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      if not isinstance(export_id, (int, str)) or isinstance(export_id, bool):
+         return {"success": False, "message": "An export_id is required"}
+      
+      chunk_size = self.exporter.clamp_chunk_size(data.get("chunk_size"))
+      success, pages = self.message_handler.stream_chat_history(chat_id, user_id, chunk_size)
+      if not success:
+         return {"success": False, "message": pages}
+      
+      # Streams on its own thread, so this connection can keep sending acks
+      success, result = self.exporter.start(client_socket, export_id, pages, data.get("window"))
+      if not success:
+         return {"success": False, "message": result}
+      return {
+         "success": True,
+         "export_id": export_id,
+         "chunk_size": chunk_size,
+         "window": result
+      }
+
+   def handle_export_chat_ack(self, client_socket, data):
+      """Handle a client granting an export more chunks, or cancelling it."""
+      running = self.exporter.acknowledge(client_socket, data.get("export_id"), data.get("credit", 0),
+                                          bool(data.get("cancel")))
+      return {"success": running}
+
+   def handle_upload_start(self, client_socket, data):
+      """Handle requests to start (or resume) uploading an attachment."""
+      token = data.get("token")
+      attachment_id = data.get("attachment_id")  # SHA-256 of the file, hex
+      size = data.get("size")
+      
+      if self._rate_limited(self.connection_limiter, id(client_socket), "upload_start"):
+         return {"success": False, "message": RATE_LIMIT_MESSAGE}
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      readable = is_attachment_id(attachment_id) and self.user_manager.can_read_attachment(attachment_id, user_id)
+      success, result = self.attachments.start_upload(client_socket, user_id, attachment_id, size, readable)
+      if not success:
+         return {"success": False, "message": result}
+      if result.get("complete"):
+         return {"success": True, "complete": True, "attachment_id": attachment_id, "size": size}
+      return {"success": True, "complete": False, **result}
+
+   def handle_upload_finish(self, client_socket, data):
+      """Handle the end of an upload: store the attachment if all of it arrived intact."""
+      token = data.get("token")
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      success, result = self.attachments.finish_upload(client_socket, data.get("upload_id"))
+      if not success:
+         return {"success": False, **result}
+      if not self.user_manager.add_attachment(result["attachment_id"], result["size"], user_id):
+         return {"success": False, "message": "Failed to store attachment", "offset": 0}
+      return {"success": True, **result}
+
+   def handle_download_start(self, client_socket, data):
+      """Handle requests to stream an attachment (from an offset, to resume) as attachment chunk frames."""
+      token = data.get("token")
+      attachment_id = data.get("attachment_id")
+      download_id = data.get("download_id")  # Chosen by the client, like an export_id
+      
+      if self._rate_limited(self.connection_limiter, id(client_socket), "download_start"):
+         return {"success": False, "message": RATE_LIMIT_MESSAGE}
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      if not isinstance(download_id, int) or isinstance(download_id, bool) or not 0 <= download_id < 2**64:
+         return {"success": False, "message": "A numeric download_id is required"}
+      if not is_attachment_id(attachment_id) or not self.user_manager.can_read_attachment(attachment_id, user_id):
+         return {"success": False, "message": "Attachment not found"}
+      
+      success, result = self.attachments.start_download(client_socket, attachment_id, download_id,
+                                                        data.get("offset", 0), data.get("window"))
+      if not success:
+         return {"success": False, "message": result}
+      return {"success": True, "download_id": download_id, **result}
+
+   def handle_download_ack(self, client_socket, data):
+      """Handle a client granting a download more chunks, or cancelling it."""
+      running = self.attachments.acknowledge(client_socket, data.get("download_id"), data.get("credit", 0),
+                                             bool(data.get("cancel")))
+      return {"success": running}
+
+   def _message_attachment(self, attachment, user_id):
+      """Check a send_message attachment; returns (success, {attachment_id, filename, size} or why not)."""
+      if not isinstance(attachment, dict) or not is_attachment_id(attachment.get("attachment_id")):
+         return False, "Invalid attachment"
+      filename = attachment.get("filename")
+      if isinstance(filename, str):
+         # Only the name, never a path the recipient would write to
+         filename = os.path.basename(filename.replace("\\", "/")).strip()
+      if not isinstance(filename, str) or not filename or len(filename) > 255:
+         return False, "Attachment file name must be 1-255 characters"
+      if not self.user_manager.can_read_attachment(attachment["attachment_id"], user_id):
+         return False, "Attachment not found"
+      stored = self.user_manager.get_attachment(attachment["attachment_id"])
+      return True, {
+         "attachment_id": attachment["attachment_id"],
+         "filename": filename,
+         "size": stored["size"]
+      }
+
+   def handle_subscribe(self, client_socket, data):
+      """Handle a client asking for full pushes of some chats, and only unread counts of the rest."""
+      token = data.get("token")
+      
+      if self._rate_limited(self.connection_limiter, id(client_socket), "subscribe"):
+         return {"success": False, "message": RATE_LIMIT_MESSAGE}
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      success, chat_ids = self._subscription_chat_ids(data.get("chat_ids"))
+      if not success:
+         return {"success": False, "message": chat_ids}
+      for chat_id in chat_ids:
+         if not self.user_manager.is_chat_member(chat_id, user_id):
+            return {"success": False, "message": f"Not a member of chat {chat_id}"}
+      
+      success, result = self.subscriptions.subscribe(client_socket, chat_ids)
+      if not success:
+         return {"success": False, "message": result}
+      return {
+         "success": True,
+         # What was counted for these chats while unsubscribed, so the client knows what to fetch
+         "chats": [{"chat_id": chat_id, "unread": unread} for chat_id, unread in result.items()]
+      }
+
+   def handle_unsubscribe(self, client_socket, data):
+      """Handle a client going back to unread counts only for some chats."""
+      token = data.get("token")
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      success, chat_ids = self._subscription_chat_ids(data.get("chat_ids"))
+      if not success:
+         return {"success": False, "message": chat_ids}
+      self.subscriptions.unsubscribe(client_socket, chat_ids)
+      return {"success": True}
+
+   def _subscription_chat_ids(self, chat_ids):
+      """Check the chat_ids of a subscribe or unsubscribe request; returns (success, chat IDs or why not)."""
+      if not isinstance(chat_ids, list) or not all(
+            isinstance(chat_id, int) and not isinstance(chat_id, bool) for chat_id in chat_ids):
+         return False, "chat_ids must be a list of chat IDs"
+      if len(chat_ids) > self.subscriptions.max_subscriptions:
+         return False, f"At most {self.subscriptions.max_subscriptions} chats can be subscribed to"
+      return True, list(dict.fromkeys(chat_ids))
+
+   def _connection_closed(self, client_socket):
+      """Stop a closed connection's exports and transfers, and forget its subscriptions and rate limits."""
+      self.exporter.close_connection(client_socket)
+      self.attachments.close_connection(client_socket)
+      self.subscriptions.close_connection(client_socket)
+      # Keyed by id(), which a later connection's socket can be given
+      self.connection_limiter.forget(id(client_socket))
+      self.auth_limiter.forget(id(client_socket))
+
+   def handle_get_metrics(self, client_socket, data):
+      """Handle admin requests for the server's metrics."""
+      token = data.get("token")
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      if not self._is_admin(user_id):
+         return {"success": False, "message": "Not authorized"}
+      
+      return {
+         "success": True,
+         "metrics": self.server.metrics.snapshot()
+      }
+
+   def handle_backup(self, client_socket, data):
+      """Handle admin requests to back up the database while the server runs."""
+      token = data.get("token")
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      if not self._is_admin(user_id):
+         return {"success": False, "message": "Not authorized"}
+      
+      # Runs in the background; progress shows up under "backup" in get_metrics
+      success, result = self.backup.start()
+      if not success:
+         return {"success": False, "message": result}
+      return {
+         "success": True,
+         "path": result
+      }
+
+   def _is_admin(self, user_id):
+      """Only users listed as admins in config.json may read metrics or start backups."""
+      user = self.user_manager.get_user_by_id(user_id)
+      return bool(user) and user['username'] in self.config.get("metrics", {}).get("admin_users", [])
+
    def handle_disconnect(self, client_socket, data):
       """Handle client disconnect requests."""
       token = data.get("token")
@@ -192,17 +600,25 @@ class ChatServer:
 
    def handle_shutdown(self, signum, frame):
       """Handle shutdown signals gracefully."""
-      print("\nShutting down server...")
+      logger.info("Shutting down server...")
       self.shutdown()
 
    def shutdown(self):
       """Clean shutdown of the server."""
       self.running = False
+      self.shutdown_event.set()
+      if hasattr(self, 'scheduler'):
+         self.scheduler.stop()
+      if getattr(self, 'metrics_http', None):
+         self.metrics_http.stop()
+      if getattr(self, 'bus', None):
+         self.bus.stop()
       if hasattr(self, 'server'):
          self.server.stop_server()
       if hasattr(self, 'user_manager'):
          self.user_manager.close()
-      print("Server shutdown complete")
+      logger.info("Server shutdown complete")
+      shutdown_logging()
       sys.exit(0)
 
    def handle_start_private_chat(self, client_socket, data):
@@ -254,9 +670,66 @@ class ChatServer:
          }
          
       except Exception as e:
-         print(f"Error in handle_start_private_chat: {e}")
+         logger.exception(f"Error in handle_start_private_chat: {e}")
          return {"success": False, "message": "Internal server error"}
 
+   def handle_search_users(self, client_socket, data):
+      """Handle username autocomplete requests."""
+      token = data.get("token")
+      query = data.get("query")
+      limit = data.get("limit", 10)
+      
+      if self._rate_limited(self.connection_limiter, id(client_socket), "search_users"):
+         return {"success": False, "message": RATE_LIMIT_MESSAGE}
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      if not isinstance(query, str) or not query or len(query) > 20:
+         return {"success": False, "message": "Query must be 1-20 characters"}
+      if not isinstance(limit, int) or isinstance(limit, bool):
+         limit = 10
+      limit = max(1, min(limit, MAX_SEARCH_RESULTS))
+      
+      # Users never need to find themselves
+      user = self.user_manager.get_user_by_id(user_id)
+      usernames = self.user_manager.search_users(query, limit, exclude=user['username'] if user else None)
+      return {
+         "success": True,
+         "usernames": usernames
+      }
+
+   def handle_search_archive(self, client_socket, data):
+      """Handle searches of a chat's archived (expired) messages."""
+      token = data.get("token")
+      chat_id = data.get("chat_id")
+      query = data.get("query")
+      limit = data.get("limit", 20)
+      
+      if self._rate_limited(self.connection_limiter, id(client_socket), "search_archive"):
+         return {"success": False, "message": RATE_LIMIT_MESSAGE}
+      
+      # Validate session
+      is_valid, user_id = self.user_manager.validate_session(token)
+      if not is_valid:
+         return {"success": False, "message": "Invalid session"}
+      
+      if not isinstance(query, str) or not query.strip() or len(query) > 100:
+         return {"success": False, "message": "Query must be 1-100 characters"}
+      if not isinstance(limit, int) or isinstance(limit, bool):
+         limit = 20
+      limit = max(1, min(limit, MAX_SEARCH_RESULTS))
+      
+      success, result = self.user_manager.search_archived_messages(chat_id, user_id, query, limit)
+      if not success:
+         return {"success": False, "message": result}
+      return {
+         "success": True,
+         "messages": result
+      }
+
    def handle_chat_message(self, client_socket, data):
       """Handle a new chat message."""
       token = data.get("token")
@@ -264,17 +737,32 @@ class ChatServer:
       content = data.get("content")
       
       try:
+         if self._rate_limited(self.connection_limiter, id(client_socket), "send_message"):
+            return {"success": False, "message": RATE_LIMIT_MESSAGE}
+         
          # Validate session
          is_valid, user_id = self.user_manager.validate_session(token)
          if not is_valid:
             return {"success": False, "message": "Invalid session"}
+         
+         # Per user, so opening more connections doesn't raise the limit
+         if self._rate_limited(self.message_limiter, user_id, "send_message"):
+            return {"success": False, "message": RATE_LIMIT_MESSAGE}
                
+         # Attachments travel separately (upload_start); the message only names one
+         attachment = data.get("attachment")
+         if attachment is not None:
+            success, attachment = self._message_attachment(attachment, user_id)
+            if not success:
+               return {"success": False, "message": attachment}
+            content = content or ""
+         
          # Validate message length
          if len(content) > self.config['chat_settings']['max_message_length']:
             return {"success": False, "message": "Message too long"}
                
          # Store message
-         success, message_id = self.user_manager.store_message(chat_id, user_id, content)
+         success, message_id = self.user_manager.store_message(chat_id, user_id, content, attachment)
          if not success:
             return {"success": False, "message": "Failed to store message"}
                
@@ -291,6 +779,8 @@ class ChatServer:
             "timestamp": timestamp,
             "username": sender_info['username']
          }
+         if attachment:
+            message_data["attachment"] = attachment
          
          # Broadcast to all chat members
          self._broadcast_to_chat_members(chat_id, {
@@ -305,34 +795,55 @@ class ChatServer:
       }
          
       except Exception as e:
-         print(f"Error in handle_chat_message: {e}")
+         logger.exception(f"Error in handle_chat_message: {e}")
          return {"success": False, "message": "Internal server error"}
     
    def _broadcast_to_chat_members(self, chat_id, message, exclude_socket=None):
-      """Broadcast message to all members of a chat."""
+      """Broadcast message to all members of a chat, on this node and the others."""
       try:
          # Get all chat members
          members = self.user_manager.get_chat_members(chat_id)
          
-         # Access connected clients through the ServerConnection instance
-         connected_clients = {
-            socket: client_info for socket, client_info in self.server.connected_clients.items()
-         }
-         
-         for socket, client_info in connected_clients.items():
-            if socket != exclude_socket:
-               try:
-                  self.server.send_to_client(socket, message)
-               except Exception as e:
-                  print(f"Error broadcasting to client: {e}")
+         # Only the members' own connections, on whichever nodes they are connected to
+         self.bus.deliver(chat_id, members, message,
+                          exclude=id(exclude_socket) if exclude_socket is not None else None)
                      
       except Exception as e:
-         print(f"Error in broadcast: {e}")
+         logger.exception(f"Error in broadcast: {e}")
+   
+   def _deliver_local(self, user_ids, message, exclude=None):
+      """Bus callback: send a chat message to the recipients connected to this node."""
+      # In full to the connections watching the chat, as an unread count to the others
+      self.subscriptions.deliver(user_ids, message, exclude_client=exclude)
+   
+def run_worker(config_path, worker_id, encryption, bus):
+   """Run one supervised worker process until it is told to stop."""
+   ChatServer(config_path, encryption=encryption, bus=bus, worker_id=worker_id).start()
    
 if __name__ == "__main__":
-    server = ChatServer()
+    import argparse
+    import functools
+    parser = argparse.ArgumentParser(description="Run the InteChat server")
+    parser.add_argument("--config", help="path to config.json (defaults to the repository's)")
+    parser.add_argument("--workers", type=int,
+                        help="worker processes sharing the port (defaults to supervisor.workers "
+                             "in config.json; 0 starts one per CPU)")
+    args = parser.parse_args()
+    
+    config_path = args.config or DEFAULT_CONFIG_PATH
+    supervisor = Supervisor(config_path, functools.partial(run_worker, config_path), args.workers)
+    if supervisor.workers > 1:
+        if supervisor.config.get("storage", {}).get("message_store") == "log":
+            print("The message log is written by one process only; running a single process")
+        elif Supervisor.supported():
+            supervisor.run()
+            sys.exit(0)
+        else:
+            print("Multiple workers need fork() and SO_REUSEPORT; running a single process")
+    
+    server = ChatServer(config_path)
     try:
         server.start()
     except KeyboardInterrupt:
-        print("\nServer shutdown requested by user")
+        logger.info("Server shutdown requested by user")
         server.shutdown()
\ No newline at end of file
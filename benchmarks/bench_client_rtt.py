@@ -0,0 +1,85 @@
+"""
+Client round-trip latency against a local server.
+
+Compares the event-driven get_next_response with the old 100 ms sleep-poll
+wait it replaced, plus the Future returned by ClientComm.request.
+
+Usage:
+    python benchmarks/bench_client_rtt.py [--requests 200] [--polled-requests 20]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from local_server import CLIENT_DIR, LocalServer, percentile
+
+sys.path.insert(0, CLIENT_DIR)
+from ClientComm import ClientComm
+
+# get_chats with a bogus token is answered after a single session lookup,
+# so the numbers are dominated by the client-side wait
+REQUEST_TYPE = "get_chats"
+REQUEST_DATA = {"token": "benchmark"}
+
+
+def wait_event(client):
+    client.send_request(REQUEST_TYPE, REQUEST_DATA)
+    return client.get_next_response()
+
+
+def wait_future(client):
+    return client.request(REQUEST_TYPE, REQUEST_DATA).result(timeout=5.0)
+
+
+def wait_polled(client):
+    # What get_next_response used to do: check, then sleep 100 ms
+    client.send_request(REQUEST_TYPE, REQUEST_DATA)
+    future, client.last_request = client.last_request, None
+    start_time = time.time()
+    while not future.done() and (time.time() - start_time) < 5.0:
+        time.sleep(0.1)
+    return future.result()
+
+
+def measure(client, wait, count):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = wait(client)
+        samples.append((time.perf_counter() - start) * 1000)
+        if response is None:
+            raise RuntimeError("Request timed out")
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="round trips per event-driven mode")
+    parser.add_argument("--polled-requests", type=int, default=20, help="round trips for the sleep-poll mode")
+    args = parser.parse_args()
+
+    with LocalServer() as server:
+        client = ClientComm(server.config_path)
+        if not client.connect():
+            raise SystemExit("Could not connect to the local server")
+        try:
+            measure(client, wait_event, 10)  # Warm up
+
+            modes = [
+                ("get_next_response", wait_event, args.requests),
+                ("request().result()", wait_future, args.requests),
+                ("sleep-poll (old)", wait_polled, args.polled_requests),
+            ]
+            print(f"{'mode':<22}{'n':>6}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+            for name, wait, count in modes:
+                samples = measure(client, wait, count)
+                print(f"{name:<22}{count:>6}{sum(samples) / len(samples):>10.2f}"
+                      f"{percentile(samples, 0.50):>10.2f}{percentile(samples, 0.99):>10.2f}")
+        finally:
+            client.disconnect()
+
+
+if __name__ == "__main__":
+    main()
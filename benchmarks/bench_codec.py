@@ -0,0 +1,135 @@
+"""
+Encode/decode benchmark and wire-size comparison for the negotiated encodings
+and compression methods.
+
+Usage:
+    python benchmarks/bench_codec.py [--messages 100] [--chats 20] [--rounds 2000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+
+from Codec import MessageCodec, extract_frame, available_encodings, available_compressions
+
+
+def make_history_response(message_count):
+    """Build a start_private_chat_response frame like the server sends."""
+    messages = []
+    for i in range(message_count):
+        messages.append({
+            "message_id": i + 1,
+            "content": f"Message number {i} in this conversation, how are you?",
+            "timestamp": f"2025-02-04 15:{i // 60 % 60:02d}:{i % 60:02d}",
+            "username": "alice" if i % 2 else "bob"
+        })
+    return {
+        "type": "start_private_chat_response",
+        "data": {
+            "success": True,
+            "chat_id": 1,
+            "target_username": "bob",
+            "messages": messages
+        }
+    }
+
+
+def make_chats_response(chat_count):
+    """Build a get_chats_response frame like the server sends."""
+    chats = []
+    for i in range(chat_count):
+        chats.append({
+            "chat_id": i + 1,
+            "chat_type": "private",
+            "created_at": "2025-02-04 15:30:22",
+            "participants": ["alice", f"user{i:04d}"],
+            "last_message": {
+                "message_id": 1000 + i,
+                "content": "See you tomorrow!",
+                "timestamp": "2025-02-04 15:30:30",
+                "username": f"user{i:04d}"
+            }
+        })
+    return {
+        "type": "get_chats_response",
+        "data": {
+            "success": True,
+            "chats": chats
+        }
+    }
+
+
+def bench_codec(codec, message, rounds):
+    """Return (wire bytes, encode us/op, decode us/op) for one payload."""
+    payload = codec.encode(message)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.encode(message)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.decode(payload)
+    decode_time = time.perf_counter() - start
+
+    return len(payload), encode_time / rounds * 1e6, decode_time / rounds * 1e6
+
+
+def bench_frames(codec, message, rounds):
+    """Return (frame bytes, build us/op, parse us/op) including compression."""
+    frame = codec.build_frame(message)
+    parsed = extract_frame(bytearray(frame))
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.build_frame(message)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.decode_frame(parsed)
+    parse_time = time.perf_counter() - start
+
+    return len(frame), build_time / rounds * 1e6, parse_time / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100, help="messages in the history payload")
+    parser.add_argument("--chats", type=int, default=20, help="chats in the chat list payload")
+    parser.add_argument("--rounds", type=int, default=2000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    payloads = {
+        "start_private_chat_response": make_history_response(args.messages),
+        "get_chats_response": make_chats_response(args.chats),
+    }
+
+    print(f"Encodings available: {', '.join(available_encodings())}")
+    print(f"{'payload':<30}{'encoding':<10}{'bytes':>10}{'vs json':>10}{'encode us':>12}{'decode us':>12}")
+    for name, message in payloads.items():
+        json_size = None
+        for encoding in reversed(available_encodings()):
+            size, encode_us, decode_us = bench_codec(MessageCodec(encoding), message, args.rounds)
+            if json_size is None:
+                json_size = size
+            print(f"{name:<30}{encoding:<10}{size:>10}{size / json_size:>10.2f}"
+                  f"{encode_us:>12.1f}{decode_us:>12.1f}")
+
+    print()
+    print(f"{'payload':<30}{'format':<18}{'frame bytes':>12}{'ratio':>8}{'build us':>12}{'parse us':>12}")
+    for name, message in payloads.items():
+        for encoding in reversed(available_encodings()):
+            plain_size, _, _ = bench_frames(MessageCodec(encoding), message, 1)
+            for compression in available_compressions():
+                codec = MessageCodec(encoding, compression=compression, compression_threshold=0)
+                size, build_us, parse_us = bench_frames(codec, message, args.rounds)
+                print(f"{name:<30}{encoding + '+' + compression:<18}{size:>12}"
+                      f"{plain_size / size:>8.2f}{build_us:>12.1f}{parse_us:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
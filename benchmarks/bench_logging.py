@@ -0,0 +1,111 @@
+"""
+Measure what request logging costs the request thread at each log level.
+
+Each iteration logs what process_request logs for one request: the
+request data (a login, with its password) and the response (a
+100-message chat history). The old behaviour, two print() calls of the
+full dicts, is measured with stdout redirected to a file.
+
+Usage:
+    python benchmarks/bench_logging.py [--iterations 20000]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+import ServerLog
+from ServerLog import setup_logging, shutdown_logging, get_logger, log_event, StructuredFormatter
+
+REQUEST = {"username": "benchmark_user", "password": "correct horse battery staple"}
+RESPONSE = {
+    "type": "start_private_chat_response",
+    "data": {
+        "success": True,
+        "chat_id": 42,
+        "target_username": "other_user",
+        "messages": [
+            {"message_id": i, "content": f"Message number {i} in this chat's history",
+             "timestamp": "2025-02-04 15:30:22", "username": "other_user"}
+            for i in range(100)
+        ]
+    }
+}
+
+
+def run_print(iterations, workdir):
+    with open(os.path.join(workdir, "stdout.txt"), "w") as out, contextlib.redirect_stdout(out):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            print(f"Processing login request with data: {REQUEST}")
+            print(f"Sending response: {RESPONSE}")
+        caller = time.perf_counter() - start
+    return caller, caller
+
+
+def run_logger(iterations, logger):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        log_event(logger, logging.DEBUG, "request", type="login", data=REQUEST)
+        log_event(logger, logging.DEBUG, "response", type=RESPONSE["type"], data=RESPONSE["data"])
+    caller = time.perf_counter() - start
+    shutdown_logging()  # Waits until the listener has written everything
+    return caller, time.perf_counter() - start
+
+
+def run_queued(iterations, workdir, level, sampling=None):
+    logger = get_logger("bench")
+    setup_logging({"level": level, "console_level": "OFF", "directory": workdir,
+                   "sampling": sampling or {}})
+    return run_logger(iterations, logger)
+
+
+def run_synchronous(iterations, workdir):
+    """DEBUG with the file handler on the calling thread, to show what the queue saves."""
+    ServerLog._sample_rates = {}
+    logger = logging.getLogger("intechat-sync")
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = RotatingFileHandler(os.path.join(workdir, "sync.log"), maxBytes=50 * 1024 * 1024,
+                                  backupCount=1, encoding="utf-8")
+    handler.setFormatter(StructuredFormatter())
+    logger.addHandler(handler)
+    try:
+        return run_logger(iterations, logger)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000, help="requests logged per scenario")
+    args = parser.parse_args()
+
+    scenarios = [
+        ("print (old)", lambda d: run_print(args.iterations, d)),
+        ("level INFO (request logs off)", lambda d: run_queued(args.iterations, d, "INFO")),
+        ("level DEBUG, sampled 1%", lambda d: run_queued(args.iterations, d, "DEBUG",
+                                                        {"request": 0.01, "response": 0.01})),
+        ("level DEBUG, queued", lambda d: run_queued(args.iterations, d, "DEBUG")),
+        ("level DEBUG, synchronous file", lambda d: run_synchronous(args.iterations, d)),
+    ]
+
+    print(f"{'scenario':<32}{'caller us/req':>15}{'total us/req':>15}")
+    for name, run in scenarios:
+        workdir = tempfile.mkdtemp(prefix="intechat-logbench-")
+        try:
+            caller, total = run(workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"{name:<32}{caller / args.iterations * 1e6:>15.2f}{total / args.iterations * 1e6:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
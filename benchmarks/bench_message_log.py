@@ -0,0 +1,102 @@
+"""
+Compare the SQLite message tables with the append-only message log.
+
+Stores --messages messages over --chats chats through each store's
+Storage.add_message, then reads history the two ways clients do: the
+newest --page messages of a random chat, and whole chats paged back
+through with before_id. Reports operations per second and latency for
+each phase. The SQLite store does a B-tree insert per message and an
+indexed ORDER BY per read; the log appends a record and follows each
+chat's back pointers through mmap.
+
+Usage:
+    python benchmarks/bench_message_log.py [--messages 50000] [--chats 200] [--page 50] [--reads 5000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from local_server import SERVER_DIR, percentile
+
+sys.path.insert(0, SERVER_DIR)
+from Storage import SQLiteStorage
+
+# Seeded users get a fixed dummy hash, bcrypt would make seeding take hours
+DUMMY_HASH = b"$2b$12$benchmarkbenchmarkbenchmarkbenchmarkbenchmarkbenchmar"
+
+
+def timed(operations):
+    """Run each operation, returning (operations per second, latencies)."""
+    latencies = []
+    started = time.perf_counter()
+    for operation in operations:
+        start = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - start)
+    return len(latencies) / (time.perf_counter() - started), latencies
+
+
+def report(store, phase, result):
+    rate, latencies = result
+    print(f"{store:<10}{phase:<14}{rate:>12.0f}{percentile(latencies, 0.5) * 1e6:>12.1f}"
+          f"{percentile(latencies, 0.99) * 1e6:>12.1f}")
+
+
+def read_history(storage, chat_id, page):
+    before_id = None
+    while True:
+        rows = storage.get_messages(chat_id, page, before_id)
+        if len(rows) < page:
+            return
+        before_id = rows[-1][0]
+
+
+def run(args, store):
+    workdir = tempfile.mkdtemp(prefix="intechat-log-")
+    try:
+        storage = SQLiteStorage(os.path.join(workdir, "chat_database.db"), message_store=store)
+        user_id = storage.add_user("bench", DUMMY_HASH)
+        chat_ids = [storage.create_chat('group', [user_id]) for _ in range(args.chats)]
+        rng = random.Random(1)
+        posts = [(rng.choice(chat_ids), f"Benchmark message {i} " + "x" * rng.randint(0, 120))
+                 for i in range(args.messages)]
+
+        report(store, "insert", timed(
+            lambda chat_id=chat_id, content=content: storage.add_message(chat_id, user_id, content)
+            for chat_id, content in posts
+        ))
+        report(store, "tail read", timed(
+            lambda chat_id=rng.choice(chat_ids): storage.get_messages(chat_id, args.page)
+            for _ in range(args.reads)
+        ))
+        report(store, "full history", timed(
+            lambda chat_id=chat_id: read_history(storage, chat_id, args.page)
+            for chat_id in chat_ids
+        ))
+        storage.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50000, help="messages to insert")
+    parser.add_argument("--chats", type=int, default=200, help="chats the messages are spread over")
+    parser.add_argument("--page", type=int, default=50, help="messages per history read")
+    parser.add_argument("--reads", type=int, default=5000, help="tail reads of random chats")
+    parser.add_argument("--stores", default="sqlite,log", help="comma-separated message stores to compare")
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages over {args.chats} chats, pages of {args.page}")
+    print(f"{'store':<10}{'phase':<14}{'ops/s':>12}{'p50 us':>12}{'p99 us':>12}")
+    for store in args.stores.split(","):
+        run(args, store)
+
+
+if __name__ == "__main__":
+    main()
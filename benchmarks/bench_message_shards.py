@@ -0,0 +1,100 @@
+"""
+Measure concurrent message inserts with and without message shards.
+
+Forks --writers processes (like the server's --workers), each storing
+messages into its own chats through UserManager.store_message for
+--duration seconds, once with every message in the main database and once
+per shard count in --shards. Reports total inserts per second and insert
+latency. Without shards every insert waits for SQLite's single write lock;
+with shards, writers whose chats hash to different files don't.
+
+Usage:
+    python benchmarks/bench_message_shards.py [--writers 4] [--shards 0,2,4,8] [--duration 5]
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from local_server import SERVER_DIR, percentile
+
+sys.path.insert(0, SERVER_DIR)
+from UserManager import UserManager
+
+# Seeded users get a fixed dummy hash, bcrypt would make seeding take hours
+DUMMY_HASH = b"$2b$12$benchmarkbenchmarkbenchmarkbenchmarkbenchmarkbenchmar"
+
+
+def seed(db_path, shards, writers, chats_per_writer):
+    """Create one user per writer and its chats; returns [(user_id, [chat_id, ...])] per writer."""
+    user_manager = UserManager(db_path, message_shards=shards)
+    plan = []
+    for writer in range(writers):
+        user_id = user_manager.storage.add_user(f"writer{writer:03d}", DUMMY_HASH)
+        chat_ids = [user_manager.storage.create_chat('group', [user_id]) for _ in range(chats_per_writer)]
+        plan.append((user_id, chat_ids))
+    user_manager.close()
+    return plan
+
+
+def write(db_path, shards, user_id, chat_ids, start_at, duration, results):
+    user_manager = UserManager(db_path, message_shards=shards)
+    latencies = []
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        success, _ = user_manager.store_message(chat_ids[i % len(chat_ids)], user_id, f"Benchmark message {i}")
+        if success:
+            latencies.append(time.perf_counter() - start)
+        i += 1
+    user_manager.close()
+    results.put(latencies)
+
+
+def run(args, shards):
+    workdir = tempfile.mkdtemp(prefix="intechat-shards-")
+    try:
+        db_path = os.path.join(workdir, "chat_database.db")
+        plan = seed(db_path, shards, args.writers, args.chats_per_writer)
+        results = multiprocessing.Queue()
+        start_at = time.time() + 0.5  # Let every writer open its connections first
+        processes = [
+            multiprocessing.Process(target=write, args=(db_path, shards, user_id, chat_ids,
+                                                        start_at, args.duration, results))
+            for user_id, chat_ids in plan
+        ]
+        for process in processes:
+            process.start()
+        latencies = [latency for _ in processes for latency in results.get()]
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    label = f"{shards} shards" if shards else "main database"
+    print(f"{label:<16}{len(latencies) / args.duration:>12.0f}{percentile(latencies, 0.5) * 1e6:>12.1f}"
+          f"{percentile(latencies, 0.99) * 1e6:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--writers", type=int, default=4, help="concurrent writer processes")
+    parser.add_argument("--shards", default="0,2,4,8", help="comma-separated shard counts to compare (0 = no shards)")
+    parser.add_argument("--chats-per-writer", type=int, default=8, help="chats each writer posts to")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of inserts per run")
+    args = parser.parse_args()
+
+    print(f"{args.writers} writers, {args.duration:.0f}s per run, {os.cpu_count()} CPUs")
+    print(f"{'storage':<16}{'inserts/s':>12}{'p50 us':>12}{'p99 us':>12}")
+    for shards in (int(count) for count in args.shards.split(",")):
+        run(args, shards)
+
+
+if __name__ == "__main__":
+    main()
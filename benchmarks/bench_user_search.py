@@ -0,0 +1,105 @@
+"""
+Measure username prefix search over a large synthetic user table.
+
+Builds the UserDirectory index from --users random usernames, then times
+search_users-style queries for short and long prefixes. For comparison,
+the same queries run as a LOWER(username) LIKE 'prefix%' scan against an
+in-memory SQLite users table, which is what a database-only search would
+do; that baseline is slow at this size, so it runs fewer queries.
+
+Usage:
+    python benchmarks/bench_user_search.py [--users 1000000] [--queries 20000]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from local_server import SERVER_DIR, percentile
+
+sys.path.insert(0, SERVER_DIR)
+from UserDirectory import UserDirectory
+
+ALPHABET = string.ascii_letters + string.digits + "_"
+
+
+def make_usernames(count, rng):
+    usernames = set()
+    while len(usernames) < count:
+        length = rng.randint(4, 20)
+        usernames.add("".join(rng.choice(ALPHABET) for _ in range(length)))
+    return list(usernames)
+
+
+def make_queries(usernames, count, rng):
+    """Prefixes of 1-6 characters taken from real usernames, so most of them match."""
+    queries = []
+    for _ in range(count):
+        username = rng.choice(usernames)
+        queries.append(username[:rng.randint(1, 6)])
+    return queries
+
+
+def time_queries(search, queries):
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name, samples):
+    print(f"{name:<28}{len(samples):>10}{percentile(samples, 0.5) * 1e6:>12.1f}"
+          f"{percentile(samples, 0.99) * 1e6:>12.1f}{max(samples) * 1e6:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000000, help="usernames in the index")
+    parser.add_argument("--queries", type=int, default=20000, help="prefix queries to time")
+    parser.add_argument("--sql-queries", type=int, default=20, help="queries for the SQLite baseline")
+    parser.add_argument("--limit", type=int, default=10, help="results per query")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    usernames = make_usernames(args.users, rng)
+    queries = make_queries(usernames, args.queries, rng)
+
+    directory = UserDirectory()
+    start = time.perf_counter()
+    directory.load(usernames)
+    print(f"Index build: {len(directory)} usernames in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    for username in usernames[:1000]:
+        directory.add(username + "x" if len(username) < 20 else username[:-1])
+    print(f"Insert: {(time.perf_counter() - start) / 1000 * 1e6:.1f} us per registration")
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT UNIQUE)")
+    conn.executemany("INSERT INTO users (username) VALUES (?)", ((u,) for u in usernames))
+    conn.execute("CREATE INDEX idx_users_username_lower ON users (LOWER(username))")
+
+    def sql_search(query):
+        return conn.execute(
+            "SELECT username FROM users WHERE LOWER(username) LIKE ? "
+            "ORDER BY LENGTH(username), LOWER(username) LIMIT ?",
+            (query.lower() + "%", args.limit)
+        ).fetchall()
+
+    print(f"\n{'search':<28}{'queries':>10}{'p50 us':>12}{'p99 us':>12}{'max us':>12}")
+    report("UserDirectory", time_queries(lambda q: directory.search(q, args.limit), queries))
+    short = [q for q in queries if len(q) == 1]
+    if short:
+        report("UserDirectory, 1 char", time_queries(lambda q: directory.search(q, args.limit), short))
+    report("SQLite LIKE", time_queries(sql_search, queries[:args.sql_queries]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Multi-client load generator and end-to-end benchmark.
+
+Starts a local ChatServer, then simulates N users in one process with
+AsyncClientComm: they connect, register, log in, open private chats in
+pairs and exchange messages at a fixed rate. Reports handshake, register
+and login rates, message throughput, delivery latency and server memory.
+
+Usage:
+    python benchmarks/load_test.py [--users 50] [--rate 1.0] [--duration 20] [--workers 1]
+                                   [--storage sqlite|memory] [--json out.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from local_server import CLIENT_DIR, LocalServer, percentile
+
+sys.path.insert(0, CLIENT_DIR)
+from AsyncClientComm import AsyncClientComm
+from Encryption import EncryptionManager
+
+PASSWORD = "benchmark123"
+
+
+class SimulatedUser:
+    """One simulated user: a connection plus its delivery bookkeeping."""
+
+    def __init__(self, index, config_path, keys):
+        self.username = f"load{index:05d}"
+        # Reuse one RSA key pair so key generation doesn't dominate connect time
+        encryption = EncryptionManager()
+        encryption.private_key, encryption.public_key = keys
+        self.comm = AsyncClientComm(config_path, encryption=encryption)
+        self.comm.set_message_callback(self.on_message)
+        self.partner = None
+        self.chat_id = None
+        self.sent = 0
+        self.send_failures = 0
+        self.ack_latencies = []
+        self.delivery_latencies = []
+
+    def on_message(self, message):
+        data = message.get("data", {})
+        # Servers may fan out more than our own chat, only count what's ours
+        if data.get("chat_id") != self.chat_id or data.get("username") == self.username:
+            return
+        sent_at = float(data.get("content", "0|").split("|", 1)[0])
+        self.delivery_latencies.append((time.perf_counter() - sent_at) * 1000)
+
+    async def send_loop(self, rate, deadline, payload):
+        interval = 1.0 / rate
+        next_send = time.perf_counter()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = await self.comm.send_message(self.chat_id, f"{start!r}|{payload}")
+                if response.get("success"):
+                    self.sent += 1
+                    self.ack_latencies.append((time.perf_counter() - start) * 1000)
+                else:
+                    self.send_failures += 1
+            except Exception:
+                self.send_failures += 1
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+
+async def timed_phase(name, coroutines, concurrency, results):
+    """Run coroutines with bounded concurrency and record the rate."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(*(run(c) for c in coroutines), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    errors = [repr(o) if isinstance(o, Exception) else o.get("message") for o in outcomes
+              if isinstance(o, Exception) or (isinstance(o, dict) and not o.get("success", True))]
+    results[f"{name}_per_second"] = round(len(outcomes) / elapsed, 2) if elapsed else 0.0
+    results[f"{name}_failures"] = len(errors)
+    print(f"{name:<12}{len(outcomes):>8} in {elapsed:8.2f}s  "
+          f"({results[f'{name}_per_second']:.1f}/s, {len(errors)} failed)")
+    if errors:
+        print(f"{'':<12}first failure: {errors[0]}")
+    return outcomes
+
+
+async def run_load(args, server):
+    keys_source = EncryptionManager()
+    keys_source.generate_keys()
+    keys = (keys_source.private_key, keys_source.public_key)
+
+    users = [SimulatedUser(i, server.config_path, keys) for i in range(args.users)]
+    results = {"users": args.users, "rate_per_user": args.rate, "duration": args.duration,
+               "workers": args.workers, "storage": args.storage}
+
+    await timed_phase("handshake", [u.comm.connect() for u in users], args.concurrency, results)
+    await timed_phase("register", [u.comm.register(u.username, PASSWORD) for u in users],
+                      args.concurrency, results)
+    await timed_phase("login", [u.comm.login(u.username, PASSWORD) for u in users],
+                      args.concurrency, results)
+
+    # Pair users up: even index opens the chat, odd index joins the same one
+    for left, right in zip(users[0::2], users[1::2]):
+        left.partner, right.partner = right, left
+    openers = [u for u in users[0::2] if u.partner]
+    responses = await timed_phase("open_chat", [u.comm.start_private_chat(u.partner.username) for u in openers],
+                                  args.concurrency, results)
+    for user, response in zip(openers, responses):
+        if isinstance(response, dict) and response.get("success"):
+            user.chat_id = user.partner.chat_id = response["chat_id"]
+    senders = [u for u in users if u.chat_id is not None]
+
+    rss_before = server.rss_bytes()
+    payload = "x" * max(0, args.message_size)
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*(u.send_loop(args.rate, deadline, payload) for u in senders))
+    await asyncio.sleep(args.drain)  # Let in-flight deliveries land
+    elapsed = time.perf_counter() - start
+
+    deliveries = [latency for u in users for latency in u.delivery_latencies]
+    acks = [latency for u in users for latency in u.ack_latencies]
+    sent = sum(u.sent for u in users)
+    results.update({
+        "messages_sent": sent,
+        "send_failures": sum(u.send_failures for u in users),
+        "messages_delivered": len(deliveries),
+        "messages_per_second": round(sent / elapsed, 2),
+        "delivery_p50_ms": round(percentile(deliveries, 0.50), 3),
+        "delivery_p99_ms": round(percentile(deliveries, 0.99), 3),
+        "ack_p50_ms": round(percentile(acks, 0.50), 3),
+        "ack_p99_ms": round(percentile(acks, 0.99), 3),
+        "server_rss_before_mb": round(rss_before / 2**20, 1),
+        "server_rss_after_mb": round(server.rss_bytes() / 2**20, 1),
+    })
+
+    await asyncio.gather(*(u.comm.disconnect() for u in users), return_exceptions=True)
+    return results
+
+
+def raise_file_limit():
+    """Each simulated user needs a socket, make sure we can open enough."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50, help="simulated users (paired into private chats)")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per user")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of message traffic")
+    parser.add_argument("--message-size", type=int, default=64, help="padding characters per message")
+    parser.add_argument("--concurrency", type=int, default=50, help="parallel connects/logins")
+    parser.add_argument("--drain", type=float, default=1.0, help="seconds to wait for late deliveries")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite",
+                        help="server storage engine; memory takes the disk out of the measurement")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+    if args.storage == "memory" and args.workers > 1:
+        parser.error("--storage memory needs a single worker, workers don't share memory")
+
+    raise_file_limit()
+    # Measure server capacity, not the configured rate limits
+    unlimited = {"rate": 1e9, "burst": 1e9}
+    overrides = {
+        "rate_limits": {"messages": unlimited, "connection": unlimited, "auth": unlimited},
+        "supervisor": {"workers": args.workers},
+        "storage": {"engine": args.storage}
+    }
+    with LocalServer(overrides) as server:
+        results = asyncio.run(run_load(args, server))
+
+    print()
+    for key, value in results.items():
+        print(f"{key:<24}{value}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Helpers for running a throwaway ChatServer on localhost for benchmarks.
+
+The server runs in a subprocess with its own config and database in a
+temporary directory, so benchmarks never touch Server/storage or clash with
+a server already running on the configured port.
+"""
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+SERVER_DIR = os.path.join(REPO_ROOT, "Server")
+CLIENT_DIR = os.path.join(REPO_ROOT, "Client")
+
+
+def free_port():
+    """Ask the OS for a TCP port nobody is listening on."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LocalServer:
+    """Context manager that starts a ChatServer subprocess and stops it on exit."""
+
+    def __init__(self, overrides=None, keep_files=False):
+        with open(os.path.join(REPO_ROOT, "config.json"), "r") as f:
+            self.config = json.load(f)
+        self.workdir = tempfile.mkdtemp(prefix="intechat-bench-")
+        self.config["server_ip_address"] = "127.0.0.1"
+        self.config["server_port"] = free_port()
+        self.config["database_path"] = os.path.join(self.workdir, "chat_database.db")
+        self.config.setdefault("logging", {})["directory"] = self.workdir
+        for key, value in (overrides or {}).items():
+            if isinstance(value, dict) and isinstance(self.config.get(key), dict):
+                self.config[key].update(value)
+            else:
+                self.config[key] = value
+        self.config_path = os.path.join(self.workdir, "config.json")
+        self.log_path = os.path.join(self.workdir, "server.out")
+        self.keep_files = keep_files
+        self.process = None
+
+    @property
+    def address(self):
+        return self.config["server_ip_address"], self.config["server_port"]
+
+    def start(self, timeout=30.0):
+        with open(self.config_path, "w") as f:
+            json.dump(self.config, f, indent=4)
+        self.log_file = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "main.py", "--config", self.config_path],
+            cwd=SERVER_DIR, stdout=self.log_file, stderr=subprocess.STDOUT
+        )
+
+        # Wait until the listening socket accepts connections
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited early, see {self.log_path}")
+            try:
+                with socket.create_connection(self.address, timeout=0.5):
+                    return self
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("Server did not start listening in time")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if getattr(self, "log_file", None):
+            self.log_file.close()
+        if not self.keep_files:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def rss_bytes(self):
+        """Resident set size of the server process and its workers, if any (Linux only)."""
+        total = 0
+        pids = [self.process.pid]
+        try:
+            with open(f"/proc/{self.process.pid}/task/{self.process.pid}/children", "r") as f:
+                pids += [int(pid) for pid in f.read().split()]
+        except OSError:
+            pass
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/status", "r") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                pass
+        return total
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of an unsorted list of numbers."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
@@ -0,0 +1,253 @@
+"""
+Microbenchmarks for the server's hot paths against a seeded database.
+
+Each benchmark times one call at a time and records ops/s and latency
+percentiles. Results are written as JSON so runs on different commits can
+be compared with --compare.
+
+Usage:
+    python benchmarks/micro_bench.py [--users 1000] [--chats 2000] [--messages 100000]
+                                     [--iterations 2000] [--output results.json]
+                                     [--compare baseline.json] [--only validate_session,...]
+                                     [--storage sqlite|memory] [--shards 0]
+"""
+import argparse
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from local_server import REPO_ROOT, SERVER_DIR, percentile
+
+sys.path.insert(0, SERVER_DIR)
+from Storage import create_storage
+from UserManager import UserManager
+from ServerComm import ServerConnection
+from RateLimiter import RateLimiter
+
+# Seeded users get a fixed dummy hash, bcrypt would make seeding take hours
+DUMMY_HASH = b"$2b$12$benchmarkbenchmarkbenchmarkbenchmarkbenchmarkbenchmar"
+
+
+def seed_database(user_manager, users, chats, messages, seed=1234):
+    """Fill an empty database; returns (user_ids, chat_members, session_tokens)."""
+    rng = random.Random(seed)
+    storage = user_manager.storage
+    user_ids = [storage.add_user(f"bench{i:07d}", DUMMY_HASH) for i in range(users)]
+
+    chat_members = []
+    for _ in range(chats):
+        first, second = rng.sample(user_ids, 2)
+        chat_members.append((storage.create_chat('private', [first, second]), first, second))
+
+    for i in range(messages):
+        chat_id, first, second = chat_members[rng.randrange(len(chat_members))]
+        storage.add_message(chat_id, rng.choice((first, second)), f"Seeded message {i} with some text in it")
+
+    tokens = [secrets.token_urlsafe(32) for _ in range(users)]
+    expires_at = int(time.time()) + 24 * 3600
+    for token, user_id in zip(tokens, user_ids):
+        storage.add_session(token, user_id, expires_at)
+    return user_ids, chat_members, tokens
+
+
+def time_calls(function, iterations):
+    """Call function(i) iterations times; returns per-call latencies in microseconds."""
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(i)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def summarize(samples):
+    total = sum(samples)
+    return {
+        "n": len(samples),
+        "ops_per_second": round(len(samples) / (total / 1e6), 1) if total else 0.0,
+        "mean_us": round(total / len(samples), 3),
+        "p50_us": round(percentile(samples, 0.50), 3),
+        "p99_us": round(percentile(samples, 0.99), 3),
+    }
+
+
+def make_client_connection(server):
+    """Register one end of a socketpair as a connected client; returns (server_end, peer_end)."""
+    server_end, peer_end = socket.socketpair()
+    client_info = ServerConnection.ClientInfo(("benchmark", 0), id(server_end))
+    client_info.session_established = True
+    server.connected_clients[server_end] = client_info
+    return server_end, peer_end
+
+
+def bench_receive_from_client(server, iterations, frame):
+    server_end, peer_end = make_client_connection(server)
+
+    def feed():
+        # Write from another thread so socket buffers never fill up
+        for _ in range(iterations):
+            peer_end.sendall(frame)
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    samples = time_calls(lambda i: server.receive_from_client(server_end), iterations)
+    feeder.join()
+    server.close_connection(server_end)
+    peer_end.close()
+    return samples
+
+
+def bench_send_to_client(server, iterations, message):
+    server_end, peer_end = make_client_connection(server)
+
+    def drain():
+        while peer_end.recv(1 << 16):
+            pass
+    drainer = threading.Thread(target=drain, daemon=True)
+    drainer.start()
+    samples = time_calls(lambda i: server.send_to_client(server_end, message), iterations)
+    server.close_connection(server_end)
+    drainer.join(timeout=2.0)
+    peer_end.close()
+    return samples
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args, workdir):
+    db_path = os.path.join(workdir, "chat_database.db")
+    storage = create_storage({"engine": args.storage, "message_shards": args.shards}, db_path)
+    user_manager = UserManager(db_path, storage=storage)
+
+    start = time.perf_counter()
+    user_ids, chat_members, tokens = seed_database(user_manager, args.users, args.chats, args.messages)
+    print(f"Seeded {args.users} users, {args.chats} chats, {args.messages} messages "
+          f"into {args.storage} storage in {time.perf_counter() - start:.1f}s")
+
+    rng = random.Random(42)
+    n = args.iterations
+    picked_tokens = [rng.choice(tokens) for _ in range(n)]
+    picked_users = [rng.choice(user_ids) for _ in range(n)]
+    picked_chats = [chat_members[rng.randrange(len(chat_members))] for _ in range(n)]
+
+    history = {
+        "type": "start_private_chat_response",
+        "data": {
+            "success": True,
+            "chat_id": 1,
+            "target_username": "bench0000001",
+            "messages": [
+                {"message_id": i, "content": "Seeded message with some text in it",
+                 "timestamp": "2025-02-04 15:30:22", "username": "bench0000001"}
+                for i in range(100)
+            ]
+        }
+    }
+    request_frame = ServerConnection.ClientInfo(None, None).codec.build_frame({
+        "type": "send_message",
+        "data": {"token": tokens[0], "chat_id": 1, "content": "Hello there, how are you?"},
+        "request_id": 1
+    })
+
+    server = ServerConnection()
+    rate_limiter = RateLimiter(rate=2, burst=10)
+
+    benchmarks = {
+        "receive_from_client": lambda: bench_receive_from_client(server, n, request_frame),
+        "send_to_client": lambda: bench_send_to_client(server, n, history),
+        "validate_session": lambda: time_calls(
+            lambda i: user_manager.validate_session(picked_tokens[i]), n),
+        "store_message": lambda: time_calls(
+            lambda i: user_manager.store_message(picked_chats[i][0], picked_chats[i][1], "Benchmark message"), n),
+        "get_user_by_id": lambda: time_calls(
+            lambda i: user_manager.get_user_by_id(picked_users[i]), n),
+        "get_user_chats": lambda: time_calls(
+            lambda i: user_manager.get_user_chats(picked_users[i]), n),
+        "get_formatted_chat_messages": lambda: time_calls(
+            lambda i: user_manager.get_formatted_chat_messages(picked_chats[i][0], limit=100), n),
+        "rate_limiter": lambda: time_calls(
+            lambda i: rate_limiter.allow(picked_users[i]), n),
+    }
+    selected = args.only.split(",") if args.only else list(benchmarks)
+
+    results = {}
+    for name in selected:
+        results[name] = summarize(benchmarks[name]())
+    user_manager.close()
+    return results
+
+
+def print_results(results, baseline=None):
+    header = f"{'benchmark':<30}{'ops/s':>12}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}"
+    if baseline:
+        header += f"{'p50 vs base':>13}"
+    print(header)
+    for name, result in results.items():
+        line = (f"{name:<30}{result['ops_per_second']:>12.1f}{result['mean_us']:>10.2f}"
+                f"{result['p50_us']:>10.2f}{result['p99_us']:>10.2f}")
+        base = (baseline or {}).get(name)
+        if base and base["p50_us"]:
+            line += f"{(result['p50_us'] / base['p50_us'] - 1) * 100:>+12.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="seeded users")
+    parser.add_argument("--chats", type=int, default=2000, help="seeded private chats")
+    parser.add_argument("--messages", type=int, default=100000, help="seeded messages")
+    parser.add_argument("--iterations", type=int, default=2000, help="timed calls per benchmark")
+    parser.add_argument("--only", help="comma-separated benchmark names to run")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite", help="storage engine")
+    parser.add_argument("--shards", type=int, default=0, help="message shard files (0 keeps messages in the main database)")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results from an earlier run to compare against")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="intechat-micro-")
+    try:
+        results = run_benchmarks(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        report = {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "parameters": {
+                "users": args.users,
+                "chats": args.chats,
+                "messages": args.messages,
+                "iterations": args.iterations,
+                "storage": args.storage,
+                "shards": args.shards,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()